@@ -0,0 +1,140 @@
+"""Time the steps of library_matching() on synthetic libraries of different sizes.
+
+Library and query spectra are generated randomly (similar to the synthetic data
+in the "performance-analysis-synthetic-data" notebook) and a small Word2Vec
+model is trained on the fly, so no data needs to be downloaded.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.benchmark_library_matching --library-sizes 1000 10000 --output results.json
+
+Results are written as JSON list with one record per library size, repetition
+and step (step "total" is the full library_matching() call). Library embedding,
+library packing and process pool start-up are reported as separate steps
+("library_embedding", "library_packing", "pool_startup"), as they are only
+needed once for a library (e.g. see library_index.py). Note that the first
+repetition includes compilation time of numba functions (use --n-repeats 2 or more).
+"""
+import argparse
+import json
+import time
+from typing import List
+import numpy as np
+from gensim.models import Word2Vec
+from matchms import Spectrum
+from spec2vec import SpectrumDocument
+from custom_functions.library_search import library_matching
+
+
+def create_synthetic_documents(n_library: int, n_queries: int,
+                               n_peaks: int = 100,
+                               seed: int = 0):
+    """Create random library documents and queries (noisy copies of library spectra).
+
+    Peak positions are rounded to 1 decimal to get a realistic vocabulary size,
+    intensities are normalized to a maximum of 1.
+    """
+    rng = np.random.default_rng(seed)
+    documents_library = []
+    for i in range(n_library):
+        mz = np.unique(np.round(100.0 + 500.0 * rng.random(n_peaks), 1))
+        intensities = rng.random(mz.shape[0])
+        spectrum = Spectrum(mz=mz, intensities=intensities / intensities.max(),
+                            metadata={"precursor_mz": float(np.round(100 + 500 * rng.random(), 4)),
+                                      "smiles": "C" * (1 + i % 20)})
+        documents_library.append(SpectrumDocument(spectrum, n_decimals=1))
+
+    documents_query = []
+    for i in rng.choice(n_library, n_queries, replace=n_queries > n_library):
+        reference = documents_library[i]._obj
+        intensities = reference.peaks.intensities * rng.uniform(0.5, 1.5, reference.peaks.mz.shape[0])
+        spectrum = Spectrum(mz=reference.peaks.mz, intensities=intensities / intensities.max(),
+                            metadata={"precursor_mz": reference.get("precursor_mz") + rng.normal(0, 0.0005)})
+        documents_query.append(SpectrumDocument(spectrum, n_decimals=1))
+    return documents_library, documents_query
+
+
+def train_model(documents: List[SpectrumDocument], vector_size: int = 100,
+                epochs: int = 2, seed: int = 0) -> Word2Vec:
+    """Train small Word2Vec model on the given documents."""
+    return Word2Vec([document.words for document in documents], vector_size=vector_size,
+                    min_count=1, epochs=epochs, seed=seed, workers=1)
+
+
+def run_benchmark(library_sizes: List[int] = (1000, 10000),
+                  n_queries: int = 100,
+                  n_peaks: int = 100,
+                  n_repeats: int = 1,
+                  presearch_based_on: List[str] = ("precursor_mz", "spec2vec-top10", "modcos-top10"),
+                  include_scores: List[str] = ("spec2vec", "cosine", "modcosine"),
+                  n_jobs: int = 1) -> List[dict]:
+    """Time all steps of library_matching() for all library sizes.
+
+    Args:
+    --------
+    library_sizes:
+        Library sizes (number of spectra) to benchmark.
+    n_queries:
+        Number of query spectra. Default = 100.
+    n_peaks:
+        Number of peaks per synthetic spectrum. Default = 100.
+    n_repeats:
+        Number of repetitions per library size. Default = 1.
+    presearch_based_on, include_scores, n_jobs:
+        Passed on to library_matching().
+
+    Returns:
+    --------
+    List of records with library size, repetition, step and time (in s).
+    """
+    results = []
+    for n_library in library_sizes:
+        documents_library, documents_query = create_synthetic_documents(n_library, n_queries, n_peaks)
+        model = train_model(documents_library)
+        for repeat in range(n_repeats):
+            timings = {}
+            start_time = time.perf_counter()
+            found_matches = library_matching(documents_query, documents_library, model,
+                                             presearch_based_on=list(presearch_based_on),
+                                             include_scores=list(include_scores),
+                                             allowed_missing_percentage=100,
+                                             mass_tolerance=2.0,
+                                             n_jobs=n_jobs,
+                                             timings=timings)
+            timings["total"] = time.perf_counter() - start_time
+            n_candidates = sum(len(matches) for matches in found_matches)
+            for step, step_time in timings.items():
+                results.append({"n_library": n_library,
+                                "n_queries": n_queries,
+                                "n_peaks": n_peaks,
+                                "n_candidates": n_candidates,
+                                "repeat": repeat,
+                                "step": step,
+                                "time_s": step_time})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--library-sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--n-peaks", type=int, default=100)
+    parser.add_argument("--n-repeats", type=int, default=1)
+    parser.add_argument("--presearch", nargs="+", default=["precursor_mz", "spec2vec-top10", "modcos-top10"])
+    parser.add_argument("--include-scores", nargs="+", default=["spec2vec", "cosine", "modcosine"])
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None, help="JSON file to store results.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.library_sizes, n_queries=args.n_queries, n_peaks=args.n_peaks,
+                            n_repeats=args.n_repeats, presearch_based_on=args.presearch,
+                            include_scores=args.include_scores, n_jobs=args.n_jobs)
+    for record in results:
+        print(f"n_library={record['n_library']:>8}  {record['step']:<20}{record['time_s']:10.3f} s")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import json
+import os
+import time
+from typing import List
+import numpy as np
+import pandas as pd
+
+
+class IVFIndex:
+    """Approximate nearest neighbour index for Spec2Vec embeddings.
+
+    Inverted file index (IVF): all library embeddings are assigned to one of
+    n_lists clusters (spherical k-means). A query is only compared to the
+    embeddings in the n_probe clusters with the closest centroids, which makes
+    top-n searches in very large libraries much faster than a brute-force search.
+    Larger n_probe gives higher recall (n_probe = n_lists is an exact search).
+    Returned scores are exact cosine similarities.
+
+    For example:
+
+    .. code-block:: python
+
+        library_ids = library_index.library_ids()
+        ann_index = IVFIndex.build(library_index.embeddings[library_ids],
+                                   ids=library_ids, n_probe=10)
+        ann_index.save("ann_index_AllPositive")
+
+        ann_index = IVFIndex.load("ann_index_AllPositive")
+        ids, scores = ann_index.search(query_vectors, top_n=10)
+    """
+    def __init__(self, centroids: np.ndarray,
+                 vectors: np.ndarray,
+                 ids: np.ndarray,
+                 list_offsets: np.ndarray,
+                 n_probe: int = 8):
+        """
+
+        Args:
+        --------
+        centroids:
+            Array with normalized centroids of all lists (n_lists x vector_size).
+        vectors:
+            Normalized embeddings, sorted by list.
+        ids:
+            Ids (e.g. library ids) of all embeddings in vectors.
+        list_offsets:
+            Embeddings of list i are vectors[list_offsets[i]:list_offsets[i+1]].
+        n_probe:
+            Default number of lists to search per query. Default = 8.
+        """
+        assert vectors.shape[0] == ids.shape[0], "Expected one id per vector."
+        assert list_offsets.shape[0] == centroids.shape[0] + 1, "Expected one offset per list."
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.list_offsets = list_offsets
+        self.n_probe = n_probe
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray,
+              ids: np.ndarray = None,
+              n_lists: int = None,
+              n_probe: int = 8,
+              n_iterations: int = 20,
+              block_size: int = 10000,
+              seed: int = 42):
+        """Cluster embeddings and build the inverted lists.
+
+        Args:
+        --------
+        embeddings:
+            Array with Spec2Vec embeddings (n_spectra x vector_size).
+        ids:
+            Ids to return for the embeddings, e.g. library ids. Default is
+            None, in which case the embedding positions are used.
+        n_lists:
+            Number of clusters/lists. Default is None, in which case the square
+            root of the number of embeddings is used.
+        n_probe:
+            Default number of lists to search per query. Default = 8.
+        n_iterations:
+            Number of k-means iterations. Default = 20.
+        block_size:
+            Number of embeddings to assign to clusters at once. Default = 10000.
+        seed:
+            Seed for the random initialization of the clusters. Default = 42.
+        """
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float64))
+        if ids is None:
+            ids = np.arange(vectors.shape[0])
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(vectors.shape[0])))
+        n_lists = min(n_lists, vectors.shape[0])
+
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)].copy()
+        for _ in range(n_iterations):
+            assignments = _assign_to_centroids(vectors, centroids, block_size)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            counts = np.bincount(assignments, minlength=n_lists)
+            centroids = sums / np.maximum(counts, 1).reshape(-1, 1)
+            for i in np.where(counts == 0)[0]:
+                # Re-seed empty cluster
+                centroids[i] = vectors[rng.integers(vectors.shape[0])]
+            centroids = _normalize(centroids)
+
+        assignments = _assign_to_centroids(vectors, centroids, block_size)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=n_lists))))
+        return cls(centroids, vectors[order], np.asarray(ids)[order], list_offsets, n_probe=n_probe)
+
+    def search(self, query_vectors: np.ndarray, top_n: int, n_probe: int = None):
+        """Search top_n most similar embeddings for all query vectors.
+
+        Args:
+        --------
+        query_vectors:
+            Array with Spec2Vec embeddings of the queries (n_queries x vector_size).
+        top_n:
+            Number of most similar embeddings to return.
+        n_probe:
+            Number of lists to search per query. Will search more lists if
+            those contain less than top_n embeddings. Default is None, in
+            which case the n_probe of the index is used.
+
+        Returns:
+        --------
+        ids, scores
+            Arrays of shape (n_queries, top_n) with ids and cosine similarity of
+            the top_n most similar embeddings (sorted from high to low).
+        """
+        if n_probe is None:
+            n_probe = self.n_probe
+        top_n = min(top_n, len(self))
+        query_vectors = _normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float64)))
+        list_sizes = np.diff(self.list_offsets)
+        lists_ranked = np.argsort(-(query_vectors @ self.centroids.T), axis=1, kind="stable")
+
+        ids = np.empty((query_vectors.shape[0], top_n), dtype=self.ids.dtype)
+        scores = np.empty((query_vectors.shape[0], top_n))
+        for i, query_vector in enumerate(query_vectors):
+            # Probe at least n_probe lists and enough lists to find top_n candidates
+            n_lists_probed = max(n_probe, np.searchsorted(np.cumsum(list_sizes[lists_ranked[i]]), top_n) + 1)
+            positions = np.concatenate([np.arange(self.list_offsets[x], self.list_offsets[x + 1])
+                                        for x in lists_ranked[i, :n_lists_probed]])
+            candidate_scores = np.asarray(self.vectors[positions]) @ query_vector
+            selected = np.argpartition(candidate_scores, -top_n)[-top_n:]
+            selected = selected[np.argsort(-candidate_scores[selected], kind="stable")]
+            ids[i, :] = self.ids[positions[selected]]
+            scores[i, :] = candidate_scores[selected]
+        return ids, scores
+
+    def save(self, path: str):
+        """Store index in folder *path* (will be created if needed)."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(path, "vectors.npy"), np.asarray(self.vectors))
+        np.save(os.path.join(path, "ids.npy"), self.ids)
+        np.save(os.path.join(path, "list_offsets.npy"), self.list_offsets)
+        with open(os.path.join(path, "settings.json"), "w") as f:
+            json.dump({"n_probe": self.n_probe}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = "r"):
+        """Load index from folder *path*. Embeddings are memory-mapped using mmap_mode."""
+        with open(os.path.join(path, "settings.json"), "r") as f:
+            settings = json.load(f)
+        return cls(np.load(os.path.join(path, "centroids.npy")),
+                   np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, "ids.npy")),
+                   np.load(os.path.join(path, "list_offsets.npy")),
+                   n_probe=settings["n_probe"])
+
+
+def recall_report(ann_index: IVFIndex, query_vectors: np.ndarray,
+                  top_n: int = 10,
+                  n_probes: List[int] = (1, 2, 4, 8, 16, 32)) -> pd.DataFrame:
+    """Compare approximate against exact top_n search for different n_probe.
+
+    Args:
+    --------
+    ann_index:
+        IVFIndex to evaluate.
+    query_vectors:
+        Array with Spec2Vec embeddings of (representative) queries.
+    top_n:
+        Number of most similar embeddings to search for. Default = 10.
+    n_probes:
+        List of n_probe values to evaluate.
+
+    Returns:
+    --------
+    DataFrame with the recall (fraction of exact top_n found) and the mean search
+    time per query (in ms) for every n_probe.
+    """
+    query_vectors = _normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float64)))
+    top_n = min(top_n, len(ann_index))
+    start_time = time.time()
+    exact_scores = np.asarray(ann_index.vectors) @ query_vectors.T
+    exact_selection = np.argpartition(exact_scores, -top_n, axis=0)[-top_n:, :]
+    time_exact = 1000 * (time.time() - start_time) / query_vectors.shape[0]
+
+    report = []
+    for n_probe in n_probes:
+        n_probe = min(n_probe, ann_index.n_lists)
+        start_time = time.time()
+        ids, _ = ann_index.search(query_vectors, top_n, n_probe=n_probe)
+        time_ann = 1000 * (time.time() - start_time) / query_vectors.shape[0]
+        found = [np.isin(ann_index.ids[exact_selection[:, i]], ids[i]).sum() for i in range(ids.shape[0])]
+        report.append((n_probe, np.sum(found) / (top_n * ids.shape[0]), time_ann, time_exact))
+    return pd.DataFrame(report, columns=["n_probe", "recall", "time_per_query_ms", "time_per_query_exact_ms"])
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Normalize vectors to unit length (empty vectors stay 0)."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros(vectors.shape), where=norms != 0)
+
+
+def _assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray, block_size: int) -> np.ndarray:
+    """Return id of most similar centroid for every vector."""
+    assignments = np.empty(vectors.shape[0], dtype="int")
+    for start in range(0, vectors.shape[0], block_size):
+        assignments[start:(start + block_size)] = np.argmax(vectors[start:(start + block_size)] @ centroids.T,
+                                                            axis=1)
+    return assignments
@@ -0,0 +1,127 @@
+"""Connected components (clusters) of networkx graphs as label arrays."""
+from typing import List
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+class ClusterLabels:
+    """Node -> cluster label array and cluster sizes of a (networkx) graph.
+
+    Labels are computed once with scipy's sparse connected components instead of
+    copying every component into a new graph. Added links (merging clusters) are
+    tracked with a union-find structure, see union(). After removing links only
+    the affected cluster is relabeled, see split(). The label of a cluster is the
+    position of one of its nodes in graph.nodes.
+
+    For example:
+
+    .. code-block:: python
+
+        clusters = ClusterLabels(graph_main)
+        for nodes in clusters.clusters():
+            if len(nodes) > 100:
+                graph = clusters.subgraph(nodes)  # networkx view, no copy
+        graph_main.add_edge(node_a, node_b)
+        clusters.union(node_a, node_b)
+        clusters.size_of(node_a)
+    """
+    def __init__(self, graph: nx.Graph):
+        """
+
+        Args:
+        --------
+        graph:
+            Undirected networkx graph, e.g. made using networking.create_network().
+        """
+        self.graph = graph
+        self.nodes = list(graph.nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        n_nodes = len(self.nodes)
+        edges = np.array([(self.node_index[u], self.node_index[v]) for u, v in graph.edges],
+                         dtype=np.int64).reshape(-1, 2)
+        adjacency = csr_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=(n_nodes, n_nodes))
+        _, labels = connected_components(adjacency, directed=False)
+        # Root of every cluster is its first node
+        _, roots = np.unique(labels, return_index=True)
+        self._parent = roots[labels]
+        self._size = np.zeros(n_nodes, dtype=np.int64)
+        self._size[roots] = np.bincount(labels)
+
+    @property
+    def labels(self) -> np.ndarray:
+        """Cluster label of every node (in order of graph.nodes)."""
+        # Pointer jumping: compresses all paths of the union-find structure
+        while True:
+            grandparent = self._parent[self._parent]
+            if np.all(grandparent == self._parent):
+                return self._parent.copy()
+            self._parent = grandparent
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """Sizes of all clusters (same order as clusters())."""
+        return self._size[self._cluster_roots()]
+
+    def find(self, node) -> int:
+        """Return cluster label of node."""
+        i = self.node_index[node]
+        while self._parent[i] != i:
+            self._parent[i] = self._parent[self._parent[i]]
+            i = self._parent[i]
+        return i
+
+    def size_of(self, node) -> int:
+        """Return size of the cluster of node."""
+        return int(self._size[self.find(node)])
+
+    def clusters(self) -> List[list]:
+        """Return nodes of all clusters, ordered by their first node (as nx.connected_components())."""
+        labels = self.labels
+        order = np.argsort(labels, kind="stable")
+        _, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+        clusters = [[self.nodes[i] for i in order[start:(start + count)]]
+                    for start, count in zip(starts, counts)]
+        clusters.sort(key=lambda nodes: self.node_index[nodes[0]])
+        return clusters
+
+    def cluster_nodes(self, node) -> list:
+        """Return all nodes of the cluster of node."""
+        return [self.nodes[i] for i in np.where(self.labels == self.find(node))[0]]
+
+    def subgraph(self, nodes: list) -> nx.Graph:
+        """Return (read-only) view of the graph restricted to nodes."""
+        return self.graph.subgraph(nodes)
+
+    def union(self, node_a, node_b) -> int:
+        """Merge clusters of node_a and node_b (after adding a link). Returns new label."""
+        root_a = self.find(node_a)
+        root_b = self.find(node_b)
+        if root_a == root_b:
+            return root_a
+        if self._size[root_a] < self._size[root_b]:
+            root_a, root_b = root_b, root_a
+        self._parent[root_b] = root_a
+        self._size[root_a] += self._size[root_b]
+        return root_a
+
+    def split(self, nodes: list) -> List[list]:
+        """Relabel a cluster after removing links within it. Returns nodes of the new clusters.
+
+        Args:
+        --------
+        nodes:
+            All nodes of the (former) cluster.
+        """
+        new_clusters = ClusterLabels(self.graph.subgraph(nodes))
+        positions = np.array([self.node_index[node] for node in new_clusters.nodes], dtype=np.int64)
+        new_labels = new_clusters.labels
+        self._parent[positions] = positions[new_labels]
+        self._size[positions[new_labels]] = new_clusters._size[new_labels]
+        return new_clusters.clusters()
+
+    def _cluster_roots(self) -> np.ndarray:
+        labels = self.labels
+        roots, first = np.unique(labels, return_index=True)
+        return roots[np.argsort(first)]
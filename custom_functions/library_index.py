@@ -0,0 +1,271 @@
+import json
+import os
+from typing import List
+import numpy as np
+from gensim.models.basemodel import BaseTopicModel
+from spec2vec import SpectrumDocument
+from spec2vec.vector_operations import calc_vector
+from tqdm import tqdm
+from custom_functions.packed_spectra import PackedSpectra
+
+
+class LibraryIndex:
+    """Library spectra with precomputed Spec2Vec embeddings.
+
+    Computing the Spec2Vec embeddings of a large library is the most expensive
+    part of a spec2vec presearch, while library and model rarely change between
+    runs. A LibraryIndex computes those embeddings once, can be stored to disk,
+    and can be passed to library_matching() instead of the library documents.
+
+    Stored on disk as a folder containing:
+        embeddings.npy      float array (n_spectra x vector_size), memory-mappable
+        library_ids.npy     ids of all annotated library spectra (with smiles)
+        metadata.json       smiles, precursor_mz and embedding settings
+
+    For example:
+
+    .. code-block:: python
+
+        library_index = LibraryIndex.build(documents_library, model,
+                                           intensity_weighting_power=0.5,
+                                           allowed_missing_percentage=5.0)
+        library_index.save("library_index_AllPositive")
+
+        # Later (or in another job)
+        library_index = LibraryIndex.load("library_index_AllPositive",
+                                          documents_library=documents_library)
+        found_matches = library_matching(documents_query, library_index, model, ...)
+    """
+    def __init__(self, embeddings: np.ndarray,
+                 metadata: dict,
+                 intensity_weighting_power: float,
+                 allowed_missing_percentage: float,
+                 documents: List[SpectrumDocument] = None):
+        """
+
+        Args:
+        --------
+        embeddings:
+            Array with one Spec2Vec embedding per library spectrum.
+        metadata:
+            Dictionary with lists "smiles" and "precursor_mz" (one entry per spectrum).
+        intensity_weighting_power:
+            Intensity weighting power that was used to compute the embeddings.
+        allowed_missing_percentage:
+            Allowed missing percentage that was used to compute the embeddings.
+        documents:
+            List containing all library spectrum documents. Only needed for steps
+            of library_matching() that require the actual peaks (modified cosine
+            presearch, cosine and modified cosine scores). Default = None.
+        """
+        assert embeddings.shape[0] == len(metadata["smiles"]), \
+            "Expected one metadata entry per embedding."
+        if documents is not None:
+            assert len(documents) == embeddings.shape[0], \
+                "Expected one library document per embedding."
+        self.embeddings = embeddings
+        self.metadata = metadata
+        self.intensity_weighting_power = intensity_weighting_power
+        self.allowed_missing_percentage = allowed_missing_percentage
+        self.documents = documents
+        self._packed_spectra = {}
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @classmethod
+    def build(cls, documents_library: List[SpectrumDocument],
+              model: BaseTopicModel,
+              intensity_weighting_power: float = 0.5,
+              allowed_missing_percentage: float = 0,
+              progress_bar: bool = True):
+        """Compute Spec2Vec embeddings for all library documents.
+
+        Args:
+        --------
+        documents_library:
+            List containing all library spectrum documents.
+        model:
+            Pretrained word2Vec model.
+        intensity_weighting_power:
+            Spectrum vectors are a weighted sum of the word vectors. The given
+            word intensities will be raised to the given power. Default = 0.5.
+        allowed_missing_percentage:
+            Set the maximum allowed percentage of the document that may be missing
+            from the input model. Default = 0.
+        progress_bar:
+            Set to True to monitor the embedding creation with a progress bar.
+        """
+        embeddings = np.empty((len(documents_library), model.wv.vector_size), dtype="float")
+        for i, document in enumerate(tqdm(documents_library,
+                                          desc="Calculating vectors of library spectrums",
+                                          disable=not progress_bar)):
+            embeddings[i, :] = calc_vector(model, document,
+                                           intensity_weighting_power,
+                                           allowed_missing_percentage)
+        metadata = {"smiles": [doc.get("smiles") for doc in documents_library],
+                    "precursor_mz": [doc.get("precursor_mz") for doc in documents_library]}
+        return cls(embeddings, metadata,
+                   intensity_weighting_power=intensity_weighting_power,
+                   allowed_missing_percentage=allowed_missing_percentage,
+                   documents=documents_library)
+
+    def library_ids(self, ignore_non_annotated: bool = True) -> np.ndarray:
+        """Return ids of all library spectra to consider for matching.
+
+        Args:
+        --------
+        ignore_non_annotated:
+            If True, only ids of annotated spectra (with smiles) are returned.
+        """
+        if ignore_non_annotated:
+            return np.asarray([i for i, x in enumerate(self.metadata["smiles"]) if x],
+                              dtype="int")
+        return np.arange(len(self))
+
+    def packed_spectra(self, ignore_non_annotated: bool = True) -> PackedSpectra:
+        """Return peaks of the library spectra with ids library_ids() as PackedSpectra.
+
+        Packed only once (requires documents), later calls return the cached result.
+
+        Args:
+        --------
+        ignore_non_annotated:
+            If True, only annotated spectra (with smiles) are included.
+        """
+        assert self.documents is not None, "Library documents are needed, use LibraryIndex with documents."
+        if ignore_non_annotated not in self._packed_spectra:
+            self._packed_spectra[ignore_non_annotated] = PackedSpectra.from_spectra(
+                [self.documents[i] for i in self.library_ids(ignore_non_annotated)])
+        return self._packed_spectra[ignore_non_annotated]
+
+    def save(self, path: str):
+        """Store library index in folder *path* (will be created if needed)."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "embeddings.npy"), np.asarray(self.embeddings))
+        np.save(os.path.join(path, "library_ids.npy"), self.library_ids(ignore_non_annotated=True))
+        metadata = {"intensity_weighting_power": self.intensity_weighting_power,
+                    "allowed_missing_percentage": self.allowed_missing_percentage,
+                    "smiles": self.metadata["smiles"],
+                    "precursor_mz": [_to_float(x) for x in self.metadata["precursor_mz"]]}
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+    @classmethod
+    def load(cls, path: str, documents_library: List[SpectrumDocument] = None,
+             mmap_mode: str = "r"):
+        """Load library index from folder *path*.
+
+        Args:
+        --------
+        path:
+            Folder as created by LibraryIndex.save().
+        documents_library:
+            List containing all library spectrum documents (same order as used
+            to build the index). Their annotated spectra (with smiles) must have
+            the stored library ids. Default = None.
+        mmap_mode:
+            Embeddings are memory-mapped using the given mode (see numpy.load).
+            Set to None to load all embeddings into memory. Default = "r".
+        """
+        embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(path, "metadata.json"), "r") as f:
+            metadata = json.load(f)
+        library_ids = np.load(os.path.join(path, "library_ids.npy"))
+        assert np.array_equal(library_ids, [i for i, x in enumerate(metadata["smiles"]) if x]), \
+            "Stored library ids do not match the stored metadata."
+        if documents_library is not None:
+            assert np.array_equal(library_ids, [i for i, doc in enumerate(documents_library) if doc.get("smiles")]), \
+                "Library documents do not match the stored library index."
+        return cls(embeddings,
+                   {"smiles": metadata["smiles"], "precursor_mz": metadata["precursor_mz"]},
+                   intensity_weighting_power=metadata["intensity_weighting_power"],
+                   allowed_missing_percentage=metadata["allowed_missing_percentage"],
+                   documents=documents_library)
+
+
+class PrecursorMzIndex:
+    """Sorted library precursor m/z values for fast mass-based candidate lookup.
+
+    Returns the same candidates as matchms PrecursorMzMatch(...).matrix(), but
+    uses a binary search on the sorted precursor m/z values instead of comparing
+    all library spectra against all queries (O(log n + k) per query).
+
+    For example:
+
+    .. code-block:: python
+
+        mass_index = PrecursorMzIndex([100.0, 250.1, 100.001],
+                                      tolerance=20, tolerance_type="ppm")
+        mass_index.candidates(100.0005)  # --> array([0, 2])
+    """
+    def __init__(self, precursor_mz: List[float],
+                 tolerance: float = 2.0,
+                 tolerance_type: str = "ppm"):
+        """
+
+        Args:
+        --------
+        precursor_mz:
+            List/array with precursor m/z of all library spectra.
+        tolerance:
+            Specify tolerance for a mass match.
+        tolerance_type:
+            Chose between "ppm" (relative) and "Dalton" (absolute) tolerance type.
+        """
+        assert tolerance_type in ["Dalton", "ppm"], "Expected type from ['Dalton', 'ppm']"
+        assert not any(x is None for x in precursor_mz), "Missing precursor m/z."
+        precursor_mz = np.asarray(precursor_mz, dtype=np.float64)
+        self.tolerance = tolerance
+        self.tolerance_type = tolerance_type
+        self.order = np.argsort(precursor_mz, kind="stable")
+        self.precursor_mz_sorted = precursor_mz[self.order]
+
+    def __len__(self):
+        return self.order.shape[0]
+
+    def _search_window(self, precursor_mz_query: float):
+        """Return (slightly widened) m/z window that contains all possible matches."""
+        if self.tolerance_type == "Dalton":
+            mz_low = precursor_mz_query - self.tolerance
+            mz_high = precursor_mz_query + self.tolerance
+        else:
+            # |mz_ref - mz_query| / mean(mz_ref, mz_query) * 1e6 <= tolerance
+            relative = self.tolerance * 1e-6 / 2
+            mz_low = precursor_mz_query * (1 - relative) / (1 + relative)
+            mz_high = precursor_mz_query * (1 + relative) / (1 - relative)
+        margin = 1e-9 * max(abs(mz_low), abs(mz_high), 1.0)
+        return mz_low - margin, mz_high + margin
+
+    def candidates(self, precursor_mz_query: float) -> np.ndarray:
+        """Return sorted ids (positions in precursor_mz) of all mass matches.
+
+        Args:
+        --------
+        precursor_mz_query:
+            Precursor m/z of the query spectrum.
+        """
+        assert precursor_mz_query is not None, "Missing precursor m/z."
+        mz_low, mz_high = self._search_window(precursor_mz_query)
+        start = np.searchsorted(self.precursor_mz_sorted, mz_low, side="left")
+        end = np.searchsorted(self.precursor_mz_sorted, mz_high, side="right")
+
+        # Exact check (same criterion as matchms PrecursorMzMatch)
+        candidates_mz = self.precursor_mz_sorted[start:end]
+        if self.tolerance_type == "Dalton":
+            is_match = np.abs(candidates_mz - precursor_mz_query) <= self.tolerance
+        else:
+            mean_mz = (candidates_mz + precursor_mz_query) / 2
+            is_match = np.abs(candidates_mz - precursor_mz_query) / mean_mz * 1e6 <= self.tolerance
+        return np.sort(self.order[start:end][is_match])
+
+    def candidates_list(self, precursor_mz_queries: List[float]) -> List[np.ndarray]:
+        """Return list with sorted candidate ids for every given query precursor m/z."""
+        return [self.candidates(x) for x in precursor_mz_queries]
+
+
+def _to_float(value):
+    """Convert precursor m/z to json compatible float (or None)."""
+    if value is None:
+        return None
+    return float(value)
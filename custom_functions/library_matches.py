@@ -0,0 +1,122 @@
+from typing import List
+import numpy as np
+import pandas as pd
+
+
+class LibraryMatches:
+    """Columnar (long-form) table with all candidates found by library_matching().
+
+    One row per (query, library spectrum) candidate pair, all columns are stored
+    as NumPy arrays. Per-query pandas.DataFrames (as returned by library_matching()
+    by default) are only created when accessed, e.g. via for_query() or by
+    indexing/iterating like a list.
+
+    For example:
+
+    .. code-block:: python
+
+        found_matches = library_matching(documents_query, documents_library, model,
+                                         output_format="columnar")
+        found_matches.save("found_matches.npz")
+        found_matches = LibraryMatches.load("found_matches.npz")
+
+        table = found_matches.to_dataframe()  # all candidates of all queries
+        matches_df = found_matches[5]  # same as library_matching(...)[5]
+    """
+    score_columns = ["cosine_score", "cosine_matches",
+                     "mod_cosine_score", "mod_cosine_matches",
+                     "mass_match", "s2v_score"]
+
+    def __init__(self, n_queries: int, query_id: np.ndarray, library_id: np.ndarray,
+                 scores: dict):
+        """
+
+        Args:
+        --------
+        n_queries:
+            Number of queries (including queries without candidates).
+        query_id:
+            Query id of every candidate (sorted).
+        library_id:
+            Library id of every candidate.
+        scores:
+            Dictionary with score arrays (one value per candidate). Keys must be
+            from LibraryMatches.score_columns, missing scores were not calculated.
+        """
+        assert query_id.shape == library_id.shape, "Expected one library id per query id."
+        assert np.all(np.diff(query_id) >= 0), "Expected candidates to be sorted by query id."
+        for column, values in scores.items():
+            assert column in self.score_columns, f"Unknown score column {column}."
+            assert values.shape == query_id.shape, f"Expected one {column} per candidate."
+        self.n_queries = n_queries
+        self.query_id = query_id
+        self.library_id = library_id
+        self.scores = scores
+        self.query_offsets = np.searchsorted(query_id, np.arange(n_queries + 1))
+
+    def __len__(self):
+        return self.n_queries
+
+    def __getitem__(self, query_id: int):
+        return self.for_query(query_id)
+
+    def __iter__(self):
+        for query_id in range(self.n_queries):
+            yield self.for_query(query_id)
+
+    @property
+    def n_candidates(self):
+        return self.query_id.shape[0]
+
+    def for_query(self, query_id: int):
+        """Return candidates of one query as pandas.DataFrame (as from library_matching()).
+
+        Returns an empty list if no candidates were found for the query.
+        """
+        if query_id < 0:
+            query_id += self.n_queries
+        if not 0 <= query_id < self.n_queries:
+            raise IndexError("Query id out of range.")
+        rows = slice(self.query_offsets[query_id], self.query_offsets[query_id + 1])
+        n_rows = rows.stop - rows.start
+        if n_rows == 0:
+            return []
+        data = {}
+        for column in self.score_columns:
+            if column in self.scores:
+                data[column] = self.scores[column][rows]
+            elif column not in ["mass_match", "s2v_score"]:
+                data[column] = n_rows * ["not calculated"]
+        return pd.DataFrame(data, index=self.library_id[rows]).fillna(0)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Return all candidates of all queries as one long-form pandas.DataFrame."""
+        data = {"query_id": self.query_id, "library_id": self.library_id}
+        for column in self.score_columns:
+            if column in self.scores:
+                data[column] = self.scores[column]
+        return pd.DataFrame(data)
+
+    def save(self, filename: str):
+        """Store all arrays in a (uncompressed) numpy .npz file."""
+        np.savez(filename, n_queries=np.array(self.n_queries), query_id=self.query_id,
+                 library_id=self.library_id, **self.scores)
+
+    @classmethod
+    def load(cls, filename: str):
+        """Load LibraryMatches from .npz file created by LibraryMatches.save()."""
+        with np.load(filename, allow_pickle=False) as data:
+            scores = {column: data[column] for column in cls.score_columns if column in data.files}
+            return cls(int(data["n_queries"]), data["query_id"], data["library_id"], scores)
+
+    @classmethod
+    def concatenate(cls, library_matches: List["LibraryMatches"]):
+        """Combine LibraryMatches of consecutive query chunks."""
+        query_starts = np.cumsum([0] + [x.n_queries for x in library_matches])
+        columns = [x for x in cls.score_columns if library_matches and x in library_matches[0].scores]
+        return cls(int(query_starts[-1]),
+                   np.concatenate([[]] + [x.query_id + query_starts[i] for i, x in enumerate(library_matches)]
+                                  ).astype("int"),
+                   np.concatenate([[]] + [x.library_id for x in library_matches]).astype("int"),
+                   {column: np.concatenate([x.scores[column] for x in library_matches])
+                    for column in columns})
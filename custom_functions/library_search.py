@@ -1,15 +1,23 @@
-from typing import List
+import inspect
+import time
+from typing import List, Union
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
 from gensim.models.basemodel import BaseTopicModel
-from matchms.similarity import CosineGreedy, ModifiedCosine, PrecursorMzMatch
+from matchms.similarity import CosineGreedy, ModifiedCosine
 from spec2vec import SpectrumDocument
-from spec2vec import Spec2Vec
+from spec2vec.vector_operations import calc_vector
+from custom_functions.ann_index import IVFIndex
+from custom_functions.library_index import LibraryIndex, PrecursorMzIndex
+from custom_functions.library_matches import LibraryMatches
+from custom_functions.packed_spectra import PackedSpectra
+from custom_functions.parallel_scoring import ScoringPool, score_pairs, top_n_scores
+from custom_functions.similarity_functions import CosineAndModifiedCosine
+from custom_functions.top_n_selection import top_n_cosine
 
 
 def library_matching(documents_query: List[SpectrumDocument],
-                     documents_library: List[SpectrumDocument],
+                     documents_library: Union[List[SpectrumDocument], LibraryIndex],
                      model: BaseTopicModel,
                      presearch_based_on: List[str] = ["precursor_mz", "spec2vec-top10"],
                      ignore_non_annotated: bool = True,
@@ -19,20 +27,31 @@ def library_matching(documents_query: List[SpectrumDocument],
                      cosine_tol: float = 0.005,
                      min_matches: int = 6,
                      mass_tolerance: float = 2.0,
-                     mass_tolerance_type: str = "ppm"):
+                     mass_tolerance_type: str = "ppm",
+                     n_jobs: int = 1,
+                     ann_index: IVFIndex = None,
+                     output_format: str = "dataframes",
+                     timings: dict = None,
+                     library_spectra: PackedSpectra = None,
+                     scoring_pool: ScoringPool = None,
+                     progress_bar: bool = True):
     """Selecting potential spectra matches with spectra library.
 
     Suitable candidates will be selected by 1) top_n Spec2Vec similarity, and 2)
     same precursor mass (within given mz_ppm tolerance(s)).
     For later matching routines, additional scores (cosine, modified cosine)
     are added as well.
+    To process large numbers of queries with bounded memory use iter_library_matching().
 
     Args:
     --------
     documents_query:
         List containing all spectrum documents that should be queried against the library.
     documents_library:
-        List containing all library spectrum documents.
+        List containing all library spectrum documents. Can also be a LibraryIndex
+        with precomputed Spec2Vec embeddings of the library (see library_index.py).
+        The library documents are then only needed (as LibraryIndex.documents) for
+        the modified cosine presearch and cosine scores.
     model:
         Pretrained word2Vec model.
     presearch_based_on:
@@ -47,142 +66,397 @@ def library_matching(documents_query: List[SpectrumDocument],
         Specify tolerance for a mass match.
     mass_toleramce_type
         Chose between "ppm" (relative) and "Dalton" (absolute) tolerance type.
+    n_jobs
+        Number of processes used for the modified cosine presearch and the cosine
+        scores (one process pool for all queries). Set to None to use all available
+        cores. Default = 1 (no process pool).
+    ann_index
+        Approximate nearest neighbour index (see ann_index.py) built on the Spec2Vec
+        embeddings of the library spectra (with library ids as ids). If given, the
+        spec2vec-topX presearch is done using this index instead of comparing the
+        queries to all library spectra. Default = None.
+    output_format
+        Set to "dataframes" to return a list with one pandas.DataFrame (or empty list)
+        per query. Set to "columnar" to return all candidates as one LibraryMatches
+        table (see library_matches.py), which is faster and can be stored to disk.
+        Default = "dataframes".
+    timings
+        Dictionary to which the time (in s) spent in the different steps is added
+        (keys: "setup", "library_embedding", "library_packing", "pool_startup",
+        "spec2vec_presearch", "mass_presearch", "modcos_presearch", "rescoring",
+        "assembly"). The first four are only spent once per call, the others for
+        every chunk of queries. Default = None.
+    library_spectra
+        Peaks of the considered library spectra as PackedSpectra (see
+        iter_library_matching()), to avoid packing them for every call. Default = None.
+    scoring_pool
+        ScoringPool of the packed library spectra (see iter_library_matching()),
+        to avoid starting worker processes for every call. Default = None.
+    progress_bar
+        Set to False to not show progress bars and messages (e.g. in a service).
+        Default = True.
     """
-
-    # Initializations
+    assert output_format in ["dataframes", "columnar"], "Unknown output_format."
     found_matches = []
-    m_mass_matches = None
-    m_spec2vec_similarities = None
-    m_modcos_similarities = None
-
-    def get_metadata(documents):
-        metadata = []
-        for doc in documents:
-            metadata.append(doc._obj.get("smiles"))
-        return metadata
-
-    library_spectra_metadata = get_metadata(documents_library)
-    if ignore_non_annotated:
+    for _, matches in iter_library_matching(documents_query, documents_library, model,
+                                            presearch_based_on=presearch_based_on,
+                                            ignore_non_annotated=ignore_non_annotated,
+                                            include_scores=include_scores,
+                                            intensity_weighting_power=intensity_weighting_power,
+                                            allowed_missing_percentage=allowed_missing_percentage,
+                                            cosine_tol=cosine_tol,
+                                            min_matches=min_matches,
+                                            mass_tolerance=mass_tolerance,
+                                            mass_tolerance_type=mass_tolerance_type,
+                                            n_jobs=n_jobs,
+                                            ann_index=ann_index,
+                                            chunk_size=max(1, len(documents_query)),
+                                            output_format=output_format,
+                                            timings=timings,
+                                            library_spectra=library_spectra,
+                                            scoring_pool=scoring_pool,
+                                            progress_bar=progress_bar):
+        found_matches.append(matches)
+    if output_format == "columnar":
+        return LibraryMatches.concatenate(found_matches)
+    return found_matches
+
+
+def iter_library_matching(documents_query: List[SpectrumDocument],
+                          documents_library: Union[List[SpectrumDocument], LibraryIndex],
+                          model: BaseTopicModel,
+                          presearch_based_on: List[str] = ["precursor_mz", "spec2vec-top10"],
+                          ignore_non_annotated: bool = True,
+                          include_scores=["spec2vec", "cosine", "modcosine"],
+                          intensity_weighting_power: float = 0.5,
+                          allowed_missing_percentage: float = 0,
+                          cosine_tol: float = 0.005,
+                          min_matches: int = 6,
+                          mass_tolerance: float = 2.0,
+                          mass_tolerance_type: str = "ppm",
+                          n_jobs: int = 1,
+                          ann_index: IVFIndex = None,
+                          chunk_size: int = 100,
+                          output_format: str = "dataframes",
+                          timings: dict = None,
+                          library_spectra: PackedSpectra = None,
+                          scoring_pool: ScoringPool = None,
+                          progress_bar: bool = True):
+    """Generator version of library_matching() that processes queries in chunks.
+
+    All presearch matrices are only computed for chunk_size queries at a time, so
+    that peak memory is bounded by len(library) x chunk_size instead of
+    len(library) x len(queries). Results are yielded as soon as a chunk is done.
+
+    For example:
+
+    .. code-block:: python
+
+        for query_id, matches in iter_library_matching(documents_query, documents_library,
+                                                       model, chunk_size=500):
+            ...  # matches is the candidate table for documents_query[query_id]
+
+    Args:
+    --------
+    documents_query, documents_library, model, ...:
+        Same as for library_matching().
+    chunk_size:
+        Number of queries to process at once. Default = 100.
+    output_format:
+        Set to "dataframes" to yield one pandas.DataFrame per query, or to
+        "columnar" to yield one LibraryMatches table per chunk. Default = "dataframes".
+    timings:
+        Dictionary to which the time (in s) spent in the different steps is added,
+        see library_matching(). Default = None.
+    library_spectra:
+        Peaks of the considered library spectra (in order of the library ids) as
+        PackedSpectra, to avoid packing them again for every call. For a LibraryIndex
+        LibraryIndex.packed_spectra() is used (packed once). Default = None.
+    scoring_pool:
+        ScoringPool started with the packed library spectra (e.g. kept by a long
+        running service). Used for all (modified) cosine scores instead of starting
+        a new process pool (n_jobs is then ignored). Default = None.
+    progress_bar:
+        Set to False to not show progress bars and messages. Default = True.
+
+    Yields:
+    --------
+    (query_id, matches)
+        Index of the query in documents_query and pandas.DataFrame with all
+        selected candidates (or empty list if no candidates were found).
+        For output_format="columnar": index of the first query of the chunk and
+        LibraryMatches with the candidates of all queries in the chunk.
+    """
+    assert chunk_size > 0, "Expected chunk_size to be a positive integer."
+    assert output_format in ["dataframes", "columnar"], "Unknown output_format."
+    start_time = time.perf_counter()
+
+    library_index = None
+    if isinstance(documents_library, LibraryIndex):
+        library_index = documents_library
+        documents_library = library_index.documents
+        msg = "LibraryIndex was built using different Spec2Vec settings."
+        assert library_index.intensity_weighting_power == intensity_weighting_power, msg
+        assert library_index.allowed_missing_percentage == allowed_missing_percentage, msg
+        library_ids = library_index.library_ids(ignore_non_annotated)
+    elif ignore_non_annotated:
         # Get array of all ids for spectra with smiles
-        library_ids = np.asarray([i for i, x in enumerate(library_spectra_metadata) if x])
+        library_ids = np.asarray([i for i, doc in enumerate(documents_library) if doc._obj.get("smiles")],
+                                 dtype="int")
     else:
         library_ids = np.arange(len(documents_library))
 
+    def require_library_documents():
+        assert documents_library is not None, \
+            "Library documents are needed, use LibraryIndex with documents."
+
     allowed_presearch_type = ["precursor_mz", "spec2vec-top", "modcos-top"]
     msg = "Presearch must include one of: " + ", ".join(allowed_presearch_type)
     assert np.any([(x in y) for x in allowed_presearch_type for y in presearch_based_on]), msg
 
-    # 1. Search for top-n Spec2Vec matches ------------------------------------
-    if np.any(["spec2vec" in x for x in presearch_based_on]):
-        top_n = int([x.split("top")[1] for x in presearch_based_on if "spec2vec" in x][0])
-        print(f"Pre-selection includes spec2vec top {top_n}.")
-        spec2vec = Spec2Vec(model=model, intensity_weighting_power=intensity_weighting_power,
-                            allowed_missing_percentage=allowed_missing_percentage,
-                            progress_bar=True)
-        m_spec2vec_similarities = spec2vec.matrix([documents_library[i] for i in library_ids],
-                                                  documents_query)
-
-        # Select top_n similarity values:
-        selection_spec2vec = np.argpartition(m_spec2vec_similarities, -top_n, axis=0)[-top_n:, :]
-    else:
-        selection_spec2vec = np.empty((0, len(documents_query)), dtype="int")
+    # Prepare presearches (only done once for all chunks) ---------------------
+    spec2vec_top_n = _get_presearch_top_n(presearch_based_on, "spec2vec")
+    library_vectors = None
+    library_rows = None
+    start_time = _add_time(timings, "setup", start_time)
+    if spec2vec_top_n is not None:
+        _log(progress_bar, f"Pre-selection includes spec2vec top {spec2vec_top_n}.")
+        if ann_index is not None:
+            _log(progress_bar,
+                 f"Spec2Vec top {spec2vec_top_n} is searched approximately (n_probe={ann_index.n_probe}).")
+        elif library_index is not None:
+            library_vectors = library_index.embeddings
+            library_rows = library_ids
+        else:
+            library_vectors = _calculate_vectors([documents_library[i] for i in library_ids],
+                                                 model, intensity_weighting_power,
+                                                 allowed_missing_percentage,
+                                                 desc="Calculating vectors of reference spectrums",
+                                                 progress_bar=progress_bar)
+    start_time = _add_time(timings, "library_embedding", start_time)
 
-    # 2. Search for precursor_mz based matches ---------------------------------
+    mass_index = None
     if "precursor_mz" in presearch_based_on:
-        print(f"Pre-selection includes mass matches within {mass_tolerance} {mass_tolerance_type}.")
-        mass_matching = PrecursorMzMatch(tolerance=mass_tolerance,
-                                         tolerance_type=mass_tolerance_type)
-        m_mass_matches = mass_matching.matrix([documents_library[i]._obj for i in library_ids],
-                                              [x._obj for x in documents_query])
-        selection_massmatch = []
-        for i in range(len(documents_query)):
-            selection_massmatch.append(np.where(m_mass_matches[:, i] == 1)[0])
-    else:
-        selection_massmatch = np.empty((len(documents_query), 0), dtype="int")
+        _log(progress_bar, f"Pre-selection includes mass matches within {mass_tolerance} {mass_tolerance_type}.")
+        if library_index is not None:
+            library_precursor_mz = [library_index.metadata["precursor_mz"][i] for i in library_ids]
+        else:
+            library_precursor_mz = [documents_library[i]._obj.get("precursor_mz") for i in library_ids]
+        mass_index = PrecursorMzIndex(library_precursor_mz,
+                                      tolerance=mass_tolerance,
+                                      tolerance_type=mass_tolerance_type)
 
-    # 3. Search for top-n modified cosine matches ------------------------------------
-    if np.any(["modcos" in x for x in presearch_based_on]):
-        top_n = int([x.split("top")[1] for x in presearch_based_on if "modcos" in x][0])
-        print(f"Pre-selection includes modified cosine top {top_n}.")
+    modcos_top_n = _get_presearch_top_n(presearch_based_on, "modcos")
+    if modcos_top_n is not None:
+        _log(progress_bar, f"Pre-selection includes modified cosine top {modcos_top_n}.")
         modcos = ModifiedCosine(tolerance=cosine_tol)
 
-        n_rows = len(library_ids)
-        n_cols = len(documents_query)
-        m_modcos_similarities = np.zeros([n_rows, n_cols], dtype=np.float64)
-        m_modcos_matches = np.zeros([n_rows, n_cols], dtype=np.float64)
-        for i_ref, reference in enumerate(tqdm([documents_library[i]._obj for i in library_ids])):
-            for i_query, query in enumerate([x._obj for x in documents_query]):
-                score = modcos.pair(reference, query)
-                m_modcos_similarities[i_ref][i_query] = score[0]
-                m_modcos_matches[i_ref][i_query] = score[1]
-
-        # Select top_n similarity values:
-        m_modcos_selected = m_modcos_similarities.copy()
-        m_modcos_selected[m_modcos_matches < min_matches] = 0
-        selection_modcos = np.argpartition(m_modcos_selected, -top_n, axis=0)[-top_n:, :]
-    else:
-        selection_modcos = np.empty((0, len(documents_query)), dtype="int")
-
-    # 4. Combine found matches ------------------------------------------------
     if "cosine" in include_scores:
-        print("Calculate cosine score for selected candidates.")
+        _log(progress_bar, "Calculate cosine score for selected candidates.")
     if "modcosine" in include_scores:
-        print("Calculate modified cosine score for selected candidates.")
-
-    for i in tqdm(range(len(documents_query))):
-        s2v_top_ids = selection_spec2vec[:, i]
-        mass_match_ids = selection_massmatch[i]
-        modcos_ids = selection_modcos[:, i]
-
-        all_match_ids = np.unique(np.concatenate((s2v_top_ids, mass_match_ids, modcos_ids)))
-
-        if len(all_match_ids) > 0:
-            if "cosine" in include_scores:
-                # Get cosine score for found matches
-                cosine_similarity = CosineGreedy(tolerance=cosine_tol)
-                cosine_scores = []
-                for match_id in library_ids[all_match_ids]:
-                    cosine_scores.append(cosine_similarity.pair(documents_library[match_id]._obj,
-                                                                documents_query[i]._obj))
+        _log(progress_bar, "Calculate modified cosine score for selected candidates.")
+
+    calculate_cosine = "cosine" in include_scores
+    calculate_modcos = modcos_top_n is not None or "modcosine" in include_scores
+    close_scoring_pool = False
+    if scoring_pool is not None and library_spectra is None:
+        library_spectra = scoring_pool.references
+    start_time = _add_time(timings, "setup", start_time)
+    if (calculate_cosine or calculate_modcos) and library_spectra is None:
+        # Peaks are only needed for (modified) cosine scores
+        require_library_documents()
+        if library_index is not None:
+            library_spectra = library_index.packed_spectra(ignore_non_annotated)
+        else:
+            library_spectra = PackedSpectra.from_spectra([documents_library[i]._obj for i in library_ids])
+    start_time = _add_time(timings, "library_packing", start_time)
+    if calculate_cosine or calculate_modcos:
+        assert len(library_spectra) == len(library_ids), "Expected one packed spectrum per library id."
+        if scoring_pool is None and n_jobs != 1:
+            # One process pool for all chunks, the library spectra are only sent once to every worker
+            scoring_pool = ScoringPool(library_spectra, n_jobs=n_jobs)
+            close_scoring_pool = True
+            scoring_pool.start()
+    _add_time(timings, "pool_startup", start_time)
+
+    try:
+        progress = tqdm(total=len(documents_query), disable=not progress_bar)
+        for chunk_start in range(0, len(documents_query), chunk_size):
+            start_time = time.perf_counter()
+            documents_chunk = documents_query[chunk_start:(chunk_start + chunk_size)]
+            query_spectra = PackedSpectra.from_spectra(documents_chunk)
+            if "spec2vec" in include_scores or spec2vec_top_n is not None:
+                query_vectors = _calculate_vectors(documents_chunk, model, intensity_weighting_power,
+                                                   allowed_missing_percentage)
+
+            # 1. Search for top-n Spec2Vec matches --------------------------------
+            if spec2vec_top_n is not None and ann_index is not None:
+                ann_ids, _ = ann_index.search(query_vectors, spec2vec_top_n)
+                # Convert library ids into positions in library_ids
+                selection_spec2vec = np.minimum(np.searchsorted(library_ids, ann_ids.T), len(library_ids) - 1)
+                assert np.all(library_ids[selection_spec2vec] == ann_ids.T), \
+                    "Expected ann_index ids to be ids of the considered library spectra."
+            elif spec2vec_top_n is not None:
+                # Select top_n similarity values (blockwise, without full similarity matrix):
+                selection_spec2vec, _ = top_n_cosine(library_vectors, query_vectors, spec2vec_top_n,
+                                                     rows=library_rows)
             else:
-                cosine_scores = len(all_match_ids) * ["not calculated"]
-
-            if m_modcos_similarities is not None:
-                mod_cosine_scores0 = [x for x in m_modcos_similarities[all_match_ids, i]]
-                mod_cosine_scores1 = [x for x in m_modcos_matches[all_match_ids, i]]
-                mod_cosine_scores = list(zip(mod_cosine_scores0, mod_cosine_scores1))
-            elif "modcosine" in include_scores:
-                # Get modified cosine score for found matches
-                mod_cosine_similarity = ModifiedCosine(tolerance=cosine_tol)
-                mod_cosine_scores = []
-                for match_id in library_ids[all_match_ids]:
-                    mod_cosine_scores.append(mod_cosine_similarity.pair(documents_library[match_id]._obj,
-                                                                        documents_query[i]._obj))
+                selection_spec2vec = np.empty((0, len(documents_chunk)), dtype="int")
+            start_time = _add_time(timings, "spec2vec_presearch", start_time)
+
+            # 2. Search for precursor_mz based matches -----------------------------
+            if mass_index is not None:
+                selection_massmatch = mass_index.candidates_list([x._obj.get("precursor_mz")
+                                                                  for x in documents_chunk])
             else:
-                mod_cosine_scores = len(all_match_ids) * ["not calculated"]
-
-            matches_df = pd.DataFrame({"cosine_score": [x["score"] for x in cosine_scores],
-                                       "cosine_matches": [x["matches"] for x in cosine_scores],
-                                       "mod_cosine_score": [x["score"] for x in mod_cosine_scores],
-                                       "mod_cosine_matches": [x["matches"] for x in mod_cosine_scores]},
-                                       index=library_ids[all_match_ids])
-
-            if m_mass_matches is not None:
-                matches_df["mass_match"] = m_mass_matches[all_match_ids, i]
-
-            if m_spec2vec_similarities is not None:
-                matches_df["s2v_score"] = m_spec2vec_similarities[all_match_ids, i]
-            elif "spec2vec" in include_scores:
-                spec2vec_similarity = Spec2Vec(model=model,
-                                               intensity_weighting_power=intensity_weighting_power,
-                                               allowed_missing_percentage=allowed_missing_percentage)
-                spec2vec_scores = []
-                for match_id in library_ids[all_match_ids]:
-                    spec2vec_scores.append(spec2vec_similarity.pair(documents_library[match_id],
-                                                                    documents_query[i]))
-                matches_df["s2v_score"] = spec2vec_scores
-            found_matches.append(matches_df.fillna(0))
-        else:
-            found_matches.append([])
+                selection_massmatch = None
+            start_time = _add_time(timings, "mass_presearch", start_time)
 
-    return found_matches
+            # 3. Search for top-n modified cosine matches --------------------------
+            if modcos_top_n is not None:
+                selection_modcos, modcos_scores, modcos_matches = top_n_scores(library_spectra,
+                                                                               query_spectra,
+                                                                               modcos, modcos_top_n,
+                                                                               min_matches=min_matches,
+                                                                               n_jobs=n_jobs, pool=scoring_pool)
+            else:
+                selection_modcos = np.empty((0, len(documents_chunk)), dtype="int")
+            start_time = _add_time(timings, "modcos_presearch", start_time)
+
+            # 4. Combine found matches --------------------------------------------
+            candidates = []
+            for i in range(len(documents_chunk)):
+                if selection_massmatch is not None:
+                    mass_match_ids = selection_massmatch[i]
+                else:
+                    mass_match_ids = np.empty((0), dtype="int")
+                candidates.append(np.unique(np.concatenate((selection_spec2vec[:, i], mass_match_ids,
+                                                            selection_modcos[:, i]))))
+
+            # All (library, query) pairs of the chunk, rescored in bulk
+            pairs = np.array([(match_id, i) for i, match_ids in enumerate(candidates) for match_id in match_ids],
+                             dtype="int").reshape(-1, 2)
+
+            scores = {}
+            if calculate_cosine and calculate_modcos:
+                # Compute both scores in one pass (sharing the zero shift peak pairs)
+                both_scores, both_matches = score_pairs(library_spectra, query_spectra, pairs,
+                                                        CosineAndModifiedCosine(tolerance=cosine_tol),
+                                                        n_jobs=n_jobs, pool=scoring_pool)
+                scores["cosine_score"], scores["mod_cosine_score"] = both_scores[:, 0], both_scores[:, 1]
+                scores["cosine_matches"], scores["mod_cosine_matches"] = both_matches[:, 0], both_matches[:, 1]
+            elif calculate_cosine:
+                scores["cosine_score"], scores["cosine_matches"] = score_pairs(library_spectra, query_spectra, pairs,
+                                                                               CosineGreedy(tolerance=cosine_tol),
+                                                                               n_jobs=n_jobs, pool=scoring_pool)
+            elif calculate_modcos:
+                mod_cosine_scores = np.zeros(pairs.shape[0])
+                mod_cosine_matches = np.zeros(pairs.shape[0], dtype="int")
+                # Use modified cosine scores from presearch where possible
+                is_known = np.zeros(pairs.shape[0], dtype=bool)
+                if modcos_top_n is not None:
+                    presearch_keys = (selection_modcos * len(documents_chunk) + np.arange(len(documents_chunk))).ravel()
+                    pairs_keys = pairs[:, 0] * len(documents_chunk) + pairs[:, 1]
+                    sorter = np.argsort(presearch_keys)
+                    positions = np.searchsorted(presearch_keys, pairs_keys, sorter=sorter)
+                    positions = sorter[np.minimum(positions, len(presearch_keys) - 1)]
+                    is_known = presearch_keys[positions] == pairs_keys
+                    mod_cosine_scores[is_known] = modcos_scores.ravel()[positions[is_known]]
+                    mod_cosine_matches[is_known] = modcos_matches.ravel()[positions[is_known]]
+                new_scores, new_matches = score_pairs(library_spectra, query_spectra, pairs[~is_known],
+                                                      ModifiedCosine(tolerance=cosine_tol), n_jobs=n_jobs,
+                                                      pool=scoring_pool)
+                mod_cosine_scores[~is_known] = new_scores
+                mod_cosine_matches[~is_known] = new_matches
+                scores["mod_cosine_score"], scores["mod_cosine_matches"] = mod_cosine_scores, mod_cosine_matches
+
+            if selection_massmatch is not None:
+                scores["mass_match"] = np.concatenate([np.zeros(0, dtype=bool)]
+                                                      + [np.isin(match_ids, selection_massmatch[i])
+                                                         for i, match_ids in enumerate(candidates)])
+
+            if "spec2vec" in include_scores or spec2vec_top_n is not None:
+                unique_ids, inverse = np.unique(pairs[:, 0], return_inverse=True)
+                if library_index is not None:
+                    candidate_vectors = library_index.embeddings[library_ids[unique_ids]]
+                elif library_vectors is not None:
+                    candidate_vectors = library_vectors[unique_ids]
+                else:
+                    # Only embed library spectra that are candidates
+                    candidate_vectors = _calculate_vectors([documents_library[i] for i in library_ids[unique_ids]],
+                                                           model, intensity_weighting_power,
+                                                           allowed_missing_percentage)
+                scores["s2v_score"] = _pairwise_cosine(candidate_vectors[inverse.ravel()], query_vectors[pairs[:, 1]])
+            start_time = _add_time(timings, "rescoring", start_time)
+
+            chunk_matches = LibraryMatches(len(documents_chunk), pairs[:, 1], library_ids[pairs[:, 0]], scores)
+            if output_format == "dataframes":
+                chunk_matches = list(chunk_matches)
+            _add_time(timings, "assembly", start_time)
+            progress.update(len(documents_chunk))
+            if output_format == "columnar":
+                yield chunk_start, chunk_matches
+            else:
+                for i, matches in enumerate(chunk_matches):
+                    yield chunk_start + i, matches
+        progress.close()
+    finally:
+        if close_scoring_pool:
+            scoring_pool.close()
+
+
+def requires_peak_scores(settings: dict) -> bool:
+    """Return True if library_matching(..., **settings) computes (modified) cosine scores."""
+    presearch_based_on = _get_setting(settings, "presearch_based_on")
+    include_scores = _get_setting(settings, "include_scores")
+    return _get_presearch_top_n(presearch_based_on, "modcos") is not None \
+        or "cosine" in include_scores or "modcosine" in include_scores
+
+
+def _get_presearch_top_n(presearch_based_on: List[str], presearch_type: str):
+    """Return top_n for presearch of given type ('spec2vec' or 'modcos'), or None."""
+    top_n = [x.split("top")[1] for x in presearch_based_on if presearch_type in x]
+    if len(top_n) == 0:
+        return None
+    return int(top_n[0])
+
+
+def _get_setting(settings: dict, name: str):
+    """Return settings[name] or the default of library_matching()."""
+    if name in settings:
+        return settings[name]
+    return inspect.signature(library_matching).parameters[name].default
+
+
+def _log(progress_bar: bool, message: str):
+    """Print message (if progress bars and messages are shown)."""
+    if progress_bar:
+        print(message)
+
+
+def _add_time(timings: dict, step: str, start_time: float) -> float:
+    """Add time since start_time to timings[step] (if timings is given) and return current time."""
+    current_time = time.perf_counter()
+    if timings is not None:
+        timings[step] = timings.get(step, 0.0) + current_time - start_time
+    return current_time
+
+
+def _calculate_vectors(documents: List[SpectrumDocument], model: BaseTopicModel,
+                       intensity_weighting_power: float,
+                       allowed_missing_percentage: float,
+                       desc: str = None,
+                       progress_bar: bool = True) -> np.ndarray:
+    """Calculate Spec2Vec embeddings (same as Spec2Vec.matrix() does internally)."""
+    vectors = np.empty((len(documents), model.wv.vector_size), dtype="float")
+    for i, document in enumerate(tqdm(documents, desc=desc, disable=desc is None or not progress_bar)):
+        vectors[i, :] = calc_vector(model, document, intensity_weighting_power,
+                                    allowed_missing_percentage)
+    return vectors
+
+
+def _pairwise_cosine(vectors_1: np.ndarray, vectors_2: np.ndarray) -> np.ndarray:
+    """Cosine similarity between vectors_1[i] and vectors_2[i] (0 for empty vectors)."""
+    norms = np.linalg.norm(vectors_1, axis=1) * np.linalg.norm(vectors_2, axis=1)
+    products = np.sum(vectors_1 * vectors_2, axis=1)
+    return np.divide(products, norms, out=np.zeros(products.shape[0]), where=norms != 0)
@@ -1,10 +1,13 @@
 # Import libraries
+from collections import namedtuple
 import numpy as np
 import networkx as nx
 from community import community_louvain
 from networkx.algorithms.connectivity import minimum_st_edge_cut  # , minimum_st_node_cut
-from networkx.algorithms.flow import shortest_augmenting_path
+from networkx.algorithms.flow import edmonds_karp, shortest_augmenting_path
 import pandas as pd
+from scipy.sparse import csr_matrix
+from custom_functions.graph_components import ClusterLabels
 from matplotlib import pyplot as plt
 import matplotlib
 
@@ -12,12 +15,16 @@ import matplotlib
 # ---------------- Graph / networking related functions ----------------------
 # ----------------------------------------------------------------------------
 
+# Cuts of n_links links found by weak_link_finder(), see there for the fields
+WeakLinks = namedtuple("WeakLinks", ["n_links", "cuts", "counts", "part_sizes"])
+
 
 def create_network(similars_idx,
                    similars,
                    max_links=10,
                    cutoff=0.7,
-                   link_method='single'):
+                   link_method='single',
+                   output_format='networkx'):
     """
     Function to create network from given top-n similarity values.
 
@@ -37,30 +44,84 @@ def create_network(similars_idx,
         Chose between 'single' and 'mutual'. 'single will add all links based
         on individual nodes. 'mutual' will only add links if that link appears
         in the given top-n list for both nodes.
+    output_format: str
+        Chose between 'networkx' (networkx graph), 'scipy' (symmetric scipy
+        sparse adjacency matrix with similarities as weights) and 'edges'
+        (arrays of sources, targets and weights, see network_edges()).
+        Default = 'networkx'.
     """
-
+    assert output_format in ["networkx", "scipy", "edges"], "Output format not known."
     dimension = similars_idx.shape[0]
+    sources, targets, weights = network_edges(similars_idx, similars, max_links=max_links,
+                                              cutoff=cutoff, link_method=link_method)
+    if output_format == "edges":
+        return sources, targets, weights
+    if output_format == "scipy":
+        return csr_matrix((np.concatenate((weights, weights)),
+                           (np.concatenate((sources, targets)), np.concatenate((targets, sources)))),
+                          shape=(dimension, dimension))
 
     # Initialize network graph, add nodes
     msnet = nx.Graph()
     msnet.add_nodes_from(np.arange(0, dimension))
+    msnet.add_weighted_edges_from(zip(sources.tolist(), targets.tolist(), weights.tolist()))
+    return msnet
 
-    # Add edges based on global threshold for weights
-    for i in range(0, dimension):
-        idx = np.where(similars[i, :] > cutoff)[0][:max_links]
-        if link_method == "single":
-            new_edges = [(i, int(similars_idx[i, x]), float(similars[i, x]))
-                         for x in idx if similars_idx[i, x] != i]
-        elif link_method == "mutual":
-            new_edges = [(i, int(similars_idx[i, x]), float(similars[i, x]))
-                         for x in idx
-                         if similars_idx[i, x] != i and i in similars_idx[x, :]
-                         ]
-        else:
-            print("Link method not kown")
-        msnet.add_weighted_edges_from(new_edges)
 
-    return msnet
+def network_edges(similars_idx,
+                  similars,
+                  max_links=10,
+                  cutoff=0.7,
+                  link_method='single'):
+    """
+    Function to select the (undirected) network edges from given top-n similarity values.
+
+    All rows are handled at once with numpy. For every node the first max_links
+    entries with similarity > cutoff are used (self-links are removed). Every
+    edge is returned once, in the order in which it first appears in the top-n
+    lists, and with the similarity of its last appearance (same as when adding
+    the links node by node to a networkx graph).
+
+    Args:
+    --------
+    similars_idx: numpy array
+        Array with indices of top-n most similar nodes.
+    similars: numpy array
+        Array with similarity values of top-n most similar nodes.
+    max_links: int
+        Maximum number of links to add per node. Default = 10.
+    cutoff: float
+        Threshold for given similarities. Default = 0.7.
+    link_method: str
+        Chose between 'single' and 'mutual' (see create_network()).
+
+    Returns:
+    --------
+    sources, targets, weights
+        Arrays with both nodes and the similarity of every edge.
+    """
+    assert link_method in ["single", "mutual"], "Link method not known."
+    dimension = similars_idx.shape[0]
+    rows = np.repeat(np.arange(dimension).reshape(-1, 1), similars_idx.shape[1], axis=1)
+    selected = similars > cutoff
+    selected &= np.cumsum(selected, axis=1) <= max_links
+    selected &= similars_idx != rows
+    sources = rows[selected].astype(np.int64)
+    targets = similars_idx[selected].astype(np.int64)
+    weights = similars[selected].astype(np.float64)
+    if link_method == "mutual":
+        # Keep link i -> j only if i is in the top-n list of j
+        top_n_links = rows.astype(np.int64).ravel() * dimension + similars_idx.astype(np.int64).ravel()
+        is_mutual = np.isin(targets * dimension + sources, top_n_links)
+        sources, targets, weights = sources[is_mutual], targets[is_mutual], weights[is_mutual]
+
+    # Remove duplicate (undirected) edges: first appearance, last weight
+    edge_keys = np.minimum(sources, targets) * dimension + np.maximum(sources, targets)
+    _, first, inverse = np.unique(edge_keys, return_index=True, return_inverse=True)
+    last = np.zeros(first.shape[0], dtype=np.int64)
+    np.maximum.at(last, inverse.ravel(), np.arange(edge_keys.shape[0]))
+    order = np.argsort(first)
+    return sources[first[order]], targets[first[order]], weights[last[order]]
 
 
 def sample_cuts(graph, max_steps=1000, max_cuts=1):
@@ -113,13 +174,16 @@ def sample_cuts(graph, max_steps=1000, max_cuts=1):
     return sampled_cuts
 
 
-def weak_link_finder(graph, max_steps=1000, max_cuts=1):
+def weak_link_finder(graph, max_steps=1000, max_cuts=1, method="sampled"):
     """ Function to detect critical links in the given graph.
     Critical links here are links which -once removed- would disconnect considerable
     parts of the network. Those links are searched for by counting minimum cuts between
     a large number of node pairs (up to max_steps pairs will be explored).
     If more pairs exist than max_steps allows to explore, pick max_steps random pairs.
 
+    With method="exact" all cuts of up to max_cuts links are found without sampling
+    (see exact_weak_links()).
+
     Args:
     -------
     graph: networkx graph
@@ -128,7 +192,24 @@ def weak_link_finder(graph, max_steps=1000, max_cuts=1):
         Up to max_steps pairs will be explored to search for cuts. Default = 1000.
     max_cuts
         Maximum numbers of links allowed to be cut. Default = 1.
+    method
+        Chose between 'sampled' (sampled minimum cuts) and 'exact'. Default = 'sampled'.
+
+    Returns
+    -------
+    proposed_cuts
+        List of WeakLinks(n_links, cuts, counts, part_sizes), one for every number
+        of links (same fields for both methods):
+        n_links: number of links of the cuts.
+        cuts: array with one cut (node pairs of all links) per row.
+        counts: number of node pairs separated by every cut. For method='sampled'
+        only the sampled pairs are counted, for method='exact' all pairs.
+        part_sizes: array with the sizes of both separated parts for every cut
+        for method='exact', None for method='sampled'.
     """
+    assert method in ["sampled", "exact"], "Method not known."
+    if method == "exact":
+        return exact_weak_links(graph, max_cuts=max_cuts)
 
     sampled_cuts = sample_cuts(graph, max_steps=max_steps, max_cuts=max_cuts)
 
@@ -152,11 +233,116 @@ def weak_link_finder(graph, max_steps=1000, max_cuts=1):
             sampled_cuts_select.reshape(-1, min_cuts * 2))
 
         # Return most promising cuts
-        proposed_cuts.append((min_cuts, cuts_unique, cuts_count))
+        proposed_cuts.append(WeakLinks(min_cuts, cuts_unique, cuts_count, None))
+
+    return proposed_cuts
+
+
+def exact_weak_links(graph, max_cuts=1):
+    """ Function to find cuts of up to max_cuts links that split the given graph.
+    For max_cuts=1 these are all bridges of the graph (linear time). For larger
+    max_cuts a minimum cut for every pair of nodes is taken from a Gomory-Hu tree
+    (number of nodes - 1 max-flow computations), so every pair of nodes that can
+    be separated by cutting up to max_cuts links is separated by one of the cuts.
+
+    Args:
+    -------
+    graph: networkx graph
+        Graph of individual (connected) cluster (created using networkx).
+    max_cuts
+        Maximum numbers of links allowed to be cut. Default = 1.
 
+    Returns
+    -------
+    proposed_cuts
+        List of WeakLinks(n_links, cuts, counts, part_sizes) for every number of
+        links (in increasing order). Cuts is an array with one cut per row (node
+        pairs of all links, sorted), counts the number of node pairs separated by
+        every cut, and part sizes an array with the sizes of both separated parts
+        for every cut. Cuts are sorted from most balanced (largest smaller part)
+        to least balanced.
+    """
+    if graph.number_of_nodes() < 2:
+        return []
+    assert nx.is_connected(graph), "Expected a connected graph (one cluster)."
+    if max_cuts == 1:
+        cuts, part_sizes = _bridge_cuts(graph)
+    else:
+        cuts, part_sizes = _gomory_hu_cuts(graph, max_cuts)
+
+    proposed_cuts = []
+    for n_links in sorted(set(len(x) for x in cuts)):
+        selected = [i for i, cut in enumerate(cuts) if len(cut) == n_links]
+        cuts_select = np.array([np.array(sorted(tuple(sorted(edge)) for edge in cuts[i])).ravel()
+                                for i in selected])
+        sizes_select = np.array([part_sizes[i] for i in selected])
+        order = np.argsort(-sizes_select.min(axis=1), kind="stable")
+        proposed_cuts.append(WeakLinks(n_links, cuts_select[order], sizes_select.prod(axis=1)[order],
+                                       sizes_select[order]))
     return proposed_cuts
 
 
+def _bridge_cuts(graph):
+    """ Return all bridges (as cuts of one link) and the sizes of the parts they separate."""
+    bridges = list(nx.bridges(graph))
+    if len(bridges) == 0:
+        return [], []
+    # Parts connected without bridges, which form a tree connected by the bridges
+    blocks = ClusterLabels(nx.restricted_view(graph, [], bridges))
+    block_of = {node: blocks.find(node) for node in blocks.nodes}
+    block_sizes = {label: blocks.size_of(blocks.nodes[label]) for label in set(block_of.values())}
+    tree = nx.Graph()
+    tree.add_edges_from((block_of[u], block_of[v]) for u, v in bridges)
+    root = block_of[blocks.nodes[0]]
+    parents = nx.dfs_predecessors(tree, root)
+    # Number of nodes in every subtree
+    subtree_sizes = dict(block_sizes)
+    for block in nx.dfs_postorder_nodes(tree, root):
+        if block != root:
+            subtree_sizes[parents[block]] += subtree_sizes[block]
+
+    n_nodes = graph.number_of_nodes()
+    part_sizes = []
+    for u, v in bridges:
+        child = block_of[u] if parents.get(block_of[u]) == block_of[v] else block_of[v]
+        part_sizes.append((subtree_sizes[child], n_nodes - subtree_sizes[child]))
+    return [[bridge] for bridge in bridges], part_sizes
+
+
+def _gomory_hu_cuts(graph, max_cuts):
+    """ Return all minimum cuts of up to max_cuts links from a Gomory-Hu tree (and part sizes)."""
+    flow_graph = nx.Graph()
+    flow_graph.add_nodes_from(graph.nodes)
+    flow_graph.add_edges_from(graph.edges, capacity=1)
+    tree = nx.gomory_hu_tree(flow_graph, flow_func=edmonds_karp)
+
+    # Number tree nodes in DFS preorder: every subtree is an interval of positions
+    root = next(iter(tree.nodes))
+    parents = nx.dfs_predecessors(tree, root)
+    position = {node: i for i, node in enumerate(nx.dfs_preorder_nodes(tree, root))}
+    subtree_sizes = dict.fromkeys(tree.nodes, 1)
+    for node in nx.dfs_postorder_nodes(tree, root):
+        if node != root:
+            subtree_sizes[parents[node]] += subtree_sizes[node]
+
+    edges = list(graph.edges)
+    edge_positions = np.array([(position[x], position[y]) for x, y in edges], dtype=np.int64).reshape(-1, 2)
+    n_nodes = graph.number_of_nodes()
+    cuts = []
+    part_sizes = []
+    for u, v, n_links in tree.edges(data="weight"):
+        if n_links > max_cuts:
+            continue
+        # Removing the tree edge separates the subtree of the child from the rest
+        child = u if parents.get(u) == v else v
+        start = position[child]
+        inside = (edge_positions >= start) & (edge_positions < start + subtree_sizes[child])
+        cuts.append([edges[i] for i in np.where(inside[:, 0] != inside[:, 1])[0]])
+        size_u = subtree_sizes[child] if child == u else n_nodes - subtree_sizes[child]
+        part_sizes.append((size_u, n_nodes - size_u))
+    return cuts, part_sizes
+
+
 def dilate_cluster(graph_main,
                    similars_idx,
                    similars,
@@ -196,17 +382,17 @@ def dilate_cluster(graph_main,
     links_added = []
 
     # Split graph into separate clusters
-    graphs = list(nx.connected_component_subgraphs(graph_main))
+    clusters = ClusterLabels(graph_main)
 
-    for graph in graphs:
-        cluster_size = len(graph.nodes)
+    for nodes in clusters.clusters():
+        cluster_size = len(nodes)
         if cluster_size < min_cluster_size:
             best_scores = []
             potential_links = []
 
-            for ID in graph.nodes:
+            for ID in nodes:
                 nodes_connected = []
-                for key in graph[ID].keys():
+                for key in graph_main[ID].keys():
                     nodes_connected.append(key)
 
                 potential_new_links = [(i, x)
@@ -238,9 +424,7 @@ def dilate_cluster(graph_main,
                 node_id = potential_links[ID][0]
 
                 # Only add link if no cluster > max_cluster_size is formed by it
-                if (len(
-                        nx.node_connected_component(graph_main,
-                                                    potential_links[ID][1])) +
+                if (clusters.size_of(potential_links[ID][1]) +
                         cluster_size) <= max_cluster_size:
                     # Actual adding of new links
                     graph_main.add_edge(node_id,
@@ -248,9 +432,8 @@ def dilate_cluster(graph_main,
                                         weight=best_scores[ID])
                     links_added.append((node_id, potential_links[ID][1]))
                     # Update cluster_size to keep track of growing clusters
-                    cluster_size = len(
-                        nx.node_connected_component(graph_main,
-                                                    potential_links[ID][1]))
+                    clusters.union(node_id, potential_links[ID][1])
+                    cluster_size = clusters.size_of(potential_links[ID][1])
 
     return graph_main, links_added
 
@@ -276,36 +459,36 @@ def erode_clusters(graph_main, max_cluster_size=100, keep_weights_above=0.8):
     links_removed = []
 
     # Split graph into separate clusters
-    graphs = list(nx.connected_component_subgraphs(graph_main))
+    clusters = ClusterLabels(graph_main)
 
-    for graph in graphs:
-        cluster_size = len(graph.nodes)
+    for nodes in clusters.clusters():
+        cluster_size = len(nodes)
         while cluster_size > max_cluster_size:
-
+            # View on current cluster (reflects removed edges of graph_main)
+            graph = clusters.subgraph(nodes)
             edges = list(graph.edges)
             edges_weights = np.array(
                 [graph[x[0]][x[1]]['weight'] for x in edges])
 
             weakest_edge = edges_weights.argsort()[0]
-            if edges_weights[weakest_edge] < keep_weights_above:
-                print("Remove edge:", edges[weakest_edge][0],
-                      edges[weakest_edge][1])
-                graph.remove_edge(edges[weakest_edge][0],
-                                  edges[weakest_edge][1])
-                graph_main.remove_edge(edges[weakest_edge][0],
-                                       edges[weakest_edge][1])
-                links_removed.append(edges[weakest_edge])
+            if edges_weights[weakest_edge] >= keep_weights_above:
+                break  # no more edges that may be removed
+            print("Remove edge:", edges[weakest_edge][0],
+                  edges[weakest_edge][1])
+            graph_main.remove_edge(edges[weakest_edge][0],
+                                   edges[weakest_edge][1])
+            links_removed.append(edges[weakest_edge])
 
             # If link removal caused split of cluster:
-            if not nx.is_connected(graph):
-                subgraphs = list(nx.connected_component_subgraphs(graph))
-                print("Getting from cluster with", len(graph.nodes),
+            subclusters = clusters.split(nodes)
+            if len(subclusters) > 1:
+                print("Getting from cluster with", len(nodes),
                       "nodes, to clusters with",
-                      [len(x.nodes) for x in subgraphs], "nodes.")
-                idx1 = np.argmax([len(x.nodes) for x in subgraphs])
-                graph = subgraphs[idx1]  # keep largest subcluster here
+                      [len(x) for x in subclusters], "nodes.")
+                idx1 = np.argmax([len(x) for x in subclusters])
+                nodes = subclusters[idx1]  # keep largest subcluster here
 
-            cluster_size = len(graph.nodes)
+            cluster_size = len(nodes)
 
     return graph_main, links_removed
 
@@ -323,10 +506,9 @@ def add_intra_cluster_links(graph_main, m_sim, min_weight=0.5, max_links=20):
         Set minimum weight to be considered for making link. Default = 0.5.
     """
     # Split graph into separate clusters
-    graphs = list(nx.connected_component_subgraphs(graph_main))
+    clusters = ClusterLabels(graph_main)
 
-    for graph in graphs:
-        nodes = list(graph.nodes)
+    for nodes in clusters.clusters():
         nodes0 = nodes.copy()
         for node in nodes:
             del nodes0[0]
@@ -345,7 +527,8 @@ def split_cluster(graph_main,
                   min_cluster_size=10,
                   max_search_steps=1000,
                   max_cuts=1,
-                  multiple_cuts_per_level=True):
+                  multiple_cuts_per_level=True,
+                  weak_link_method="sampled"):
     """
     Function to split clusters at weak links.
 
@@ -363,123 +546,149 @@ def split_cluster(graph_main,
         Maximum numbers of links allowed to be cut. Default = 1.
     multiple_cuts_per_level
         If true allow multiple cuts to be done per level and run. Default = True.
+    weak_link_method
+        Method to find weak links, 'sampled' or 'exact' (see weak_link_finder()).
+        Default = 'sampled'.
     """
 
     # Split graph into separate clusters
-    graphs = list(nx.connected_component_subgraphs(graph_main))
+    clusters = ClusterLabels(graph_main)
 
     links_removed = []
-    for i, graph in enumerate(graphs):
-        if len(graph.nodes) > max_cluster_size:
-            # Detect potential weak links
-            weak_links = weak_link_finder(graph,
-                                          max_steps=max_search_steps,
-                                          max_cuts=max_cuts)
+    for nodes in clusters.clusters():
+        if len(nodes) > max_cluster_size:
+            # Only copy clusters that need to be split
+            links_removed.extend(_split_single_cluster(graph_main, clusters.subgraph(nodes).copy(),
+                                                       max_cluster_size=max_cluster_size,
+                                                       min_cluster_size=min_cluster_size,
+                                                       max_search_steps=max_search_steps,
+                                                       max_cuts=max_cuts,
+                                                       multiple_cuts_per_level=multiple_cuts_per_level,
+                                                       weak_link_method=weak_link_method))
 
-            split_done = False
-            j = 0
-            new_graph = graph.copy()
-            while not split_done and j < len(weak_links):
+    return graph_main, links_removed
 
-                # Test best candidates
 
+def _split_single_cluster(graph_main, graph, max_cluster_size, min_cluster_size,
+                          max_search_steps, max_cuts, multiple_cuts_per_level,
+                          weak_link_method):
+    """
+    Split one cluster (graph, a copy of the cluster in graph_main) at weak links.
+    Removed links are removed from graph_main as well and returned.
+    """
+    links_removed = []
+    # Detect potential weak links
+    weak_links = weak_link_finder(graph,
+                                  max_steps=max_search_steps,
+                                  max_cuts=max_cuts,
+                                  method=weak_link_method)
+    if weak_link_method == "exact":
+        # Parts can only get smaller: skip cuts that separate too small parts
+        large_parts = [x.part_sizes.min(axis=1) >= min_cluster_size for x in weak_links]
+        weak_links = [x._replace(cuts=x.cuts[large], counts=x.counts[large], part_sizes=x.part_sizes[large])
+                      for x, large in zip(weak_links, large_parts) if np.any(large)]
+
+    split_done = False
+    j = 0
+    new_graph = graph
+    while not split_done and j < len(weak_links):
+
+        # Test best candidates
+
+        new_graph_testing = new_graph.copy()
+        pairs = weak_links[j].cuts
+        pair_counts = weak_links[j].counts
+        pairs = pairs[pair_counts.argsort()[::-1]]
+        # print(i,j, pairs)
+
+        # ----------------------------------------------
+        # Check if pairs have already been removed in former iteration
+        # ----------------------------------------------
+        pairs_still_present = []
+        for i, pair in enumerate(pairs):
+            all_edges_present = True
+            for m in range(int(pairs.shape[1] / 2)):
+                edge = (pair[m * 2], pair[m * 2 + 1])
+                if edge not in new_graph_testing.edges:
+                    all_edges_present = False
+            if all_edges_present:
+                pairs_still_present.append(i)
+            pairs_still_present = list(set(pairs_still_present))
+        pairs = pairs[
+            pairs_still_present]  # Remove pairs which have been cut out already
+
+        # ----------------------------------------------
+        # Test removing proposed links for all pairs
+        # ----------------------------------------------
+        if len(pairs) > 0:
+            min_size_after_cutting = []
+            for pair in pairs:
                 new_graph_testing = new_graph.copy()
-                pairs = weak_links[j][1]
-                pair_counts = weak_links[j][2]
-                pairs = pairs[pair_counts.argsort()[::-1]]
-                # print(i,j, pairs)
-
-                # ----------------------------------------------
-                # Check if pairs have already been removed in former iteration
-                # ----------------------------------------------
-                pairs_still_present = []
-                for i, pair in enumerate(pairs):
-                    all_edges_present = True
-                    for m in range(int(pairs.shape[1] / 2)):
-                        edge = (pair[m * 2], pair[m * 2 + 1])
-                        if edge not in new_graph_testing.edges:
-                            all_edges_present = False
-                    if all_edges_present:
-                        pairs_still_present.append(i)
-                    pairs_still_present = list(set(pairs_still_present))
-                pairs = pairs[
-                    pairs_still_present]  # Remove pairs which have been cut out already
-
-                # ----------------------------------------------
-                # Test removing proposed links for all pairs
-                # ----------------------------------------------
-                if len(pairs) > 0:
-                    min_size_after_cutting = []
-                    for pair in pairs:
-                        new_graph_testing = new_graph.copy()
-
-                        # Remove edges in pair
-                        for m in range(int(pairs.shape[1] / 2)):
-                            new_graph_testing.remove_edge(
-                                pair[m * 2], pair[m * 2 + 1])
-
-                        # Check if created subclustes are big enough:
-                        subgraphs = list(
-                            nx.connected_component_subgraphs(
-                                new_graph_testing))
-                        min_size_after_cutting.append(
-                            min([len(x.nodes) for x in subgraphs]))
-
-                    # Select best partition of graph (creating most similar sized subclusters)
-                    min_size_after_cutting = np.array(min_size_after_cutting)
-                    best_partition = np.argmax(min_size_after_cutting)
-                else:
-                    min_size_after_cutting = [0]
-                    best_partition = 0
-
-                # ----------------------------------------------
-                # Actual removal of links
-                # ----------------------------------------------
-                if min_size_after_cutting[best_partition] >= min_cluster_size:
-                    new_graph_testing = new_graph.copy()
-                    pair = pairs[best_partition]
-
-                    # Remove edges in selected pair
-                    for m in range(int(pairs.shape[1] / 2)):
-                        # Remove edge from current cluster:
-                        new_graph_testing.remove_edge(pair[m * 2],
-                                                      pair[m * 2 + 1])
-                        # Remove edge from main graph:
-                        graph_main.remove_edge(pair[m * 2], pair[m * 2 + 1])
-                        links_removed.append((pair[m * 2], pair[m * 2 + 1]))
-                    subgraphs = list(
-                        nx.connected_component_subgraphs(new_graph_testing))
-
-                    if int(pairs.shape[1] / 2) > 1:
-                        print("Removed", int(pairs.shape[1] / 2), "edges:",
-                              pair)
-                    else:
-                        print("Removed", int(pairs.shape[1] / 2), "edge:",
-                              pair)
-
-                    print("Getting from cluster with", len(new_graph.nodes),
-                          "nodes, to clusters with",
-                          [len(x.nodes) for x in subgraphs], "nodes.")
-                    idx1 = np.argmax([len(x.nodes) for x in subgraphs])
-                    new_graph = subgraphs[idx1]  # keep largest subcluster here
-
-                    if len(new_graph.nodes) <= max_cluster_size:
-                        split_done = True
-                    else:
-                        pass
-
-                # Check if more suited cuts are expected for the same number of cuts
-                if len(min_size_after_cutting) > 1:
-                    idx = np.argsort(min_size_after_cutting)[::-1][1]
-                    if min_size_after_cutting[
-                            idx] >= min_cluster_size and multiple_cuts_per_level:
-                        pass
-                    else:
-                        j += 1
-                else:
-                    j += 1
 
-    return graph_main, links_removed
+                # Remove edges in pair
+                for m in range(int(pairs.shape[1] / 2)):
+                    new_graph_testing.remove_edge(
+                        pair[m * 2], pair[m * 2 + 1])
+
+                # Check if created subclustes are big enough:
+                min_size_after_cutting.append(
+                    ClusterLabels(new_graph_testing).sizes.min())
+
+            # Select best partition of graph (creating most similar sized subclusters)
+            min_size_after_cutting = np.array(min_size_after_cutting)
+            best_partition = np.argmax(min_size_after_cutting)
+        else:
+            min_size_after_cutting = [0]
+            best_partition = 0
+
+        # ----------------------------------------------
+        # Actual removal of links
+        # ----------------------------------------------
+        if min_size_after_cutting[best_partition] >= min_cluster_size:
+            new_graph_testing = new_graph.copy()
+            pair = pairs[best_partition]
+
+            # Remove edges in selected pair
+            for m in range(int(pairs.shape[1] / 2)):
+                # Remove edge from current cluster:
+                new_graph_testing.remove_edge(pair[m * 2],
+                                              pair[m * 2 + 1])
+                # Remove edge from main graph:
+                graph_main.remove_edge(pair[m * 2], pair[m * 2 + 1])
+                links_removed.append((pair[m * 2], pair[m * 2 + 1]))
+            subclusters = ClusterLabels(new_graph_testing).clusters()
+
+            if int(pairs.shape[1] / 2) > 1:
+                print("Removed", int(pairs.shape[1] / 2), "edges:",
+                      pair)
+            else:
+                print("Removed", int(pairs.shape[1] / 2), "edge:",
+                      pair)
+
+            print("Getting from cluster with", len(new_graph.nodes),
+                  "nodes, to clusters with",
+                  [len(x) for x in subclusters], "nodes.")
+            idx1 = np.argmax([len(x) for x in subclusters])
+            # keep largest subcluster here
+            new_graph = new_graph_testing.subgraph(subclusters[idx1]).copy()
+
+            if len(new_graph.nodes) <= max_cluster_size:
+                split_done = True
+            else:
+                pass
+
+        # Check if more suited cuts are expected for the same number of cuts
+        if len(min_size_after_cutting) > 1:
+            idx = np.argsort(min_size_after_cutting)[::-1][1]
+            if min_size_after_cutting[
+                    idx] >= min_cluster_size and multiple_cuts_per_level:
+                pass
+            else:
+                j += 1
+        else:
+            j += 1
+
+    return links_removed
 
 
 # ----------------------------------------------------------------------------
@@ -498,36 +707,52 @@ def refine_network(graph_main,
                    max_cuts=2,
                    max_split_iterations=10,
                    basic_splitting=True,
-                   dilation=False):
+                   dilation=False,
+                   weak_link_method="sampled"):
     """
     Args:
     -------
+    weak_link_method
+        Method to find weak links, 'sampled' or 'exact' (see weak_link_finder()).
+        Default = 'sampled'.
     """
-    # Split graph into separate clusters
-    graphs = list(nx.connected_component_subgraphs(graph_main))
-
     links_removed = []
     links_added = []
 
-    # n_cluster = len(graphs)
-    cluster_max = np.max([len(x.nodes) for x in graphs])
+    # Work queue of clusters larger than max_cluster_size
+    clusters = ClusterLabels(graph_main)
+    oversized = [nodes for nodes in clusters.clusters() if len(nodes) > max_cluster_size]
+    if len(oversized) > 0:
+        # Single copy, links are then removed in place
+        graph_main = graph_main.copy()
+        clusters = ClusterLabels(graph_main)
     counter = 0
 
     print(20 * '---')
-    while cluster_max > max_cluster_size and counter < max_split_iterations:
+    while len(oversized) > 0 and counter < max_split_iterations:
         print("Splitting iteration:", counter + 1, "Max cluster size =",
-              cluster_max, '\n')
-        graph_main, links = split_cluster(graph_main.copy(),
+              max(len(nodes) for nodes in oversized), '\n')
+        still_oversized = []
+        for nodes in oversized:
+            links = _split_single_cluster(graph_main, clusters.subgraph(nodes).copy(),
                                           max_cluster_size=max_cluster_size,
                                           min_cluster_size=min_cluster_size,
                                           max_search_steps=max_search_steps,
                                           max_cuts=max_cuts,
-                                          multiple_cuts_per_level=True)
-        links_removed.extend(links)
-
-        # Split updated graph into separate clusters
-        graphs = list(nx.connected_component_subgraphs(graph_main))
-        cluster_max = np.max([len(x.nodes) for x in graphs])
+                                          multiple_cuts_per_level=True,
+                                          weak_link_method=weak_link_method)
+            links_removed.extend(links)
+            if len(links) > 0:
+                # Only the parts of a cut cluster need to be re-examined
+                still_oversized.extend(sorted(part, key=clusters.node_index.get)
+                                       for part in clusters.split(nodes)
+                                       if len(part) > max_cluster_size)
+            elif weak_link_method == "sampled":
+                # Sampling again can still find a cut ('exact' would give the same result)
+                still_oversized.append(nodes)
+
+        # Same order as the clusters of graph_main
+        oversized = sorted(still_oversized, key=lambda nodes: clusters.node_index[nodes[0]])
         counter += 1
 
     if basic_splitting:
@@ -540,7 +765,8 @@ def refine_network(graph_main,
             min_cluster_size=min_cluster_size,
             max_search_steps=max_search_steps,
             max_cuts=1,
-            multiple_cuts_per_level=False)
+            multiple_cuts_per_level=False,
+            weak_link_method=weak_link_method)
         links_removed.extend(links)
 
     if dilation:
@@ -580,7 +806,7 @@ def evaluate_clusters(graph_main, m_sim_ref):
     """
 
     # Split graph into separate clusters
-    graphs = list(nx.connected_component_subgraphs(graph_main))
+    clusters = ClusterLabels(graph_main)
 
     num_nodes = []
     num_edges = []
@@ -590,8 +816,9 @@ def evaluate_clusters(graph_main, m_sim_ref):
     ref_sim_var_nodes = []
 
     # Loop through clusters
-    for graph in graphs:
-        num_nodes.append(len(graph.nodes))
+    for nodes in clusters.clusters():
+        graph = clusters.subgraph(nodes)
+        num_nodes.append(len(nodes))
         if len(graph.edges) > 0:  # no edges for singletons
             num_edges.append(len(graph.edges))
 
@@ -605,7 +832,6 @@ def evaluate_clusters(graph_main, m_sim_ref):
             ref_sim_mean_edges.append(0)
             ref_sim_var_edges.append(0)
 
-        nodes = list(graph.nodes)
         mean_mol_sims = []
         for node in nodes:
             mean_mol_sims.append(m_sim_ref[node, nodes])
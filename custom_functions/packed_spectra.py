@@ -0,0 +1,138 @@
+"""Spectrum collection stored in contiguous peak arrays."""
+import hashlib
+from typing import List
+import numpy as np
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from matchms.similarity.spectrum_similarity_functions import collect_peak_pairs
+from matchms.typing import SpectrumType
+from custom_functions.similarity_functions import CosineAndModifiedCosine, cosine_and_modified_cosine, greedy_score
+
+
+class PackedSpectra:
+    """Peaks and precursor m/z of many spectra in a few contiguous arrays.
+
+    Peaks of spectrum i are peaks[offsets[i]:offsets[i+1]] (columns: m/z and
+    intensity), which is a view and not a copy. Compared to a list of matchms
+    Spectrum objects, a PackedSpectra is cheap to send to worker processes and
+    can be scored without creating new peak arrays for every pair. It can be
+    used instead of a list of spectra in parallel_scoring.py and
+    all_vs_all_similarity_matrix() (for CosineGreedy, ModifiedCosine and
+    CosineAndModifiedCosine).
+
+    For example:
+
+    .. code-block:: python
+
+        packed_spectra = PackedSpectra.from_spectra(spectrums)
+        similarities, num_matches = all_vs_all_similarity_matrix(packed_spectra, ModifiedCosine())
+    """
+    def __init__(self, peaks: np.ndarray, offsets: np.ndarray, precursor_mz: np.ndarray):
+        """
+
+        Args:
+        --------
+        peaks:
+            Array of shape (total number of peaks, 2) with m/z and intensities of all
+            spectra (sorted by m/z within each spectrum).
+        offsets:
+            Peaks of spectrum i are peaks[offsets[i]:offsets[i+1]].
+        precursor_mz:
+            Precursor m/z of all spectra (NaN if missing).
+        """
+        assert peaks.ndim == 2 and peaks.shape[1] == 2, "Expected peaks array with m/z and intensities."
+        assert offsets.shape[0] == precursor_mz.shape[0] + 1, "Expected one offset per spectrum (+1)."
+        self.peaks = np.ascontiguousarray(peaks, dtype=np.float64)
+        self.offsets = offsets
+        self.precursor_mz = precursor_mz
+
+    def __len__(self):
+        return self.precursor_mz.shape[0]
+
+    @property
+    def mz(self) -> np.ndarray:
+        return self.peaks[:, 0]
+
+    @property
+    def intensities(self) -> np.ndarray:
+        return self.peaks[:, 1]
+
+    @classmethod
+    def from_spectra(cls, spectra: List[SpectrumType]):
+        """Create from list of matchms Spectrum objects (or SpectrumDocuments)."""
+        spectra = [getattr(s, "_obj", s) for s in spectra]
+        n_peaks = [s.peaks.mz.shape[0] for s in spectra]
+        peaks = np.zeros((sum(n_peaks), 2), dtype=np.float64)
+        offsets = np.concatenate(([0], np.cumsum(n_peaks))).astype(np.int64)
+        for i, spectrum in enumerate(spectra):
+            peaks[offsets[i]:offsets[i + 1], 0] = spectrum.peaks.mz
+            peaks[offsets[i]:offsets[i + 1], 1] = spectrum.peaks.intensities
+        precursor_mz = np.array([np.nan if s.get("precursor_mz") is None else float(s.get("precursor_mz"))
+                                 for s in spectra], dtype=np.float64)
+        return cls(peaks, offsets, precursor_mz)
+
+    def peaks_of(self, i: int) -> np.ndarray:
+        """Return peaks (view) of spectrum i as array of shape (n_peaks, 2)."""
+        return self.peaks[self.offsets[i]:self.offsets[i + 1]]
+
+    def content_hash(self) -> str:
+        """Return hash of all peaks and precursor m/z (e.g. to check that checkpoints belong to the same spectra)."""
+        content = hashlib.sha256()
+        for array in [self.peaks, self.offsets, self.precursor_mz]:
+            content.update(np.ascontiguousarray(array).tobytes())
+        return content.hexdigest()
+
+    def subset(self, ids: List[int]):
+        """Return new PackedSpectra with only the spectra with given ids."""
+        ids = np.asarray(ids, dtype="int")
+        n_peaks = np.diff(self.offsets)[ids]
+        positions = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in ids]
+                                   + [np.zeros(0, dtype="int")])
+        return PackedSpectra(self.peaks[positions], np.concatenate(([0], np.cumsum(n_peaks))).astype(np.int64),
+                             self.precursor_mz[ids])
+
+
+def spectra_hash(spectra) -> str:
+    """Return content hash of a list of spectra (or PackedSpectra), see PackedSpectra.content_hash()."""
+    if not isinstance(spectra, PackedSpectra):
+        spectra = PackedSpectra.from_spectra(spectra)
+    return spectra.content_hash()
+
+
+def is_packed_similarity(similarity_function) -> bool:
+    """Return True if similarity_function can be computed on PackedSpectra."""
+    return type(similarity_function).pair in (CosineGreedy.pair, ModifiedCosine.pair,
+                                              CosineAndModifiedCosine.pair)
+
+
+def score_packed_pair(references: PackedSpectra, i: int,
+                      queries: PackedSpectra, j: int,
+                      similarity_function):
+    """Compute score and matches of references[i] and queries[j].
+
+    Gives the same result as similarity_function.pair() for CosineGreedy,
+    ModifiedCosine and CosineAndModifiedCosine (using the same matchms functions),
+    but works on peak views.
+    """
+    spec1 = references.peaks_of(i)
+    spec2 = queries.peaks_of(j)
+    tolerance = similarity_function.tolerance
+    mz_power = similarity_function.mz_power
+    intensity_power = similarity_function.intensity_power
+    if isinstance(similarity_function, CosineAndModifiedCosine):
+        return cosine_and_modified_cosine(spec1, spec2, references.precursor_mz[i], queries.precursor_mz[j],
+                                          tolerance, mz_power, intensity_power)
+    matching_pairs = collect_peak_pairs(spec1, spec2, tolerance, shift=0.0,
+                                        mz_power=mz_power, intensity_power=intensity_power)
+    if isinstance(similarity_function, ModifiedCosine):
+        precursor_mz_ref = references.precursor_mz[i]
+        precursor_mz_query = queries.precursor_mz[j]
+        assert not (np.isnan(precursor_mz_ref) or np.isnan(precursor_mz_query)), \
+            "Precursor_mz missing. Apply 'add_precursor_mz' filter first."
+        assert precursor_mz_ref > 0 and precursor_mz_query > 0, "Expect precursor to be positive number."
+        nonzero_pairs = collect_peak_pairs(spec1, spec2, tolerance, shift=precursor_mz_ref - precursor_mz_query,
+                                           mz_power=mz_power, intensity_power=intensity_power)
+        matching_pairs = np.concatenate([x for x in [matching_pairs, nonzero_pairs] if x is not None]
+                                        + [np.zeros((0, 3))], axis=0)
+    if matching_pairs is None:
+        return 0.0, 0
+    return greedy_score(matching_pairs, spec1, spec2, mz_power, intensity_power)
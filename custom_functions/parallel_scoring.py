@@ -0,0 +1,334 @@
+"""Multi-core computation of (modified) cosine scores for tiles or lists of pairs.
+
+References and queries can be lists of spectra or PackedSpectra (see packed_spectra.py).
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from typing import List, Tuple
+import numpy as np
+from matchms.typing import SpectrumType
+from custom_functions.packed_spectra import PackedSpectra, is_packed_similarity, score_packed_pair
+from custom_functions.top_n_selection import RunningTopN
+
+
+# Data shared with worker processes (set once per worker by _init_worker)
+_worker_data = {}
+
+
+class ScoringPool:
+    """Process pool with the reference spectra loaded once into every worker.
+
+    iter_scored_tiles(), score_pairs() and top_n_scores() otherwise start a new
+    process pool (and send all references to every worker) on every call. With a
+    ScoringPool, many calls with the same references (e.g. one per chunk of
+    queries) share the workers, only the queries are sent with every work item.
+
+    For example:
+
+    .. code-block:: python
+
+        library_spectra = PackedSpectra.from_spectra(documents_library)
+        with ScoringPool(library_spectra, n_jobs=8) as pool:
+            for query_spectra in query_chunks:
+                scores, matches = score_pairs(library_spectra, query_spectra, pairs,
+                                              ModifiedCosine(), pool=pool)
+    """
+    def __init__(self, references, n_jobs: int = None, mp_context: str = None):
+        """
+
+        Args:
+        --------
+        references:
+            List of reference spectrums (or PackedSpectra) used for all calls.
+        n_jobs:
+            Number of worker processes. Set to None to use all available cores.
+            For n_jobs=1 no processes are started. Default = None.
+        mp_context:
+            Start method of the worker processes ("fork", "forkserver" or "spawn").
+            Workers are started on the first call, use "spawn" or "forkserver" if
+            that can happen while other threads are running (forking a process
+            with several threads can deadlock). Default = None (platform default).
+        """
+        self.references = references
+        self.n_jobs = (os.cpu_count() or 1) if n_jobs is None else n_jobs
+        self._executor = None
+        if self.n_jobs > 1:
+            context = None if mp_context is None else multiprocessing.get_context(mp_context)
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=context,
+                                                 initializer=_init_worker, initargs=(references, None, None))
+
+    def start(self):
+        """Start all worker processes (and send them the references) now instead of on the first call."""
+        if self._executor is not None:
+            list(self._executor.map(_do_nothing, range(self.n_jobs)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Shut down worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def make_tiles(n_rows: int, n_cols: int,
+               tile_size: Tuple[int, int] = (1000, 100)) -> List[Tuple[int, int, int, int]]:
+    """Split a n_rows x n_cols score matrix into tiles.
+
+    Returns list of tiles (row_start, row_end, col_start, col_end).
+    """
+    return [(row_start, min(row_start + tile_size[0], n_rows),
+             col_start, min(col_start + tile_size[1], n_cols))
+            for row_start in range(0, n_rows, tile_size[0])
+            for col_start in range(0, n_cols, tile_size[1])]
+
+
+def make_upper_triangle_tiles(n_spectrums: int,
+                              tile_size: Tuple[int, int] = (500, 500)) -> List[Tuple[int, int, int, int]]:
+    """Split upper triangle (including diagonal) of a n_spectrums x n_spectrums matrix into tiles.
+
+    Returns list of tiles (row_start, row_end, col_start, col_end) that contain
+    at least one entry with row <= column.
+    """
+    return [tile for tile in make_tiles(n_spectrums, n_spectrums, tile_size)
+            if tile[0] < tile[3]]
+
+
+def iter_scored_tiles(references: List[SpectrumType],
+                      queries: List[SpectrumType],
+                      similarity_function,
+                      tiles: List[Tuple[int, int, int, int]],
+                      n_jobs: int = None,
+                      upper_triangle: bool = False,
+                      pool: ScoringPool = None):
+    """Compute scores for all given tiles on a process pool.
+
+    Yields (tile, scores, matches) in order of completion, with scores and
+    matches arrays of shape (row_end - row_start, col_end - col_start) (plus a
+    last axis of size 2 for CosineAndModifiedCosine).
+
+    Args:
+    --------
+    references:
+        List of reference spectrums (matrix rows).
+    queries:
+        List of query spectrums (matrix columns).
+    similarity_function:
+        Matchms similarity function (e.g. CosineGreedy or ModifiedCosine).
+    tiles:
+        List of tiles (row_start, row_end, col_start, col_end), see make_tiles().
+    n_jobs:
+        Number of worker processes. Set to None to use all available cores.
+        For n_jobs=1 all tiles are computed in the current process. Default = None.
+    upper_triangle:
+        Set to True to only compute entries with row <= column (e.g. for symmetric
+        all-vs-all matrices). Other entries are returned as 0. Default = False.
+    pool:
+        ScoringPool of the references to use instead of starting new worker
+        processes (n_jobs is then ignored). Default = None.
+    """
+    yield from _run_on_pool(partial(_score_tile, upper_triangle=upper_triangle), tiles,
+                            references, queries, similarity_function, n_jobs, pool)
+
+
+def score_pairs(references: List[SpectrumType],
+                queries: List[SpectrumType],
+                pairs: np.ndarray,
+                similarity_function,
+                n_jobs: int = None,
+                batch_size: int = 1000,
+                pool: ScoringPool = None):
+    """Compute scores for a list of (reference, query) pairs on a process pool.
+
+    Duplicate pairs are only scored once.
+
+    Args:
+    --------
+    references:
+        List of reference spectrums.
+    queries:
+        List of query spectrums.
+    pairs:
+        Array of shape (n_pairs, 2) with reference and query index of every pair.
+    similarity_function:
+        Matchms similarity function (e.g. CosineGreedy or ModifiedCosine).
+    n_jobs:
+        Number of worker processes. Set to None to use all available cores. Default = None.
+    batch_size:
+        Number of pairs that are send to a worker process at once. Default = 1000.
+    pool:
+        ScoringPool of the references to use instead of starting new worker
+        processes (n_jobs is then ignored). Default = None.
+
+    Returns:
+    --------
+    scores, matches
+        Arrays with score and number of matching peaks for every given pair
+        (of shape (n_pairs, 2) for CosineAndModifiedCosine).
+    """
+    pairs = np.asarray(pairs, dtype="int").reshape(-1, 2)
+    unique_pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    score_shape = (unique_pairs.shape[0],) + tuple(getattr(similarity_function, "score_shape", ()))
+    scores = np.zeros(score_shape, dtype=np.float64)
+    matches = np.zeros(score_shape, dtype="int")
+    batches = [(start, unique_pairs[start:(start + batch_size)])
+               for start in range(0, unique_pairs.shape[0], batch_size)]
+    for start, batch_scores, batch_matches in _run_on_pool(_score_pair_batch, batches, references,
+                                                           queries, similarity_function, n_jobs, pool):
+        scores[start:(start + batch_scores.shape[0])] = batch_scores
+        matches[start:(start + batch_scores.shape[0])] = batch_matches
+    inverse = inverse.ravel()
+    return scores[inverse], matches[inverse]
+
+
+def top_n_scores(references: List[SpectrumType],
+                 queries: List[SpectrumType],
+                 similarity_function,
+                 top_n: int,
+                 min_matches: int = 0,
+                 n_jobs: int = None,
+                 tile_size: Tuple[int, int] = (1000, 100),
+                 pool: ScoringPool = None):
+    """Find top_n highest scoring references for every query.
+
+    The reference x query space is split into tiles which are scored on a
+    process pool. Only the running top_n per query (and their scores and
+    matches) are kept, so that no full score matrix is created.
+    Scores with less than min_matches matching peaks are treated as 0 for the
+    selection (as done in library_matching). Ties are resolved by taking the
+    lowest reference index.
+
+    Args:
+    --------
+    references:
+        List of reference spectrums.
+    queries:
+        List of query spectrums.
+    similarity_function:
+        Matchms similarity function (e.g. ModifiedCosine).
+    top_n:
+        Number of best references to select per query.
+    min_matches:
+        Minimum number of matching peaks for a score to be considered. Default = 0.
+    n_jobs:
+        Number of worker processes. Set to None to use all available cores. Default = None.
+    tile_size:
+        Tile size as (number of references, number of queries). Default = (1000, 100).
+    pool:
+        ScoringPool of the references to use instead of starting new worker
+        processes (n_jobs is then ignored). Default = None.
+
+    Returns:
+    --------
+    selected_ids, selected_scores, selected_matches
+        Arrays of shape (top_n, len(queries)) with reference ids, scores and matches
+        of the selected references (sorted from highest to lowest score).
+    """
+    assert getattr(similarity_function, "score_shape", ()) == (), "Expected similarity function with one score."
+    running_top_n = RunningTopN(min(top_n, len(references)), len(queries),
+                                fields={"scores": np.float64, "matches": "int"})
+    tiles = make_tiles(len(references), len(queries), tile_size)
+    for tile, scores, matches in iter_scored_tiles(references, queries, similarity_function,
+                                                   tiles, n_jobs=n_jobs, pool=pool):
+        row_start, row_end, col_start, _ = tile
+        values = scores.copy()
+        values[matches < min_matches] = 0
+        running_top_n.update(np.arange(row_start, row_end), values, col_start=col_start,
+                             scores=scores, matches=matches)
+
+    return running_top_n.ids, running_top_n.fields["scores"], running_top_n.fields["matches"]
+
+
+def _run_on_pool(function, work_items, references, queries, similarity_function, n_jobs, pool=None):
+    """Run function on all work items (in order of completion)."""
+    packed = isinstance(references, PackedSpectra)
+    assert packed == isinstance(queries, PackedSpectra), "Expected both or none of the spectra to be packed."
+    assert not packed or is_packed_similarity(similarity_function), \
+        "PackedSpectra can only be scored with CosineGreedy, ModifiedCosine or CosineAndModifiedCosine."
+    if pool is not None:
+        assert pool.references is references, "Expected references the ScoringPool was started with."
+        if pool._executor is None or len(work_items) <= 1:
+            n_jobs = 1
+        else:
+            # References are already in the workers, only send the queries
+            futures = [pool._executor.submit(_run_with_queries, function, queries, similarity_function, work_item)
+                       for work_item in work_items]
+            for future in as_completed(futures):
+                yield future.result()
+            return
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1 or len(work_items) <= 1:
+        _init_worker(references, queries, similarity_function)
+        for work_item in work_items:
+            yield function(work_item)
+        _worker_data.clear()
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(references, queries, similarity_function)) as executor:
+        futures = [executor.submit(function, work_item) for work_item in work_items]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _do_nothing(_):
+    """Work item to start a worker process."""
+    return None
+
+
+def _init_worker(references, queries, similarity_function):
+    """Store spectra and similarity function in the (worker) process."""
+    _worker_data["references"] = references
+    _worker_data["queries"] = queries
+    _worker_data["similarity_function"] = similarity_function
+    _worker_data["packed"] = isinstance(references, PackedSpectra)
+
+
+def _run_with_queries(function, queries, similarity_function, work_item):
+    """Run function on work_item in a ScoringPool worker (references are already loaded)."""
+    _worker_data["queries"] = queries
+    _worker_data["similarity_function"] = similarity_function
+    return function(work_item)
+
+
+def _score_pair(i, j):
+    """Compute score and matches for references[i] and queries[j]."""
+    if _worker_data["packed"]:
+        return score_packed_pair(_worker_data["references"], i, _worker_data["queries"], j,
+                                 _worker_data["similarity_function"])
+    score = _worker_data["similarity_function"].pair(_worker_data["references"][i], _worker_data["queries"][j])
+    return score["score"], score["matches"]
+
+
+def _score_shape():
+    """Shape of the score of a single pair (e.g. (2,) for CosineAndModifiedCosine)."""
+    return tuple(getattr(_worker_data["similarity_function"], "score_shape", ()))
+
+
+def _score_tile(tile, upper_triangle=False):
+    """Compute scores and matches for all pairs (or upper triangle pairs) within one tile."""
+    row_start, row_end, col_start, col_end = tile
+    score_shape = (row_end - row_start, col_end - col_start) + _score_shape()
+    scores = np.zeros(score_shape, dtype=np.float64)
+    matches = np.zeros(score_shape, dtype="int")
+    for i in range(row_start, row_end):
+        for j in range(max(i, col_start) if upper_triangle else col_start, col_end):
+            scores[i - row_start, j - col_start], matches[i - row_start, j - col_start] = _score_pair(i, j)
+    return tile, scores, matches
+
+
+def _score_pair_batch(batch):
+    """Compute scores and matches for a batch of (reference, query) pairs."""
+    start, pairs = batch
+    scores = np.zeros((pairs.shape[0],) + _score_shape(), dtype=np.float64)
+    matches = np.zeros((pairs.shape[0],) + _score_shape(), dtype="int")
+    for i, (i_ref, i_query) in enumerate(pairs):
+        scores[i], matches[i] = _score_pair(i_ref, i_query)
+    return start, scores, matches
@@ -345,8 +345,8 @@ def cosine_score(spectrum1, spectrum2, tolerance, modified_cosine=False):
     """
     def get_peaks_arrays():
         """Get peaks mz and intensities as numpy array."""
-        spec1 = np.vstack((spectrum1.peaks.mz, spectrum1.peaks.intensities)).T
-        spec2 = np.vstack((spectrum2.peaks.mz, spectrum2.peaks.intensities)).T
+        spec1 = spectrum1.peaks.to_numpy
+        spec2 = spectrum2.peaks.to_numpy
         assert max(spec1[:, 1]) <= 1, ("Input spectrum1 is not normalized. ",
                                        "Apply 'normalize_intensities' filter first.")
         assert max(spec2[:, 1]) <= 1, ("Input spectrum2 is not normalized. ",
@@ -0,0 +1,216 @@
+"""Cheap upper bounds of (modified) cosine scores to skip pairs below a threshold."""
+from typing import Tuple
+import numpy as np
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from scipy.sparse import csr_matrix
+from custom_functions.packed_spectra import PackedSpectra
+
+
+class ScoreUpperBound:
+    """Upper bounds of CosineGreedy/ModifiedCosine scores and matches for many pairs.
+
+    Peaks are binned with a bin width of the matching tolerance, so matching peaks
+    are always in the same or in neighbouring bins. Per spectrum and bin the norm
+    of the (normalized) peak weights is stored. By Cauchy-Schwarz, the greedy score
+    of a pair is at most the sum over all neighbouring bins of the products of
+    these norms (and the number of matches at most the number of peak pairs in
+    neighbouring bins). For ModifiedCosine the same is added for peaks binned by
+    their m/z difference to the precursor m/z (the shifted peak pairs).
+
+    Bounds of all pairs of a tile are computed with one sparse matrix product,
+    which is much faster than the exact greedy matching. Pairs whose bound cannot
+    reach the thresholds can therefore be skipped without changing the result.
+
+    For example:
+
+    .. code-block:: python
+
+        upper_bound = ScoreUpperBound(spectrums, spectrums, ModifiedCosine(tolerance=0.005))
+        pairs = upper_bound.candidate_pairs((0, 500, 0, 500), score_cutoff=0.7, min_matches=6)
+        print(upper_bound.n_pairs_pruned, "of", upper_bound.n_pairs_checked, "pairs pruned")
+    """
+    def __init__(self, references, queries, similarity_function):
+        """
+
+        Args:
+        --------
+        references:
+            List of reference spectrums (or PackedSpectra), rows.
+        queries:
+            List of query spectrums (or PackedSpectra), columns.
+        similarity_function:
+            CosineGreedy or ModifiedCosine (or subclass with the same score).
+        """
+        assert isinstance(similarity_function, (CosineGreedy, ModifiedCosine)), \
+            "Upper bounds are only available for CosineGreedy and ModifiedCosine."
+        assert similarity_function.tolerance > 0, \
+            "Upper bounds require a tolerance > 0 (peaks are binned by the tolerance)."
+        references, queries = [x if isinstance(x, PackedSpectra) else PackedSpectra.from_spectra(x)
+                               for x in [references, queries]]
+        shifted = isinstance(similarity_function, ModifiedCosine)
+        # Slightly wider bins to be safe from rounding errors at bin borders
+        bin_width = similarity_function.tolerance * (1 + 1e-6)
+        bins = [_peak_bins(spectra, bin_width, shifted) for spectra in [references, queries]]
+        offset = min(np.min(x, initial=0) for x in bins) - 1
+        n_bins = max(np.max(x, initial=0) for x in bins) - offset + 2
+        if shifted:
+            # Shifted bins are stored after the m/z bins
+            n_bins = 2 * n_bins
+            bins = [np.where(np.arange(len(x)) < len(x) // 2, x - offset, x - offset + n_bins // 2)
+                    for x in bins]
+        else:
+            bins = [x - offset for x in bins]
+
+        weights_references = _peak_weights(references, similarity_function)
+        weights_queries = _peak_weights(queries, similarity_function)
+        if shifted:
+            weights_references = np.tile(weights_references, 2)
+            weights_queries = np.tile(weights_queries, 2)
+        self.score_references = _bin_norms(references, weights_references, bins[0], n_bins, shifted)
+        self.score_queries = _neighbour_sum(_bin_norms(queries, weights_queries, bins[1], n_bins, shifted))
+        self.count_references = _bin_counts(references, bins[0], n_bins, shifted)
+        self.count_queries = _neighbour_sum(_bin_counts(queries, bins[1], n_bins, shifted))
+        self.n_peaks_references = np.diff(references.offsets)
+        self.n_peaks_queries = np.diff(queries.offsets)
+        # Missing precursor m/z: no bound (exact score computation reports the error)
+        self.missing_references = np.isnan(references.precursor_mz) if shifted else np.zeros(len(references), bool)
+        self.missing_queries = np.isnan(queries.precursor_mz) if shifted else np.zeros(len(queries), bool)
+        # Pruning effectiveness of all candidate_pairs() and prune_pairs() calls
+        self.n_pairs_checked = 0
+        self.n_pairs_pruned = 0
+
+    def tile(self, tile: Tuple[int, int, int, int]):
+        """Return upper bounds of scores and matches for all pairs of a tile.
+
+        Args:
+        --------
+        tile:
+            Tile (row_start, row_end, col_start, col_end).
+
+        Returns:
+        --------
+        Arrays score_bounds and matches_bounds of shape (row_end - row_start, col_end - col_start).
+        """
+        rows = slice(tile[0], tile[1])
+        columns = slice(tile[2], tile[3])
+        score_bounds = (self.score_references[rows] @ self.score_queries[columns].T).toarray()
+        matches_bounds = (self.count_references[rows] @ self.count_queries[columns].T).toarray()
+        matches_bounds = np.minimum(matches_bounds, np.minimum(self.n_peaks_references[rows].reshape(-1, 1),
+                                                               self.n_peaks_queries[columns].reshape(1, -1)))
+        missing = self.missing_references[rows].reshape(-1, 1) | self.missing_queries[columns].reshape(1, -1)
+        score_bounds[missing] = np.inf
+        matches_bounds[missing] = np.iinfo(matches_bounds.dtype).max
+        return score_bounds, matches_bounds
+
+    def candidate_pairs(self, tile: Tuple[int, int, int, int],
+                        score_cutoff: float = None,
+                        min_matches: int = None,
+                        upper_triangle: bool = False) -> np.ndarray:
+        """Return all pairs (row, column) of a tile that can have score > score_cutoff and
+        at least min_matches matching peaks.
+
+        Args:
+        --------
+        tile:
+            Tile (row_start, row_end, col_start, col_end).
+        score_cutoff:
+            Score threshold (scores must be > score_cutoff). Default = None.
+        min_matches:
+            Minimum number of matching peaks. Default = None.
+        upper_triangle:
+            Set to True to only return pairs with row <= column. Default = False.
+
+        Returns:
+        --------
+        Array of shape (n_pairs, 2).
+        """
+        score_bounds, matches_bounds = self.tile(tile)
+        selected = np.ones(score_bounds.shape, dtype=bool)
+        if score_cutoff is not None:
+            selected &= _can_exceed(score_bounds, score_cutoff)
+        if min_matches is not None:
+            selected &= matches_bounds >= min_matches
+        n_pairs = selected.size
+        if upper_triangle:
+            in_triangle = np.arange(tile[0], tile[1]).reshape(-1, 1) <= np.arange(tile[2], tile[3]).reshape(1, -1)
+            selected &= in_triangle
+            n_pairs = int(in_triangle.sum())
+        rows, columns = np.nonzero(selected)
+        self._count(n_pairs, rows.shape[0])
+        return np.stack((rows + tile[0], columns + tile[2]), axis=1)
+
+    def prune_pairs(self, pairs: np.ndarray, score_cutoff: float = None,
+                    min_matches: int = None) -> np.ndarray:
+        """Return the given pairs (row, column) that can reach the thresholds."""
+        score_bounds = np.asarray(self.score_references[pairs[:, 0]].multiply(
+            self.score_queries[pairs[:, 1]]).sum(axis=1)).ravel()
+        matches_bounds = np.asarray(self.count_references[pairs[:, 0]].multiply(
+            self.count_queries[pairs[:, 1]]).sum(axis=1)).ravel()
+        matches_bounds = np.minimum(matches_bounds, np.minimum(self.n_peaks_references[pairs[:, 0]],
+                                                               self.n_peaks_queries[pairs[:, 1]]))
+        missing = self.missing_references[pairs[:, 0]] | self.missing_queries[pairs[:, 1]]
+        selected = np.ones(pairs.shape[0], dtype=bool)
+        if score_cutoff is not None:
+            selected &= _can_exceed(score_bounds, score_cutoff) | missing
+        if min_matches is not None:
+            selected &= (matches_bounds >= min_matches) | missing
+        self._count(pairs.shape[0], int(selected.sum()))
+        return pairs[selected]
+
+    def _count(self, n_pairs: int, n_selected: int):
+        self.n_pairs_checked += n_pairs
+        self.n_pairs_pruned += n_pairs - n_selected
+
+
+def _can_exceed(score_bounds: np.ndarray, score_cutoff: float) -> np.ndarray:
+    # Small margin for rounding differences to the exact score computation
+    return score_bounds * (1 + 1e-6) + 1e-12 > score_cutoff
+
+
+def _peak_bins(spectra: PackedSpectra, bin_width: float, shifted: bool) -> np.ndarray:
+    """Bin of every peak (followed by the bin of every peak relative to the precursor m/z)."""
+    bins = np.floor(spectra.mz / bin_width)
+    if shifted:
+        precursor_mz = np.repeat(np.nan_to_num(spectra.precursor_mz), np.diff(spectra.offsets))
+        bins = np.concatenate((bins, np.floor((spectra.mz - precursor_mz) / bin_width)))
+    return bins.astype(np.int64)
+
+
+def _peak_weights(spectra: PackedSpectra, similarity_function) -> np.ndarray:
+    """Peak weights (as in the cosine score), normalized per spectrum."""
+    weights = spectra.mz ** similarity_function.mz_power * spectra.intensities ** similarity_function.intensity_power
+    norms = np.sqrt(np.bincount(_spectrum_ids(spectra, False), weights ** 2, minlength=len(spectra)))
+    norms = np.repeat(norms, np.diff(spectra.offsets))
+    return np.divide(weights, norms, out=np.zeros_like(weights), where=norms > 0)
+
+
+def _spectrum_ids(spectra: PackedSpectra, shifted: bool) -> np.ndarray:
+    spectrum_ids = np.repeat(np.arange(len(spectra)), np.diff(spectra.offsets))
+    return np.tile(spectrum_ids, 2) if shifted else spectrum_ids
+
+
+def _bin_norms(spectra: PackedSpectra, weights: np.ndarray, bins: np.ndarray,
+               n_bins: int, shifted: bool) -> csr_matrix:
+    """Sparse matrix (spectrums x bins) with the norm of the peak weights in every bin."""
+    norms = csr_matrix((weights ** 2, (_spectrum_ids(spectra, shifted), bins)), shape=(len(spectra), n_bins))
+    norms.sum_duplicates()
+    norms.data = np.sqrt(norms.data)
+    return norms
+
+
+def _bin_counts(spectra: PackedSpectra, bins: np.ndarray, n_bins: int, shifted: bool) -> csr_matrix:
+    """Sparse matrix (spectrums x bins) with the number of peaks in every bin."""
+    counts = csr_matrix((np.ones(bins.shape[0], dtype=np.int64), (_spectrum_ids(spectra, shifted), bins)),
+                        shape=(len(spectra), n_bins))
+    counts.sum_duplicates()
+    return counts
+
+
+def _neighbour_sum(binned: csr_matrix) -> csr_matrix:
+    """Add the values of the left and right neighbour bin to every bin."""
+    binned = binned.tocoo()
+    summed = csr_matrix((np.tile(binned.data, 3),
+                         (np.tile(binned.row, 3), np.concatenate([binned.col + shift for shift in [-1, 0, 1]]))),
+                        shape=binned.shape)
+    summed.sum_duplicates()
+    return summed
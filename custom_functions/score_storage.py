@@ -0,0 +1,301 @@
+"""Storage formats for large (all-vs-all) score matrices."""
+import json
+import os
+from typing import Tuple
+import numpy as np
+
+
+class CondensedScoreMatrix:
+    """Symmetric all-vs-all score matrix stored as memory-mapped triangle.
+
+    Only one triangle (including the diagonal) of the scores and matches is
+    stored, scores as float32 and matches as uint16 by default. Compared to two
+    dense float64 arrays this needs about 8x less disk space/memory, and matrices
+    larger than the available RAM can be created and read. Rows, columns and blocks
+    are returned as dense (symmetric) arrays.
+
+    Entry (i, j) with j <= i is stored at position i * (i + 1) / 2 + j, which does
+    not depend on the number of spectrums. New spectrums can therefore be added by
+    appending their rows to the files (see extend() and extend_similarity_matrix()).
+
+    Stored on disk as a folder containing:
+        scores.bin          condensed triangle of the scores (raw array)
+        matches.bin         condensed triangle of the number of matches (raw array)
+        settings.json       number of spectrums, dtypes, similarity settings
+                            (see similarity_settings()) and content hash of the
+                            spectrums (see spectra_hash())
+
+    For example:
+
+    .. code-block:: python
+
+        score_matrix = CondensedScoreMatrix.create("modcos_matrix", n_spectrums=len(spectrums))
+        score_matrix.write_tile((0, 500, 0, 500), scores, matches)
+        score_matrix.flush()
+
+        score_matrix = CondensedScoreMatrix.open("modcos_matrix")
+        scores, matches = score_matrix.row(10)
+        scores, matches = score_matrix.block(slice(0, 100), slice(200, 300))
+    """
+    def __init__(self, scores: np.ndarray, matches: np.ndarray, n_spectrums: int,
+                 folder: str = None,
+                 similarity_settings: dict = None,
+                 spectra_hash: str = None):
+        """
+
+        Args:
+        --------
+        scores:
+            Condensed triangle of the scores (n_spectrums * (n_spectrums + 1) / 2).
+        matches:
+            Condensed triangle of the number of matching peaks.
+        n_spectrums:
+            Number of rows and columns of the full matrix.
+        folder:
+            Folder the matrix is stored in (None for in-memory matrices).
+        similarity_settings:
+            Class name and parameters of the similarity function. Default = None.
+        spectra_hash:
+            Content hash of the spectrums of the matrix. Default = None.
+        """
+        assert scores.shape == matches.shape == (n_spectrums * (n_spectrums + 1) // 2,), \
+            "Expected condensed triangle of scores and matches."
+        self.scores = scores
+        self.matches = matches
+        self.n_spectrums = n_spectrums
+        self.folder = folder
+        self.similarity_settings = similarity_settings
+        self.spectra_hash = spectra_hash
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.n_spectrums, self.n_spectrums
+
+    @classmethod
+    def create(cls, folder: str, n_spectrums: int,
+               score_dtype: str = "float32",
+               matches_dtype: str = "uint16",
+               similarity_settings: dict = None,
+               spectra_hash: str = None):
+        """Create new (zero-filled) matrix in folder (will be created if needed)."""
+        os.makedirs(folder, exist_ok=True)
+        for name, dtype in [("scores", score_dtype), ("matches", matches_dtype)]:
+            with open(os.path.join(folder, name + ".bin"), "wb") as f:
+                f.truncate(_n_entries(n_spectrums) * np.dtype(dtype).itemsize)
+        _write_settings(folder, {"n_spectrums": n_spectrums, "score_dtype": score_dtype,
+                                 "matches_dtype": matches_dtype,
+                                 "similarity_settings": similarity_settings,
+                                 "spectra_hash": spectra_hash})
+        return cls.open(folder, mode="r+")
+
+    @classmethod
+    def open(cls, folder: str, mode: str = "r"):
+        """Open existing matrix. Use mode="r+" to allow writing."""
+        with open(os.path.join(folder, "settings.json"), "r") as f:
+            settings = json.load(f)
+        n_entries = _n_entries(settings["n_spectrums"])
+        return cls(np.memmap(os.path.join(folder, "scores.bin"), dtype=settings["score_dtype"],
+                             mode=mode, shape=(n_entries,)),
+                   np.memmap(os.path.join(folder, "matches.bin"), dtype=settings["matches_dtype"],
+                             mode=mode, shape=(n_entries,)),
+                   settings["n_spectrums"], folder=folder,
+                   similarity_settings=settings.get("similarity_settings"),
+                   spectra_hash=settings.get("spectra_hash"))
+
+    def extend(self, n_spectrums: int, spectra_hash: str = None):
+        """Return matrix (opened for writing) with rows for n_spectrums spectrums.
+
+        Existing entries are kept and the rows of the new spectrums are appended
+        (zero-filled). The new size (and spectra_hash of all spectrums) is only
+        recorded in settings.json by flush(), so that an interrupted extension
+        leaves the stored matrix unchanged.
+        """
+        assert self.folder is not None, "Only stored matrices can be extended."
+        assert n_spectrums >= self.n_spectrums, "Matrix cannot be reduced in size."
+        for array, name in [(self.scores, "scores"), (self.matches, "matches")]:
+            with open(os.path.join(self.folder, name + ".bin"), "r+b") as f:
+                f.truncate(_n_entries(n_spectrums) * array.dtype.itemsize)
+        n_entries = _n_entries(n_spectrums)
+        return CondensedScoreMatrix(
+            np.memmap(os.path.join(self.folder, "scores.bin"), dtype=self.scores.dtype, mode="r+",
+                      shape=(n_entries,)),
+            np.memmap(os.path.join(self.folder, "matches.bin"), dtype=self.matches.dtype, mode="r+",
+                      shape=(n_entries,)),
+            n_spectrums, folder=self.folder, similarity_settings=self.similarity_settings,
+            spectra_hash=spectra_hash)
+
+    def flush(self):
+        """Write changes (and the number of spectrums) to disk."""
+        for array in [self.scores, self.matches]:
+            if isinstance(array, np.memmap):
+                array.flush()
+        if self.folder is not None:
+            _write_settings(self.folder, {"n_spectrums": self.n_spectrums,
+                                          "score_dtype": self.scores.dtype.name,
+                                          "matches_dtype": self.matches.dtype.name,
+                                          "similarity_settings": self.similarity_settings,
+                                          "spectra_hash": self.spectra_hash})
+
+    def write_tile(self, tile: Tuple[int, int, int, int], scores: np.ndarray, matches: np.ndarray):
+        """Store upper triangle part (row <= column) of a tile (row_start, row_end, col_start, col_end)."""
+        row_start, row_end, col_start, col_end = tile
+        if np.issubdtype(self.matches.dtype, np.integer):
+            assert np.max(matches, initial=0) <= np.iinfo(self.matches.dtype).max, \
+                "Number of matches too large for matches dtype."
+        # Entries (row, j) with row <= j are stored contiguously for every column j
+        for j in range(max(col_start, row_start), col_end):
+            last_row = min(row_end, j + 1)
+            position = self._offset(j) + row_start
+            self.scores[position:(position + last_row - row_start)] = scores[:(last_row - row_start), j - col_start]
+            self.matches[position:(position + last_row - row_start)] = matches[:(last_row - row_start), j - col_start]
+
+    def row(self, i: int):
+        """Return scores and matches of row (or column) i of the full matrix."""
+        higher = np.arange(i + 1, self.n_spectrums)
+        positions = np.concatenate((np.arange(self._offset(i), self._offset(i) + i + 1),
+                                    self._offset(higher) + i))
+        return np.asarray(self.scores[positions]), np.asarray(self.matches[positions])
+
+    def block(self, rows: slice, columns: slice):
+        """Return scores and matches of block [rows, columns] of the full matrix.
+
+        Stored entries are read as contiguous runs: per row i the entries with
+        column <= i, and per column j the entries with row < j. No index array
+        of the size of the block is needed.
+        """
+        row_range = range(self.n_spectrums)[rows]
+        column_range = range(self.n_spectrums)[columns]
+        if row_range.step != 1 or column_range.step != 1:
+            row_ids = np.arange(self.n_spectrums)[rows].reshape(-1, 1)
+            column_ids = np.arange(self.n_spectrums)[columns].reshape(1, -1)
+            positions = self._offset(np.maximum(row_ids, column_ids)) + np.minimum(row_ids, column_ids)
+            return np.asarray(self.scores[positions]), np.asarray(self.matches[positions])
+
+        row_start, row_end = row_range.start, row_range.start + len(row_range)
+        col_start, col_end = column_range.start, column_range.start + len(column_range)
+        scores = np.zeros((len(row_range), len(column_range)), dtype=self.scores.dtype)
+        matches = np.zeros((len(row_range), len(column_range)), dtype=self.matches.dtype)
+        # Entries (i, j) with j <= i are stored contiguously for every row i
+        for i in range(max(row_start, col_start), row_end):
+            stored = slice(self._offset(i) + col_start, self._offset(i) + min(col_end, i + 1))
+            n_stored = stored.stop - stored.start
+            scores[i - row_start, :n_stored] = self.scores[stored]
+            matches[i - row_start, :n_stored] = self.matches[stored]
+        # Entries (i, j) with i < j are stored contiguously for every column j
+        for j in range(max(col_start, row_start + 1), col_end):
+            stored = slice(self._offset(j) + row_start, self._offset(j) + min(row_end, j))
+            n_stored = stored.stop - stored.start
+            scores[:n_stored, j - col_start] = self.scores[stored]
+            matches[:n_stored, j - col_start] = self.matches[stored]
+        return scores, matches
+
+    def to_dense(self):
+        """Return full scores and matches matrices (only for small matrices)."""
+        return self.block(slice(None), slice(None))
+
+    @staticmethod
+    def _offset(i):
+        """Position of entry (i, 0) in the condensed arrays."""
+        return i * (i + 1) // 2
+
+
+def _n_entries(n_spectrums: int) -> int:
+    return n_spectrums * (n_spectrums + 1) // 2
+
+
+def _write_settings(folder: str, settings: dict):
+    temp_filename = os.path.join(folder, "settings_temp.json")
+    with open(temp_filename, "w") as f:
+        json.dump(settings, f)
+    os.replace(temp_filename, os.path.join(folder, "settings.json"))
+
+
+class SparseScoreMatrix:
+    """Sparse score matrix in compressed sparse row (CSR) format.
+
+    Entries of row i are indices[indptr[i]:indptr[i+1]] (sorted), with their
+    scores and matches at the same positions.
+
+    For example:
+
+    .. code-block:: python
+
+        score_matrix = all_vs_all_similarity_matrix(spectrums, ModifiedCosine(),
+                                                    score_cutoff=0.7, min_matches=6)
+        columns, scores, matches = score_matrix.row(10)
+        score_matrix.save("modcos_sparse.npz")
+    """
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray,
+                 scores: np.ndarray, matches: np.ndarray,
+                 shape: Tuple[int, int]):
+        """
+
+        Args:
+        --------
+        indptr:
+            Entries of row i are stored at positions indptr[i] to indptr[i+1].
+        indices:
+            Column index of every entry.
+        scores:
+            Score of every entry.
+        matches:
+            Number of matching peaks of every entry.
+        shape:
+            Shape (n_rows, n_columns) of the full matrix.
+        """
+        assert indptr.shape[0] == shape[0] + 1, "Expected one indptr entry per row (+1)."
+        assert indices.shape == scores.shape == matches.shape, "Expected one score and matches per entry."
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        self.matches = matches
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    @classmethod
+    def from_coo(cls, rows: np.ndarray, columns: np.ndarray,
+                 scores: np.ndarray, matches: np.ndarray,
+                 shape: Tuple[int, int]):
+        """Create from arrays with row, column, score and matches of all entries."""
+        order = np.lexsort((columns, rows))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=shape[0]))))
+        return cls(indptr.astype(np.int64), np.asarray(columns)[order],
+                   np.asarray(scores)[order], np.asarray(matches)[order], shape)
+
+    def row(self, i: int):
+        """Return column indices, scores and matches of all entries in row i."""
+        entries = slice(self.indptr[i], self.indptr[i + 1])
+        return self.indices[entries], self.scores[entries], self.matches[entries]
+
+    def to_coo(self):
+        """Return rows, columns, scores and matches of all entries."""
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return rows, self.indices, self.scores, self.matches
+
+    def to_dense(self):
+        """Return dense scores and matches arrays (missing entries are 0)."""
+        rows, columns, _, _ = self.to_coo()
+        scores = np.zeros(self.shape, dtype=self.scores.dtype)
+        matches = np.zeros(self.shape, dtype=self.matches.dtype)
+        scores[rows, columns] = self.scores
+        matches[rows, columns] = self.matches
+        return scores, matches
+
+    def to_scipy(self, field: str = "scores"):
+        """Return scores (or matches with field="matches") as scipy.sparse.csr_matrix."""
+        from scipy.sparse import csr_matrix  # pylint: disable=import-outside-toplevel
+        return csr_matrix((getattr(self, field), self.indices, self.indptr), shape=self.shape)
+
+    def save(self, filename: str):
+        """Store all arrays in a numpy .npz file."""
+        np.savez(filename, indptr=self.indptr, indices=self.indices, scores=self.scores,
+                 matches=self.matches, shape=np.array(self.shape))
+
+    @classmethod
+    def load(cls, filename: str):
+        """Load SparseScoreMatrix from .npz file created by SparseScoreMatrix.save()."""
+        with np.load(filename, allow_pickle=False) as data:
+            return cls(data["indptr"], data["indices"], data["scores"], data["matches"],
+                       tuple(data["shape"]))
@@ -0,0 +1,300 @@
+"""Long-lived local library search service with micro-batching of requests."""
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Union
+from urllib import request as urllib_request
+import numpy as np
+from gensim.models.basemodel import BaseTopicModel
+from matchms import Spectrum
+from spec2vec import SpectrumDocument
+from custom_functions.library_index import LibraryIndex
+from custom_functions.library_search import _get_setting, library_matching, requires_peak_scores
+from custom_functions.parallel_scoring import ScoringPool
+
+
+class LibrarySearchService:
+    """Keep model and library in memory and answer library_matching() requests.
+
+    Library embeddings are computed once (as LibraryIndex). If (modified) cosine
+    scores are needed, the library peaks are also packed once and kept in the
+    workers of a ScoringPool, which is used for all requests. Requests that arrive
+    concurrently (from threads or via HTTP) are coalesced into micro-batches of
+    up to max_batch_size queries, which are then processed by a single
+    library_matching() call. If a batch fails, its requests are processed one by
+    one, so that an error only reaches the request that caused it. Latency and
+    batch size of the most recent statistics_window requests are kept for
+    statistics(). Progress bars and messages of library_matching() are not shown.
+
+    For example:
+
+    .. code-block:: python
+
+        service = LibrarySearchService(documents_library, model,
+                                       presearch_based_on=["precursor_mz", "spec2vec-top10"],
+                                       allowed_missing_percentage=5.0)
+        url = service.serve(port=8765)  # http://127.0.0.1:8765
+
+        # From another process/job
+        found_matches = search_remote(url, spectrums_query)
+
+        service.close()
+    """
+    def __init__(self, documents_library: Union[List[SpectrumDocument], LibraryIndex],
+                 model: BaseTopicModel,
+                 max_batch_size: int = 100,
+                 max_wait: float = 0.01,
+                 n_decimals: int = 2,
+                 statistics_window: int = 10000,
+                 **settings):
+        """
+
+        Args:
+        --------
+        documents_library:
+            List containing all library spectrum documents, or LibraryIndex
+            (with documents if cosine or modified cosine scores are needed).
+        model:
+            Pretrained word2Vec model.
+        max_batch_size:
+            Maximum number of queries to process in one batch. Default = 100.
+        max_wait:
+            Time (in s) to wait for more requests before a batch is started.
+            Default = 0.01.
+        n_decimals:
+            Peak positions of query spectrums are rounded to n_decimals when
+            creating SpectrumDocuments (must be the same as for the library).
+            Default = 2.
+        statistics_window:
+            Number of most recent requests to keep latency and batch size of.
+            Default = 10000.
+        settings:
+            Further arguments for library_matching() (e.g. presearch_based_on,
+            include_scores, intensity_weighting_power, allowed_missing_percentage).
+        """
+        if not isinstance(documents_library, LibraryIndex):
+            documents_library = LibraryIndex.build(documents_library, model,
+                                                   _get_setting(settings, "intensity_weighting_power"),
+                                                   _get_setting(settings, "allowed_missing_percentage"),
+                                                   progress_bar=False)
+        assert "output_format" not in settings, "Output format is set by the service."
+        assert "progress_bar" not in settings, "Progress bars are not shown by the service."
+        self.library_index = documents_library
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.n_decimals = n_decimals
+        self.settings = settings
+        self.scoring_pool = None
+        if requires_peak_scores(settings):
+            library_spectra = self.library_index.packed_spectra(_get_setting(settings, "ignore_non_annotated"))
+            # Workers are started from the batching thread (HTTP server threads may be running)
+            self.scoring_pool = ScoringPool(library_spectra, n_jobs=_get_setting(settings, "n_jobs"),
+                                            mp_context="spawn")
+        self.n_requests = 0
+        self.latencies = deque(maxlen=statistics_window)
+        self.batch_sizes = deque(maxlen=statistics_window)
+        self._statistics_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._server = None
+        self._worker = threading.Thread(target=self._process_requests, daemon=True)
+        self._worker.start()
+
+    def search(self, spectrums_query: List[Union[Spectrum, SpectrumDocument]]) -> list:
+        """Search library for the given query spectrums (blocks until done).
+
+        Returns a list with one pandas.DataFrame of candidates (or empty list) per
+        query, as returned by library_matching().
+        """
+        return self.submit(spectrums_query).result()["matches"]
+
+    def submit(self, spectrums_query: List[Union[Spectrum, SpectrumDocument]]) -> Future:
+        """Add search request to the queue.
+
+        Returns a Future with result dictionary containing "matches" (as from
+        search()), "latency" (in s) and "batch_size" (number of queries in the
+        batch that included this request).
+        """
+        documents = [x if isinstance(x, SpectrumDocument) else SpectrumDocument(x, n_decimals=self.n_decimals)
+                     for x in spectrums_query]
+        future = Future()
+        self._requests.put((documents, future, time.time()))
+        return future
+
+    def statistics(self) -> dict:
+        """Return number of requests, and batch sizes and latencies (in ms) of the
+        most recent statistics_window requests."""
+        with self._statistics_lock:
+            n_requests = self.n_requests
+            latencies = 1000 * np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+        if latencies.shape[0] == 0:
+            return {"n_requests": n_requests}
+        return {"n_requests": n_requests,
+                "mean_batch_size": float(batch_sizes.mean()),
+                "max_batch_size": int(batch_sizes.max()),
+                "latency_mean_ms": float(latencies.mean()),
+                "latency_p50_ms": float(np.percentile(latencies, 50)),
+                "latency_p95_ms": float(np.percentile(latencies, 95)),
+                "latency_max_ms": float(latencies.max())}
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start HTTP server (in background thread) and return its url.
+
+        Endpoints:
+            POST /search    JSON {"spectrums": [{"mz": [...], "intensities": [...],
+                            "metadata": {...}}, ...]}, returns JSON with "matches"
+                            (list of candidate records per query), "latency_ms"
+                            and "batch_size".
+            GET /statistics Returns statistics() as JSON.
+
+        Use port=0 to select a free port.
+        """
+        assert self._server is None, "Service is already running."
+        self._server = ThreadingHTTPServer((host, port), _make_request_handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def close(self):
+        """Stop HTTP server (if running) and request processing."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self._requests.put(None)
+        self._worker.join()
+        if self.scoring_pool is not None:
+            self.scoring_pool.close()
+
+    def _next_batch(self):
+        """Wait for next request and collect further requests up to max_batch_size."""
+        first_request = self._requests.get()
+        if first_request is None:
+            return None
+        batch = [first_request]
+        n_queries = len(first_request[0])
+        deadline = time.time() + self.max_wait
+        while n_queries < self.max_batch_size:
+            try:
+                next_request = self._requests.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if next_request is None:
+                # Finish current batch first
+                self._requests.put(None)
+                break
+            batch.append(next_request)
+            n_queries += len(next_request[0])
+        return batch
+
+    def _process_requests(self):
+        """Run library_matching() on micro-batches until the service is closed."""
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._process_batch(batch)
+            except Exception as error:  # pylint: disable=broad-except
+                if len(batch) == 1:
+                    batch[0][1].set_exception(error)
+                    continue
+                # Re-run requests one by one, so that only the failing request gets the error
+                for single_request in batch:
+                    try:
+                        self._process_batch([single_request])
+                    except Exception as single_error:  # pylint: disable=broad-except
+                        single_request[1].set_exception(single_error)
+
+    def _process_batch(self, batch):
+        """Run library_matching() on all queries of the batch and set the results."""
+        documents_batch = [document for documents, _, _ in batch for document in documents]
+        found_matches = library_matching(documents_batch, self.library_index, self.model,
+                                         output_format="columnar", scoring_pool=self.scoring_pool,
+                                         progress_bar=False, **self.settings)
+        query_start = 0
+        for documents, future, start_time in batch:
+            matches = [found_matches[i] for i in range(query_start, query_start + len(documents))]
+            query_start += len(documents)
+            latency = time.time() - start_time
+            with self._statistics_lock:
+                self.n_requests += 1
+                self.latencies.append(latency)
+                self.batch_sizes.append(len(documents_batch))
+            future.set_result({"matches": matches,
+                               "latency": latency,
+                               "batch_size": len(documents_batch)})
+
+
+def search_remote(url: str, spectrums_query: List[Spectrum], timeout: float = 600) -> list:
+    """Send query spectrums to a running LibrarySearchService.
+
+    Returns a list with one list of candidate records (dictionaries with
+    library_id and scores) per query.
+    """
+    spectrums = [{"mz": s.peaks.mz.tolist(),
+                  "intensities": s.peaks.intensities.tolist(),
+                  "metadata": s.metadata} for s in spectrums_query]
+    data = json.dumps({"spectrums": spectrums}).encode("utf-8")
+    search_request = urllib_request.Request(url + "/search", data=data,
+                                            headers={"Content-Type": "application/json"})
+    with urllib_request.urlopen(search_request, timeout=timeout) as response:
+        return json.loads(response.read())["matches"]
+
+
+def _make_request_handler(service: LibrarySearchService):
+    """Create HTTP request handler class for given service."""
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/statistics":
+                self.send_error(404)
+                return
+            self._send_json(service.statistics())
+
+        def do_POST(self):
+            if self.path != "/search":
+                self.send_error(404)
+                return
+            try:
+                content = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                spectrums = [Spectrum(mz=np.array(x["mz"], dtype="float"),
+                                      intensities=np.array(x["intensities"], dtype="float"),
+                                      metadata=x.get("metadata", {}))
+                             for x in content["spectrums"]]
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_error(400, str(error))
+                return
+            try:
+                result = service.submit(spectrums).result()
+            except Exception as error:  # pylint: disable=broad-except
+                self.send_error(500, str(error))
+                return
+            self._send_json({"matches": [_to_records(x) for x in result["matches"]],
+                             "latency_ms": 1000 * result["latency"],
+                             "batch_size": result["batch_size"]})
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+        def _send_json(self, content):
+            data = json.dumps(content).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return RequestHandler
+
+
+def _to_records(matches) -> list:
+    """Convert candidates DataFrame (or empty list) to list of JSON-compatible dicts."""
+    if len(matches) == 0:
+        return []
+    return json.loads(matches.rename_axis("library_id").reset_index().to_json(orient="records"))
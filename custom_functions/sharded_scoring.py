@@ -0,0 +1,296 @@
+"""Sharded all-vs-all computation with a file-based work queue.
+
+A planner writes the tiles of the upper triangle (see make_upper_triangle_tiles())
+together with the spectrums and the similarity function to a shared folder (e.g.
+on a network file system). Any number of worker processes, on any number of
+hosts, then claim tiles by atomically creating lock files and store every
+finished tile as separate .npz file. When all tiles are finished, they can be
+merged into a (dense, condensed or sparse) score matrix with
+all_vs_all_similarity_matrix(..., shared_folder=...).
+
+Start a worker (e.g. on another host) with:
+
+    python -m custom_functions.sharded_scoring /shared/modcos_queue
+
+Shared folder layout:
+    manifest.json           number of spectrums, tile size, all tiles, similarity
+                            parameters and content hash of the spectrums
+    spectrums.pickle        spectrums and similarity function
+    locks/                  one lock file per claimed tile
+    tiles/                  one .npz file (scores, matches) per finished tile
+"""
+import argparse
+import json
+import os
+import pickle
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import List, Tuple
+import numpy as np
+from custom_functions.packed_spectra import spectra_hash
+from custom_functions.parallel_scoring import iter_scored_tiles, make_upper_triangle_tiles
+from custom_functions.similarity_functions import similarity_settings
+
+
+class ShardedTileQueue:
+    """Tiles of an all-vs-all score matrix in a shared folder, claimed via lock files.
+
+    A tile is claimed by creating its lock file with os.open(..., O_CREAT | O_EXCL),
+    which only succeeds for one process. Finished tiles are first written to a
+    temporary file and then moved to their final name, so a tile file is either
+    complete or missing. While a worker computes a tile, it refreshes the
+    modification time of the lock every heartbeat_interval seconds. Locks that
+    were not refreshed for lock_timeout seconds (of crashed workers) can be taken
+    over (this relies on synchronized clocks of all hosts), so lock_timeout
+    should be several times the heartbeat_interval. If a worker is stalled for
+    longer than lock_timeout, a tile can be computed twice, which gives the same
+    result.
+
+    For example:
+
+    .. code-block:: python
+
+        queue = ShardedTileQueue.create("/shared/modcos_queue", spectrums, ModifiedCosine(),
+                                        tile_size=(500, 500))
+        # On every host (any number of times):
+        ShardedTileQueue.open("/shared/modcos_queue").run_worker()
+        # When all workers are done:
+        score_matrix = all_vs_all_similarity_matrix(spectrums, ModifiedCosine(), n_jobs=0,
+                                                    shared_folder="/shared/modcos_queue",
+                                                    output_folder="modcos_matrix")
+    """
+    def __init__(self, folder: str, n_spectrums: int,
+                 tile_size: Tuple[int, int],
+                 tiles: List[Tuple[int, int, int, int]],
+                 similarity_function: str = None):
+        """
+
+        Args:
+        --------
+        folder:
+            Shared folder of the queue.
+        n_spectrums:
+            Number of spectrums (matrix rows and columns).
+        tile_size:
+            Tile size as (number of rows, number of columns).
+        tiles:
+            List of all tiles (row_start, row_end, col_start, col_end).
+        similarity_function:
+            Name of the similarity function. Default = None.
+        """
+        self.folder = folder
+        self.n_spectrums = n_spectrums
+        self.tile_size = tuple(tile_size)
+        self.tiles = [tuple(tile) for tile in tiles]
+        self.similarity_function = similarity_function
+
+    @classmethod
+    def create(cls, folder: str, spectrums, similarity_function,
+               tile_size: Tuple[int, int] = (500, 500)):
+        """Write manifest, spectrums and similarity function to folder (planner).
+
+        If the folder already contains a queue with the same settings, this queue
+        is returned (and finished tiles are kept).
+        """
+        manifest = {"n_spectrums": len(spectrums),
+                    "tile_size": list(tile_size),
+                    "similarity_function": similarity_function.__class__.__name__,
+                    "similarity_settings": similarity_settings(similarity_function),
+                    "spectra_hash": spectra_hash(spectrums)}
+        manifest_file = os.path.join(folder, "manifest.json")
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as f:
+                existing_manifest = json.load(f)
+            assert {key: existing_manifest.get(key) for key in manifest} == manifest, \
+                "Shared folder belongs to a computation with different settings."
+            return cls.open(folder)
+        for subfolder in ["locks", "tiles"]:
+            os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
+        _write_atomic(os.path.join(folder, "spectrums.pickle"),
+                      pickle.dumps((spectrums, similarity_function)))
+        manifest["tiles"] = make_upper_triangle_tiles(len(spectrums), tile_size)
+        # Manifest is written last: workers only start when everything else exists
+        _write_atomic(manifest_file, json.dumps(manifest).encode())
+        return cls(folder, manifest["n_spectrums"], tile_size, manifest["tiles"],
+                   manifest["similarity_function"])
+
+    @classmethod
+    def open(cls, folder: str):
+        """Open existing queue (e.g. on a worker host)."""
+        with open(os.path.join(folder, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        return cls(folder, manifest["n_spectrums"], manifest["tile_size"], manifest["tiles"],
+                   manifest["similarity_function"])
+
+    def load_spectrums(self):
+        """Return spectrums and similarity function stored by the planner."""
+        with open(os.path.join(self.folder, "spectrums.pickle"), "rb") as f:
+            return pickle.load(f)
+
+    def is_finished(self, tile: Tuple[int, int, int, int]) -> bool:
+        return os.path.exists(self._tile_filename(tile))
+
+    def missing_tiles(self) -> List[Tuple[int, int, int, int]]:
+        """Return all tiles that are not finished yet."""
+        return [tile for tile in self.tiles if not self.is_finished(tile)]
+
+    def claim(self, tile: Tuple[int, int, int, int], lock_timeout: float = None) -> bool:
+        """Try to claim a tile. Returns True if this process should compute it.
+
+        Args:
+        --------
+        tile:
+            Tile (row_start, row_end, col_start, col_end).
+        lock_timeout:
+            If given, locks that were not refreshed for lock_timeout seconds (of
+            crashed workers) are taken over. Default = None.
+        """
+        if self.is_finished(tile):
+            return False
+        lock_filename = self._lock_filename(tile)
+        if lock_timeout is not None and _is_stale(lock_filename, lock_timeout):
+            # Renaming succeeds for only one process, the others get FileNotFoundError
+            try:
+                stale_filename = f"{lock_filename}.{uuid.uuid4().hex}.stale"
+                os.rename(lock_filename, stale_filename)
+                os.remove(stale_filename)
+            except FileNotFoundError:
+                return False
+        try:
+            file_descriptor = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(file_descriptor, "w") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}, f)
+        # Tile might have been finished by the previous owner of a stale lock
+        return not self.is_finished(tile)
+
+    def add(self, tile: Tuple[int, int, int, int], scores: np.ndarray, matches: np.ndarray):
+        """Store scores and matches of a finished tile."""
+        filename = self._tile_filename(tile)
+        temp_filename = filename[:-4] + f"_{uuid.uuid4().hex}_temp.npz"
+        np.savez(temp_filename, scores=scores, matches=matches)
+        os.replace(temp_filename, filename)
+
+    def iter_tiles(self):
+        """Yield (tile, scores, matches) for all tiles (all tiles must be finished)."""
+        missing = self.missing_tiles()
+        assert not missing, f"{len(missing)} of {len(self.tiles)} tiles are not finished yet."
+        for tile in self.tiles:
+            with np.load(self._tile_filename(tile)) as data:
+                yield tile, data["scores"], data["matches"]
+
+    def run_worker(self, max_tiles: int = None, lock_timeout: float = None,
+                   heartbeat_interval: float = 60) -> int:
+        """Claim and compute tiles until no unclaimed tiles are left.
+
+        Args:
+        --------
+        max_tiles:
+            Stop after computing max_tiles tiles. Default = None.
+        lock_timeout:
+            Take over locks that were not refreshed for lock_timeout seconds.
+            Default = None.
+        heartbeat_interval:
+            Seconds between refreshes of the lock of the tile that is being
+            computed. Default = 60.
+
+        Returns:
+        --------
+        Number of computed tiles.
+        """
+        spectrums, similarity_function = self.load_spectrums()
+        n_computed = 0
+        for tile in self.tiles:
+            if max_tiles is not None and n_computed >= max_tiles:
+                break
+            if not self.claim(tile, lock_timeout=lock_timeout):
+                continue
+            with _refresh_lock(self._lock_filename(tile), heartbeat_interval):
+                for _, scores, matches in iter_scored_tiles(spectrums, spectrums, similarity_function,
+                                                            [tile], n_jobs=1, upper_triangle=True):
+                    self.add(tile, scores, matches)
+            n_computed += 1
+        return n_computed
+
+    def wait(self, poll_interval: float = 10, timeout: float = None):
+        """Wait until all tiles are finished (e.g. by workers on other hosts)."""
+        start_time = time.time()
+        while True:
+            n_missing = len(self.missing_tiles())
+            if n_missing == 0:
+                return
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TimeoutError(f"{n_missing} of {len(self.tiles)} tiles are not finished.")
+            print("\r", f"Waiting for {n_missing} of {len(self.tiles)} tiles.", end="")
+            time.sleep(poll_interval)
+
+    def _tile_filename(self, tile: Tuple[int, int, int, int]) -> str:
+        return os.path.join(self.folder, "tiles", "tile_{}_{}_{}_{}.npz".format(*tile))
+
+    def _lock_filename(self, tile: Tuple[int, int, int, int]) -> str:
+        return os.path.join(self.folder, "locks", "tile_{}_{}_{}_{}.lock".format(*tile))
+
+
+def run_worker(shared_folder: str, max_tiles: int = None, lock_timeout: float = None,
+               heartbeat_interval: float = 60) -> int:
+    """Open queue in shared_folder and compute tiles (see ShardedTileQueue.run_worker())."""
+    return ShardedTileQueue.open(shared_folder).run_worker(max_tiles=max_tiles, lock_timeout=lock_timeout,
+                                                           heartbeat_interval=heartbeat_interval)
+
+
+def _is_stale(lock_filename: str, lock_timeout: float) -> bool:
+    try:
+        return time.time() - os.path.getmtime(lock_filename) > lock_timeout
+    except FileNotFoundError:
+        return False
+
+
+@contextmanager
+def _refresh_lock(lock_filename: str, heartbeat_interval: float):
+    """Refresh modification time of the lock file in a background thread."""
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(heartbeat_interval):
+            try:
+                os.utime(lock_filename)
+            except FileNotFoundError:
+                # Lock was taken over by another worker
+                return
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _write_atomic(filename: str, content: bytes):
+    temp_filename = f"{filename}.{uuid.uuid4().hex}.temp"
+    with open(temp_filename, "wb") as f:
+        f.write(content)
+    os.replace(temp_filename, filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute tiles of a sharded all-vs-all score matrix.")
+    parser.add_argument("shared_folder", help="Shared folder created by ShardedTileQueue.create().")
+    parser.add_argument("--max-tiles", type=int, default=None, help="Stop after this many tiles.")
+    parser.add_argument("--lock-timeout", type=float, default=None,
+                        help="Take over locks that were not refreshed for this many seconds.")
+    parser.add_argument("--heartbeat-interval", type=float, default=60,
+                        help="Seconds between refreshes of the lock of the tile being computed.")
+    args = parser.parse_args(argv)
+    n_computed = run_worker(args.shared_folder, max_tiles=args.max_tiles, lock_timeout=args.lock_timeout,
+                            heartbeat_interval=args.heartbeat_interval)
+    print(f"Computed {n_computed} tiles.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Similarity functions that compute several (matchms) scores in one pass."""
+import json
+import numpy as np
+from matchms.similarity.spectrum_similarity_functions import collect_peak_pairs, score_best_matches
+from matchms.typing import SpectrumType
+
+
+class CosineAndModifiedCosine:
+    """Calculate CosineGreedy and ModifiedCosine score of a pair in one pass.
+
+    The modified cosine score uses all peak pairs of the cosine score (zero shift)
+    plus the peak pairs for the precursor m/z shift. Here the zero shift peak pairs
+    are only collected once and used for both scores. Scores and matches are the
+    same as from matchms' CosineGreedy and ModifiedCosine.
+
+    Can be used as similarity function in parallel_scoring.py and in
+    all_vs_all_similarity_matrix() (dense output), where scores and matches then
+    get an additional last axis of size 2 (cosine, modified cosine).
+
+    For example:
+
+    .. code-block:: python
+
+        score = CosineAndModifiedCosine(tolerance=0.005).pair(reference, query)
+        cosine_score, mod_cosine_score = score["score"]
+        cosine_matches, mod_cosine_matches = score["matches"]
+    """
+    score_names = ("cosine", "modified_cosine")
+    score_shape = (2,)
+    score_datatype = [("score", np.float64, (2,)), ("matches", "int", (2,))]
+
+    def __init__(self, tolerance: float = 0.1, mz_power: float = 0.0,
+                 intensity_power: float = 1.0):
+        """
+
+        Args:
+        --------
+        tolerance:
+            Peaks will be considered a match when <= tolerance apart. Default is 0.1.
+        mz_power:
+            The power to raise m/z to in the cosine function. Default is 0.
+        intensity_power:
+            The power to raise intensity to in the cosine function. Default is 1.
+        """
+        self.tolerance = tolerance
+        self.mz_power = mz_power
+        self.intensity_power = intensity_power
+
+    def pair(self, reference: SpectrumType, query: SpectrumType) -> np.ndarray:
+        """Return structured array with scores and matches (cosine, modified cosine)."""
+        scores, matches = cosine_and_modified_cosine(reference.peaks.to_numpy, query.peaks.to_numpy,
+                                                     _get_precursor_mz(reference), _get_precursor_mz(query),
+                                                     self.tolerance, self.mz_power, self.intensity_power)
+        return np.asarray((scores, matches), dtype=self.score_datatype)
+
+
+def similarity_settings(similarity_function) -> dict:
+    """Return class name and parameters (e.g. tolerance) of a similarity function as JSON-compatible dict.
+
+    Private attributes (starting with "_") are not considered parameters.
+    """
+    parameters = {key: value for key, value in vars(similarity_function).items() if not key.startswith("_")}
+    parameters = json.loads(json.dumps(parameters, default=str, sort_keys=True))
+    return {"name": similarity_function.__class__.__name__, "parameters": parameters}
+
+
+def cosine_and_modified_cosine(spec1: np.ndarray, spec2: np.ndarray,
+                               precursor_mz_1: float, precursor_mz_2: float,
+                               tolerance: float, mz_power: float = 0.0,
+                               intensity_power: float = 1.0):
+    """Compute cosine and modified cosine score of two peak arrays.
+
+    Returns:
+    --------
+    (cosine_score, mod_cosine_score), (cosine_matches, mod_cosine_matches)
+    """
+    zero_pairs = collect_peak_pairs(spec1, spec2, tolerance, shift=0.0,
+                                    mz_power=mz_power, intensity_power=intensity_power)
+    if zero_pairs is None:
+        zero_pairs = np.zeros((0, 3))
+    cosine_score, cosine_matches = greedy_score(zero_pairs, spec1, spec2, mz_power, intensity_power)
+
+    assert not (np.isnan(precursor_mz_1) or np.isnan(precursor_mz_2)), \
+        "Precursor_mz missing. Apply 'add_precursor_mz' filter first."
+    assert precursor_mz_1 > 0 and precursor_mz_2 > 0, "Expect precursor to be positive number."
+    nonzero_pairs = collect_peak_pairs(spec1, spec2, tolerance, shift=precursor_mz_1 - precursor_mz_2,
+                                       mz_power=mz_power, intensity_power=intensity_power)
+    if nonzero_pairs is not None:
+        mod_cosine_score, mod_cosine_matches = greedy_score(np.concatenate((zero_pairs, nonzero_pairs), axis=0),
+                                                            spec1, spec2, mz_power, intensity_power)
+    else:
+        mod_cosine_score, mod_cosine_matches = cosine_score, cosine_matches
+    return (cosine_score, mod_cosine_score), (cosine_matches, mod_cosine_matches)
+
+
+def greedy_score(matching_pairs: np.ndarray, spec1: np.ndarray, spec2: np.ndarray,
+                 mz_power: float = 0.0, intensity_power: float = 1.0):
+    """Greedy cosine score and matches for given (unsorted) matching peak pairs (as in matchms)."""
+    if matching_pairs.shape[0] == 0:
+        return 0.0, 0
+    matching_pairs = matching_pairs[np.argsort(matching_pairs[:, 2])[::-1], :]
+    return score_best_matches(matching_pairs, spec1, spec2, mz_power, intensity_power)
+
+
+def _get_precursor_mz(spectrum: SpectrumType) -> float:
+    precursor_mz = spectrum.get("precursor_mz")
+    return np.nan if precursor_mz is None else float(precursor_mz)
@@ -1,53 +1,660 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
 import numpy as np
+from custom_functions.packed_spectra import PackedSpectra, spectra_hash
+from custom_functions.parallel_scoring import iter_scored_tiles, make_tiles, make_upper_triangle_tiles, score_pairs
+from custom_functions.score_bounds import ScoreUpperBound
+from custom_functions.score_storage import CondensedScoreMatrix, SparseScoreMatrix
+from custom_functions.sharded_scoring import ShardedTileQueue, run_worker
+from custom_functions.similarity_functions import similarity_settings
+from custom_functions.top_n_selection import RunningTopN
 
 
 def all_vs_all_similarity_matrix(spectrums, similarity_function,
-                                 filename=None, safety_points=None):
+                                 filename=None, safety_points=None,
+                                 n_jobs: int = None,
+                                 tile_size: Tuple[int, int] = (500, 500),
+                                 checkpoint_folder: str = None,
+                                 output_folder: str = None,
+                                 score_cutoff: float = None,
+                                 min_matches: int = None,
+                                 top_n: int = None,
+                                 ignore_diagonal: bool = False,
+                                 max_precursor_difference: float = None,
+                                 precursor_windows: List[Tuple[float, float]] = None,
+                                 shared_folder: str = None,
+                                 lock_timeout: float = None,
+                                 wait_timeout: float = None,
+                                 poll_interval: float = 10,
+                                 prune_with_upper_bound: bool = False,
+                                 pruning_statistics: dict = None):
     """Calculate similarity matrix of all spectrums vs all spectrums.
 
+    The upper triangle of the matrix is split into tiles which are computed on a
+    process pool. Scores are the same as when calculating all pairs one by one.
+    If a checkpoint_folder is given, every finished tile is stored there (see
+    TileJournal), for sparse output only its selected entries. Running the
+    function again with the same checkpoint_folder (e.g. after a crash) only
+    computes the missing tiles.
+    If an output_folder is given, scores are written directly into a memory-mapped
+    CondensedScoreMatrix (one triangle only, float32 scores and uint16 matches)
+    instead of two dense float64 arrays, which allows matrices larger than RAM.
+    If score_cutoff, min_matches and/or top_n are given, only the selected entries
+    are kept and returned as SparseScoreMatrix. Without top_n this matrix is
+    symmetric. With top_n, row i holds the top_n entries of row i, so j can be in
+    the top_n of i without i being in the top_n of j.
+    With similarity_function=CosineAndModifiedCosine(...) cosine and modified cosine
+    scores are computed in one pass, similarities and num_matches then have an
+    additional last axis (cosine, modified cosine). Only for dense output.
+    If max_precursor_difference and/or precursor_windows are given, only pairs of
+    spectrums with a suitable precursor m/z difference are scored (see
+    precursor_window_pairs()) and the result is returned as SparseScoreMatrix.
+    With prune_with_upper_bound=True (requires score_cutoff and/or min_matches),
+    pairs whose cheap upper bound (see ScoreUpperBound) cannot reach the thresholds
+    are not scored. Returned entries are the same as without pruning.
+    If a shared_folder is given, tiles are computed via a file-based work queue
+    (see ShardedTileQueue) by n_jobs local worker processes plus any number of
+    workers on other hosts, and are merged when all tiles are finished.
+
     Args:
     ----
     spectrums
+        List of spectrums (or PackedSpectra, see packed_spectra.py).
     similarity_function
+        Matchms similarity function (e.g. CosineGreedy or ModifiedCosine).
     filename=None
+        If given, similarities and matches will be stored as numpy files (or as
+        .npz file for sparse output).
     safety_points=None
+        Number of times the intermediate results are saved (requires filename).
+    n_jobs=None
+        Number of worker processes. Set to None to use all available cores.
+    tile_size=(500, 500)
+        Number of rows and columns of the tiles.
+    checkpoint_folder=None
+        Folder to store finished tiles in, and to resume from.
+    output_folder=None
+        If given, return CondensedScoreMatrix stored in this folder (see
+        score_storage.py) instead of dense similarities and matches arrays.
+    score_cutoff=None
+        Only keep entries with score > score_cutoff (sparse output).
+    min_matches=None
+        Only keep entries with at least min_matches matching peaks (sparse output).
+    top_n=None
+        Only keep the top_n highest scores per row (sparse output, not symmetric).
+    ignore_diagonal=False
+        Set to True to not keep the diagonal (self-similarities) in sparse output.
+    max_precursor_difference=None
+        Only score pairs with a precursor m/z difference <= max_precursor_difference.
+    precursor_windows=None
+        Only score pairs with a precursor m/z difference within one of the given
+        (min_difference, max_difference) windows, e.g. [(0, 0.01), (13.99, 14.02)].
+    shared_folder=None
+        Folder (e.g. on a shared file system) for a sharded computation. Set
+        n_jobs=0 to only wait for other workers and merge their tiles.
+    lock_timeout=None
+        Local workers take over locks of a shared_folder that were not refreshed
+        for lock_timeout seconds, e.g. left by crashed workers (workers refresh
+        their lock every 60 s). Default = None (never take over locks).
+    wait_timeout=None
+        Raise TimeoutError if tiles of a shared_folder are still missing after
+        wait_timeout seconds. Default = None (wait until all tiles are finished).
+    poll_interval=10
+        Seconds between checks for finished tiles of a shared_folder.
+    prune_with_upper_bound=False
+        Set to True to skip pairs that cannot reach score_cutoff and min_matches
+        (only for CosineGreedy and ModifiedCosine, sparse output).
+    pruning_statistics=None
+        Dictionary to which the number of pairs checked by the upper bound
+        ("n_pairs_checked"), the number of pruned pairs ("n_pairs_pruned") and the
+        number of actually scored pairs ("n_pairs_scored") are added. Default = None.
     """
+    n_spectrums = len(spectrums)
+    score_shape = tuple(getattr(similarity_function, "score_shape", ()))
+    assert score_shape == () or (output_folder is None and score_cutoff is None and min_matches is None
+                                 and top_n is None and max_precursor_difference is None
+                                 and precursor_windows is None), \
+        "Similarity functions with several scores are only supported for dense output."
+    if max_precursor_difference is not None or precursor_windows is not None or prune_with_upper_bound:
+        assert output_folder is None and checkpoint_folder is None and safety_points is None \
+            and shared_folder is None, "Pair-wise scoring only supports in-memory sparse output."
+        assert top_n is None, "Top-n selection is not available for pair-wise scoring."
+        assert not prune_with_upper_bound or score_cutoff is not None or min_matches is not None, \
+            "Pruning with upper bounds requires score_cutoff and/or min_matches."
+        pairs = None
+        if max_precursor_difference is not None or precursor_windows is not None:
+            windows = [] if precursor_windows is None else list(precursor_windows)
+            if max_precursor_difference is not None:
+                windows.append((0, max_precursor_difference))
+            pairs = _precursor_window_pairs(spectrums, windows)
+        sparse_matrix = _sparse_pair_matrix(spectrums, similarity_function, pairs, n_jobs, tile_size,
+                                            score_cutoff, min_matches, ignore_diagonal,
+                                            prune_with_upper_bound, pruning_statistics)
+        if filename is not None:
+            sparse_matrix.save(filename)
+        return sparse_matrix
+
+    tiles = make_upper_triangle_tiles(n_spectrums, tile_size)
+    sparse_output = score_cutoff is not None or min_matches is not None or top_n is not None
+
+    if output_folder is not None:
+        assert filename is None, "Scores are stored in output_folder, filename is not used."
+        assert not sparse_output, "Sparse output cannot be stored in output_folder, use filename."
+        journal_exists = checkpoint_folder is not None and os.path.exists(checkpoint_folder)
+        if journal_exists and os.path.exists(os.path.join(output_folder, "settings.json")):
+            score_matrix = CondensedScoreMatrix.open(output_folder, mode="r+")
+        else:
+            score_matrix = CondensedScoreMatrix.create(output_folder, n_spectrums,
+                                                       similarity_settings=similarity_settings(similarity_function),
+                                                       spectra_hash=spectra_hash(spectrums))
+    elif sparse_output:
+        assert safety_points is None, "Safety points are not available for sparse output."
+        score_matrix = SparseTileCollector(n_spectrums, score_cutoff=score_cutoff, min_matches=min_matches,
+                                           top_n=top_n, ignore_diagonal=ignore_diagonal)
+    else:
+        score_matrix = DenseTileCollector(n_spectrums, score_shape)
+        if safety_points is not None:
+            # Save matrix along process
+            safety_interval = max(1, int(len(tiles)/safety_points))
+
+    journal = None
+    if checkpoint_folder is not None:
+        # Tiles of a CondensedScoreMatrix are already on disk
+        journal = TileJournal(checkpoint_folder, n_spectrums, tile_size,
+                              similarity_function=similarity_function,
+                              store_tiles=output_folder is None,
+                              spectra_hash=spectra_hash(spectrums),
+                              output_settings=score_matrix.settings() if sparse_output else None)
+        for tile, arrays in journal.load_tiles():
+            if sparse_output:
+                score_matrix.add_entries(tile, **arrays)
+            else:
+                score_matrix.write_tile(tile, arrays["scores"], arrays["matches"])
+        completed = journal.completed_tiles()
+        print(f"Found {len(completed)} of {len(tiles)} tiles in checkpoint folder.")
+        tiles = [tile for tile in tiles if tile not in completed]
+
+    if shared_folder is not None:
+        assert checkpoint_folder is None, "Finished tiles are already stored in shared_folder."
+        queue = ShardedTileQueue.create(shared_folder, spectrums, similarity_function, tile_size)
+        _run_local_workers(shared_folder, n_jobs, lock_timeout=lock_timeout)
+        queue.wait(poll_interval=poll_interval, timeout=wait_timeout)
+        scored_tiles = queue.iter_tiles()
+    else:
+        scored_tiles = iter_scored_tiles(spectrums, spectrums, similarity_function, tiles,
+                                         n_jobs=n_jobs, upper_triangle=True)
+
+    for count, (tile, scores, matches) in enumerate(scored_tiles):
+        if sparse_output:
+            # Only journal the selected entries instead of the dense tile
+            tile_arrays = score_matrix.select_entries(tile, scores, matches)
+            score_matrix.add_entries(tile, **tile_arrays)
+        else:
+            score_matrix.write_tile(tile, scores, matches)
+            tile_arrays = {"scores": scores, "matches": matches}
+        if journal is not None:
+            if output_folder is not None:
+                score_matrix.flush()
+            journal.add(tile, **tile_arrays)
+        # Show progress
+        print("\r", "About {:.3f}% of similarity scores calculated.".format(100 * (count + 1)/len(tiles)), end="")
+
+        # Create safety points
+        if filename is not None and safety_points is not None:
+            if (count+1) % safety_interval == 0:
+                safety_filename = filename.split(".")[0] + "safety"
+                np.save(safety_filename + ".npy", score_matrix.similarities)
+                np.save(safety_filename + "_matches.npy", score_matrix.num_matches)
+
+    if output_folder is not None:
+        score_matrix.flush()
+        return CondensedScoreMatrix.open(output_folder)
+
+    if sparse_output:
+        sparse_matrix = score_matrix.result()
+        if filename is not None:
+            sparse_matrix.save(filename)
+        return sparse_matrix
 
-    if safety_points is not None:
-        # Save matrix along process
-        total_num_calculations = int((len(spectrums)**2)/2 + 0.5 * len(spectrums))
-        safety_interval = int(total_num_calculations/safety_points)
-
-    similarities = np.zeros((len(spectrums), len(spectrums)))
-    num_matches = np.zeros((len(spectrums), len(spectrums)))
-
-    count = 0
-    for i in range(len(spectrums)):
-        for j in range(i, len(spectrums)):
-            score, matches = similarity_function.pair(spectrums[i], spectrums[j])
-            similarities[i, j] = score
-            num_matches[i, j] = matches
-            count += 1
-            # Show progress
-            if (count+1) % 10000 == 0:
-                print("\r", "About {:.3f}% of similarity scores calculated.".format(100 * count/total_num_calculations), end="")
-
-            # Create safety points
-            if filename is not None and safety_points is not None:
-                if (count+1) % safety_interval == 0:
-                    safety_filename = filename.split(".")[0] + "safety"
-                    np.save(safety_filename + ".npy", similarities)
-                    np.save(safety_filename + "_matches.npy", num_matches)
-
-    # Symmetric matrix --> fill
-    for i in range(1, len(spectrums)):
-        for j in range(i):
-            similarities[i, j] = similarities[j, i]
-            num_matches[i, j] = num_matches[j, i]
-
-     # Save final results
+    similarities, num_matches = score_matrix.result()
+
+    # Save final results
     if filename is not None:
         np.save(filename, similarities)
         np.save(filename.split(".")[0] + "_matches.npy", num_matches)
 
     return similarities, num_matches
+
+
+def extend_similarity_matrix(output_folder: str, spectrums, similarity_function,
+                             n_jobs: int = None,
+                             tile_size: Tuple[int, int] = (500, 500)) -> CondensedScoreMatrix:
+    """Add new spectrums to a CondensedScoreMatrix stored in output_folder.
+
+    The first spectrums must be the spectrums of the stored matrix (in the same
+    order), followed by the new spectrums, and the similarity function must be
+    the same as for the stored matrix (both are checked). Only the scores of the new spectrums
+    with all spectrums (new x old and new x new) are computed and appended to the
+    stored matrix, so the cost grows with the number of new spectrums and not
+    with the square of the total number of spectrums. If the extension is
+    interrupted, the stored matrix is unchanged and the extension can be repeated.
+
+    Args:
+    --------
+    output_folder:
+        Folder of a CondensedScoreMatrix, e.g. created by
+        all_vs_all_similarity_matrix(..., output_folder=output_folder).
+    spectrums:
+        List of all spectrums (or PackedSpectra), old spectrums first.
+    similarity_function:
+        Matchms similarity function, same as for the stored matrix.
+    n_jobs:
+        Number of worker processes. Set to None to use all available cores.
+    tile_size:
+        Number of rows and columns of the tiles.
+    """
+    score_matrix = CondensedScoreMatrix.open(output_folder)
+    n_stored = score_matrix.n_spectrums
+    n_spectrums = len(spectrums)
+    assert n_spectrums >= n_stored, "Expected all stored spectrums followed by the new spectrums."
+    if isinstance(spectrums, PackedSpectra):
+        stored_spectrums = spectrums.subset(np.arange(n_stored))
+    else:
+        stored_spectrums = spectrums[:n_stored]
+    assert score_matrix.similarity_settings == similarity_settings(similarity_function) \
+        and score_matrix.spectra_hash == spectra_hash(stored_spectrums), \
+        "Stored matrix belongs to a computation with different settings."
+    score_matrix = score_matrix.extend(n_spectrums, spectra_hash=spectra_hash(spectrums))
+
+    # Columns are the new spectrums, rows all spectrums (only rows <= column are scored)
+    tiles = [(row_start, row_end, col_start + n_stored, col_end + n_stored)
+             for row_start, row_end, col_start, col_end in make_tiles(n_spectrums, n_spectrums - n_stored,
+                                                                      tile_size)
+             if row_start < col_end + n_stored]
+    for tile, scores, matches in iter_scored_tiles(spectrums, spectrums, similarity_function, tiles,
+                                                   n_jobs=n_jobs, upper_triangle=True):
+        score_matrix.write_tile(tile, scores, matches)
+    score_matrix.flush()
+    return CondensedScoreMatrix.open(output_folder)
+
+
+def precursor_window_pairs(precursor_mz: List[float],
+                           windows: List[Tuple[float, float]]) -> np.ndarray:
+    """Return all pairs (i, j) with i <= j whose precursor m/z difference is within a window.
+
+    Spectrums are sorted by precursor m/z, so that the matching pairs for every
+    window are found with a binary search instead of comparing all pairs.
+    Spectrums without precursor m/z are not paired.
+
+    Args:
+    --------
+    precursor_mz:
+        Precursor m/z of all spectrums (None for missing values).
+    windows:
+        List of (min_difference, max_difference) of the absolute precursor m/z
+        difference. Use (0, max_difference) to include pairs with the same
+        precursor m/z (and the diagonal).
+
+    Returns:
+    --------
+    Array of shape (n_pairs, 2) with sorted, unique pairs (i, j), i <= j.
+    """
+    precursor_mz = np.array([np.nan if x is None else x for x in precursor_mz], dtype=np.float64)
+    has_mz = np.where(~np.isnan(precursor_mz))[0]
+    order = has_mz[np.argsort(precursor_mz[has_mz], kind="stable")]
+    mz_sorted = precursor_mz[order]
+    positions = np.arange(order.shape[0])
+
+    pairs = [np.zeros((0, 2), dtype="int")]
+    for min_difference, max_difference in windows:
+        assert 0 <= min_difference <= max_difference, "Expected windows (min_difference, max_difference)."
+        starts = np.maximum(np.searchsorted(mz_sorted, mz_sorted + min_difference, side="left"), positions)
+        ends = np.searchsorted(mz_sorted, mz_sorted + max_difference, side="right")
+        counts = np.maximum(ends - starts, 0)
+        first = np.repeat(positions, counts)
+        # Position of every second element: starts[first] + (0, 1, ..., count - 1)
+        second = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        pairs.append(np.stack((order[first], order[second]), axis=1))
+    pairs = np.concatenate(pairs)
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+
+def _precursor_window_pairs(spectrums, windows) -> np.ndarray:
+    """Return all pairs of spectrums within given precursor m/z windows."""
+    if isinstance(spectrums, PackedSpectra):
+        precursor_mz = spectrums.precursor_mz
+    else:
+        precursor_mz = [s.get("precursor_mz") for s in spectrums]
+    pairs = precursor_window_pairs(precursor_mz, windows)
+    print(f"Scoring {pairs.shape[0]} pairs within precursor m/z windows.")
+    return pairs
+
+
+def _sparse_pair_matrix(spectrums, similarity_function, pairs, n_jobs, tile_size,
+                        score_cutoff, min_matches, ignore_diagonal,
+                        prune_with_upper_bound, pruning_statistics=None) -> SparseScoreMatrix:
+    """Score pairs of the upper triangle and return SparseScoreMatrix.
+
+    If pairs is None, all pairs that pass the score upper bound are scored.
+    """
+    n_spectrums = len(spectrums)
+    if prune_with_upper_bound:
+        upper_bound = ScoreUpperBound(spectrums, spectrums, similarity_function)
+        if pairs is None:
+            pairs = np.concatenate([upper_bound.candidate_pairs(tile, score_cutoff, min_matches,
+                                                                upper_triangle=True)
+                                    for tile in make_upper_triangle_tiles(n_spectrums, tile_size)]
+                                   + [np.zeros((0, 2), dtype="int")])
+        else:
+            pairs = upper_bound.prune_pairs(pairs, score_cutoff, min_matches)
+        print(f"Pruned {upper_bound.n_pairs_pruned} of {upper_bound.n_pairs_checked} pairs by score upper bound.")
+        _add_count(pruning_statistics, "n_pairs_checked", upper_bound.n_pairs_checked)
+        _add_count(pruning_statistics, "n_pairs_pruned", upper_bound.n_pairs_pruned)
+    if ignore_diagonal:
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    _add_count(pruning_statistics, "n_pairs_scored", pairs.shape[0])
+    scores, matches = score_pairs(spectrums, spectrums, pairs, similarity_function, n_jobs=n_jobs)
+    selected = np.ones(pairs.shape[0], dtype=bool)
+    if score_cutoff is not None:
+        selected &= scores > score_cutoff
+    if min_matches is not None:
+        selected &= matches >= min_matches
+    pairs, scores, matches = pairs[selected], scores[selected], matches[selected]
+    mirrored = pairs[:, 0] != pairs[:, 1]
+    return SparseScoreMatrix.from_coo(np.concatenate((pairs[:, 0], pairs[mirrored, 1])),
+                                      np.concatenate((pairs[:, 1], pairs[mirrored, 0])),
+                                      np.concatenate((scores, scores[mirrored])),
+                                      np.concatenate((matches, matches[mirrored])),
+                                      (len(spectrums), len(spectrums)))
+
+
+def _add_count(statistics: dict, key: str, count: int):
+    """Add count to statistics[key] (if statistics is given)."""
+    if statistics is not None:
+        statistics[key] = statistics.get(key, 0) + int(count)
+
+
+def _run_local_workers(shared_folder: str, n_jobs: int = None, lock_timeout: float = None):
+    """Run n_jobs workers of the sharded work queue in shared_folder (none for n_jobs=0)."""
+    if n_jobs == 0:
+        return
+    if n_jobs == 1:
+        run_worker(shared_folder, lock_timeout=lock_timeout)
+        return
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(run_worker, [shared_folder] * n_jobs, [None] * n_jobs, [lock_timeout] * n_jobs))
+
+
+class SparseTileCollector:
+    """Collect selected entries of upper triangle tiles of a symmetric score matrix.
+
+    Entries are selected by score_cutoff and/or min_matches, and (optionally) only
+    the top_n highest scores per row are kept. Ties are resolved by taking the
+    lowest column index. Tiles can be added in any order.
+    """
+    def __init__(self, n_spectrums: int,
+                 score_cutoff: float = None,
+                 min_matches: int = None,
+                 top_n: int = None,
+                 ignore_diagonal: bool = False):
+        """
+
+        Args:
+        --------
+        n_spectrums:
+            Number of rows and columns of the score matrix.
+        score_cutoff:
+            Only keep entries with score > score_cutoff. Default = None.
+        min_matches:
+            Only keep entries with at least min_matches matching peaks. Default = None.
+        top_n:
+            Only keep the top_n highest scores per row. Default = None.
+        ignore_diagonal:
+            Set to True to not keep diagonal entries. Default = False.
+        """
+        self.n_spectrums = n_spectrums
+        self.score_cutoff = score_cutoff
+        self.min_matches = min_matches
+        self.ignore_diagonal = ignore_diagonal
+        self._entries = []
+        self._running_top_n = None
+        if top_n is not None:
+            # Columns of the running top_n are the rows of the (symmetric) matrix
+            self._running_top_n = RunningTopN(min(top_n, n_spectrums), n_spectrums,
+                                              fields={"scores": np.float64, "matches": "int"})
+
+    def settings(self) -> dict:
+        """Return selection settings (e.g. to check that a checkpoint belongs to them)."""
+        top_n = None if self._running_top_n is None else self._running_top_n.ids.shape[0]
+        return {"score_cutoff": self.score_cutoff,
+                "min_matches": self.min_matches,
+                "top_n": top_n,
+                "ignore_diagonal": self.ignore_diagonal}
+
+    def write_tile(self, tile: Tuple[int, int, int, int], scores: np.ndarray, matches: np.ndarray):
+        """Add selected upper triangle entries (row <= column) of a tile."""
+        self.add_entries(tile, **self.select_entries(tile, scores, matches))
+
+    def select_entries(self, tile: Tuple[int, int, int, int], scores: np.ndarray, matches: np.ndarray) -> dict:
+        """Return selected upper triangle entries (row <= column) of a tile.
+
+        With top_n, only entries within the top_n of their tile row or tile column
+        are returned, since no other entries can be in the top_n of a matrix row.
+        Returns dictionary with rows, columns, scores and matches of the entries.
+        """
+        row_start, row_end, col_start, col_end = tile
+        rows = np.arange(row_start, row_end).reshape(-1, 1)
+        columns = np.arange(col_start, col_end).reshape(1, -1)
+        selected = columns > rows if self.ignore_diagonal else columns >= rows
+        if self.score_cutoff is not None:
+            selected = selected & (scores > self.score_cutoff)
+        if self.min_matches is not None:
+            selected = selected & (matches >= self.min_matches)
+        if self._running_top_n is not None:
+            selected = selected & _in_top_n(np.where(selected, scores, -np.inf), self._running_top_n.ids.shape[0])
+        i, j = np.nonzero(selected)
+        return {"rows": i + row_start, "columns": j + col_start,
+                "scores": scores[i, j], "matches": matches[i, j]}
+
+    def add_entries(self, tile: Tuple[int, int, int, int], rows: np.ndarray, columns: np.ndarray,
+                    scores: np.ndarray, matches: np.ndarray):
+        """Add entries returned by select_entries() for the given tile."""
+        # Mirrored entries (lower triangle), without diagonal
+        mirrored = rows != columns
+        if self._running_top_n is None:
+            self._entries.append((np.concatenate((rows, columns[mirrored])),
+                                  np.concatenate((columns, rows[mirrored])),
+                                  np.concatenate((scores, scores[mirrored])),
+                                  np.concatenate((matches, matches[mirrored]))))
+            return
+        row_start, row_end, col_start, col_end = tile
+        shape = (row_end - row_start, col_end - col_start)
+        i, j = rows - row_start, columns - col_start
+        values = np.full(shape, -np.inf)
+        values[i, j] = scores
+        values_mirrored = np.full(shape, -np.inf)
+        values_mirrored[i[mirrored], j[mirrored]] = scores[mirrored]
+        tile_scores = np.zeros(shape)
+        tile_scores[i, j] = scores
+        tile_matches = np.zeros(shape, dtype="int")
+        tile_matches[i, j] = matches
+        self._running_top_n.update(np.arange(row_start, row_end), values,
+                                   col_start=col_start, scores=tile_scores, matches=tile_matches)
+        self._running_top_n.update(np.arange(col_start, col_end), values_mirrored.T,
+                                   col_start=row_start, scores=tile_scores.T, matches=tile_matches.T)
+
+    def result(self) -> SparseScoreMatrix:
+        """Return all selected entries as SparseScoreMatrix."""
+        shape = (self.n_spectrums, self.n_spectrums)
+        if self._running_top_n is not None:
+            top_n = self._running_top_n
+            selected = top_n.values > -np.inf
+            return SparseScoreMatrix.from_coo(np.nonzero(selected)[1], top_n.ids[selected],
+                                              top_n.fields["scores"][selected],
+                                              top_n.fields["matches"][selected], shape)
+        entries = [np.concatenate([x[i] for x in self._entries] + [np.zeros(0, dtype=dtype)])
+                   for i, dtype in enumerate(["int", "int", np.float64, "int"])]
+        return SparseScoreMatrix.from_coo(*entries, shape)
+
+
+def _in_top_n(values: np.ndarray, top_n: int) -> np.ndarray:
+    """Return mask of entries within the top_n of their row or column (ignoring -inf)."""
+    in_top_n = np.zeros(values.shape, dtype=bool)
+    column_top_n = RunningTopN(min(top_n, values.shape[0]), values.shape[1])
+    column_top_n.update(np.arange(values.shape[0]), values)
+    in_top_n[column_top_n.ids, np.arange(values.shape[1])] = True
+    row_top_n = RunningTopN(min(top_n, values.shape[1]), values.shape[0])
+    row_top_n.update(np.arange(values.shape[1]), values.T)
+    in_top_n[np.arange(values.shape[0]), row_top_n.ids] = True
+    return in_top_n & (values > -np.inf)
+
+
+class DenseTileCollector:
+    """Collect tiles in dense similarities and num_matches arrays."""
+    def __init__(self, n_spectrums: int, score_shape: tuple = ()):
+        self.similarities = np.zeros((n_spectrums, n_spectrums) + score_shape)
+        self.num_matches = np.zeros((n_spectrums, n_spectrums) + score_shape)
+
+    def write_tile(self, tile, scores, matches):
+        row_start, row_end, col_start, col_end = tile
+        self.similarities[row_start:row_end, col_start:col_end] = scores
+        self.num_matches[row_start:row_end, col_start:col_end] = matches
+
+    def result(self):
+        """Return symmetric similarities and num_matches (lower triangle filled from upper)."""
+        lower = np.tril_indices(self.similarities.shape[0], -1)
+        self.similarities[lower] = np.swapaxes(self.similarities, 0, 1)[lower]
+        self.num_matches[lower] = np.swapaxes(self.num_matches, 0, 1)[lower]
+        return self.similarities, self.num_matches
+
+
+class TileJournal:
+    """Checkpoint journal for tiled score matrix computations.
+
+    The arrays of every finished tile (e.g. dense scores and matches, or only the
+    selected entries for sparse output) are stored as a separate .npz file in the
+    journal folder, and then recorded in completed_tiles.txt (one line per tile). Only tiles that
+    are recorded in completed_tiles.txt are considered finished, so tiles that
+    were being written during a crash are simply computed again.
+
+    For example:
+
+    .. code-block:: python
+
+        journal = TileJournal("checkpoints_modcos", n_spectrums, tile_size=(500, 500))
+        tiles = [tile for tile in tiles if tile not in journal.completed_tiles()]
+        for tile, scores, matches in iter_scored_tiles(...):
+            journal.add(tile, scores=scores, matches=matches)
+    """
+    def __init__(self, folder: str, n_spectrums: int,
+                 tile_size: Tuple[int, int],
+                 similarity_function=None,
+                 store_tiles: bool = True,
+                 spectra_hash: str = None,
+                 output_settings: dict = None):
+        """
+
+        Args:
+        --------
+        folder:
+            Folder to store the journal in (will be created if needed).
+        n_spectrums:
+            Number of spectrums (matrix rows and columns).
+        tile_size:
+            Tile size as (number of rows, number of columns).
+        similarity_function:
+            Similarity function (or its name). Its class and parameters are only
+            used to check that an existing journal belongs to the same computation.
+            Default = None.
+        store_tiles:
+            Set to False if tiles are already stored elsewhere (e.g. in a
+            CondensedScoreMatrix) and only need to be recorded. Default = True.
+        spectra_hash:
+            Content hash of the spectrums (see packed_spectra.spectra_hash()), to
+            check that an existing journal belongs to the same spectrums. Default = None.
+        output_settings:
+            Settings that determine the stored tile arrays (e.g. the selection of
+            sparse output, see SparseTileCollector.settings()), to check that an
+            existing journal belongs to the same output. Default = None.
+        """
+        self.folder = folder
+        self.store_tiles = store_tiles
+        self._tiles = set(make_upper_triangle_tiles(n_spectrums, tile_size))
+        if similarity_function is not None and not isinstance(similarity_function, str):
+            similarity_function = similarity_settings(similarity_function)
+        settings = {"n_spectrums": n_spectrums,
+                    "tile_size": list(tile_size),
+                    "similarity_function": similarity_function,
+                    "store_tiles": store_tiles,
+                    "spectra_hash": spectra_hash,
+                    "output_settings": output_settings}
+        os.makedirs(folder, exist_ok=True)
+        settings_file = os.path.join(folder, "settings.json")
+        if os.path.exists(settings_file):
+            with open(settings_file, "r") as f:
+                assert json.load(f) == settings, \
+                    "Checkpoint folder belongs to a computation with different settings."
+        else:
+            with open(settings_file, "w") as f:
+                json.dump(settings, f)
+        self._journal_file = os.path.join(folder, "completed_tiles.txt")
+
+    def completed_tiles(self) -> set:
+        """Return set of all finished tiles (row_start, row_end, col_start, col_end).
+
+        Lines that were not completely written (e.g. during a crash), that are no
+        tile of the computation or whose tile file is missing are ignored.
+        """
+        if not os.path.exists(self._journal_file):
+            return set()
+        completed = set()
+        with open(self._journal_file, "r") as f:
+            for line in f:
+                try:
+                    tile = tuple(int(x) for x in line.split(","))
+                except ValueError:
+                    continue
+                if line.endswith("\n") and tile in self._tiles \
+                        and (not self.store_tiles or os.path.exists(self._tile_filename(tile))):
+                    completed.add(tile)
+        return completed
+
+    def load_tiles(self):
+        """Yield (tile, arrays) for all finished tiles (if tiles are stored).
+
+        arrays is a dictionary with the arrays given to add() for the tile.
+        """
+        if not self.store_tiles:
+            return
+        for tile in sorted(self.completed_tiles()):
+            with np.load(self._tile_filename(tile)) as data:
+                yield tile, dict(data)
+
+    def add(self, tile: Tuple[int, int, int, int], **arrays: np.ndarray):
+        """Store arrays (e.g. scores and matches) of a finished tile and record it in the journal."""
+        if self.store_tiles:
+            filename = self._tile_filename(tile)
+            temp_filename = filename[:-4] + "_temp.npz"
+            np.savez(temp_filename, **arrays)
+            os.replace(temp_filename, filename)
+        line = ",".join(str(x) for x in tile) + "\n"
+        if self._has_torn_line():
+            # Start on a new line if the last line was not completely written
+            line = "\n" + line
+        with open(self._journal_file, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _has_torn_line(self) -> bool:
+        if not os.path.exists(self._journal_file) or os.path.getsize(self._journal_file) == 0:
+            return False
+        with open(self._journal_file, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def _tile_filename(self, tile: Tuple[int, int, int, int]) -> str:
+        return os.path.join(self.folder, "tile_{}_{}_{}_{}.npz".format(*tile))
@@ -0,0 +1,212 @@
+"""Select top-n scores without creating full score matrices."""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from spec2vec.vector_operations import cosine_similarity_matrix
+from custom_functions.score_storage import CondensedScoreMatrix
+
+
+class RunningTopN:
+    """Keep the top_n highest values (and their ids) for every column.
+
+    Blocks of values can be added one by one using update(). Per column, the
+    top_n of a block are pre-selected with a partial selection, so only
+    2 x top_n entries are sorted per update. Ties are resolved by taking the
+    lowest id. NaN values are treated as 0.
+
+    For example:
+
+    .. code-block:: python
+
+        top_n = RunningTopN(3, n_columns=10, fields={"matches": "int"})
+        for row_start, row_end in blocks:
+            top_n.update(np.arange(row_start, row_end), scores_block, matches=matches_block)
+        top_n.ids, top_n.values, top_n.fields["matches"]  # arrays of shape (3, 10)
+    """
+    def __init__(self, top_n: int, n_columns: int, fields: dict = None):
+        """
+
+        Args:
+        --------
+        top_n:
+            Number of highest values to keep per column.
+        n_columns:
+            Number of columns (e.g. queries).
+        fields:
+            Dictionary with names and dtypes of additional values to keep for
+            the selected entries (e.g. {"matches": "int"}). Default = None.
+        """
+        self.ids = np.full((top_n, n_columns), -1, dtype="int")
+        self.values = np.full((top_n, n_columns), -np.inf)
+        if fields is None:
+            fields = {}
+        self.fields = {name: np.zeros((top_n, n_columns), dtype=dtype) for name, dtype in fields.items()}
+
+    def update(self, ids: np.ndarray, values: np.ndarray, col_start: int = 0, **fields):
+        """Merge block of values into current top_n.
+
+        Args:
+        --------
+        ids:
+            Ids of the block rows (n_rows,).
+        values:
+            Block of values (n_rows, n_block_columns) for columns col_start to
+            col_start + n_block_columns.
+        col_start:
+            First column of the block. Default = 0.
+        fields:
+            Blocks of the additional fields (same shape as values).
+        """
+        top_n = self.ids.shape[0]
+        columns = slice(col_start, col_start + values.shape[1])
+        ids = np.asarray(ids)
+        # Keep -inf, which marks entries that must not be selected
+        values = np.nan_to_num(values, nan=0.0, posinf=np.inf, neginf=-np.inf)
+        if np.any(np.diff(ids) < 0):
+            # Block rows must be in increasing id order for the tie-break below
+            row_order = np.argsort(ids, kind="stable")
+            ids, values = ids[row_order], values[row_order]
+            fields = {name: np.asarray(field)[row_order] for name, field in fields.items()}
+        if len(ids) > top_n:
+            # Pre-select the block's top_n per column, so only 2 x top_n rows are sorted
+            block_rows, values = _select_top_n(values.T, top_n)
+            block_rows, values = block_rows.T, values.T
+            fields = {name: np.take_along_axis(np.asarray(field), block_rows, axis=0)
+                      for name, field in fields.items()}
+            block_ids = ids[block_rows]
+        else:
+            block_ids = np.repeat(ids.reshape(-1, 1), values.shape[1], axis=1)
+        all_ids = np.concatenate((self.ids[:, columns], block_ids))
+        all_values = np.concatenate((self.values[:, columns], values))
+        order = np.lexsort((all_ids, -all_values), axis=0)[:top_n, :]
+        for name, selected in self.fields.items():
+            all_field = np.concatenate((selected[:, columns], fields[name]))
+            selected[:, columns] = np.take_along_axis(all_field, order, axis=0)
+        self.ids[:, columns] = np.take_along_axis(all_ids, order, axis=0)
+        self.values[:, columns] = np.take_along_axis(all_values, order, axis=0)
+
+
+def top_n_cosine(library_vectors: np.ndarray,
+                 query_vectors: np.ndarray,
+                 top_n: int,
+                 rows: np.ndarray = None,
+                 block_size: int = 10000):
+    """Exact top_n cosine similarities between library and query vectors.
+
+    Walks through the library in blocks of block_size vectors, so that peak
+    memory is O(block_size x n_queries + top_n x n_queries) instead of creating
+    the full library x queries similarity matrix. Scores are computed in the
+    same way as in Spec2Vec.matrix().
+
+    Args:
+    --------
+    library_vectors:
+        Array (or memory-mapped array) with library embeddings.
+    query_vectors:
+        Array with query embeddings.
+    top_n:
+        Number of most similar library vectors to select per query.
+    rows:
+        Only consider library_vectors[rows]. Returned ids are then positions in
+        rows. Default is None, in which case all library vectors are used.
+    block_size:
+        Number of library vectors to compare at once. Default = 10000.
+
+    Returns:
+    --------
+    ids, scores
+        Arrays of shape (top_n, n_queries) with ids and cosine similarity of the
+        top_n most similar library vectors for every query (sorted from high to low).
+    """
+    n_library = library_vectors.shape[0] if rows is None else len(rows)
+    running_top_n = RunningTopN(min(top_n, n_library), query_vectors.shape[0])
+    for start in range(0, n_library, block_size):
+        end = min(start + block_size, n_library)
+        if rows is None:
+            block = np.asarray(library_vectors[start:end])
+        else:
+            block = np.asarray(library_vectors[rows[start:end]])
+        running_top_n.update(np.arange(start, end), cosine_similarity_matrix(block, query_vectors))
+    return running_top_n.ids, running_top_n.values
+
+
+def top_n_neighbours(scores, top_n: int,
+                     matches: np.ndarray = None,
+                     min_matches: int = None,
+                     block_size: int = 1000,
+                     n_jobs: int = 1):
+    """Top_n highest scores (and their column indices) for every row of a score matrix.
+
+    The matrix is read in blocks of block_size rows, so it can be a memory-mapped
+    array (e.g. np.load(filename, mmap_mode="r")) or a CondensedScoreMatrix that
+    is larger than the available RAM. Per row, the top_n entries are found with a
+    partial selection (np.partition) instead of sorting the full row. Ties are
+    resolved by taking the lowest column index, NaN values are treated as 0.
+    The output can directly be used in networking.create_network().
+
+    Args:
+    --------
+    scores:
+        Score matrix (array, memory-mapped array or CondensedScoreMatrix).
+    top_n:
+        Number of highest scores to select per row.
+    matches:
+        Matrix with the number of matching peaks (same shape as scores). Only used
+        with min_matches, not needed for a CondensedScoreMatrix. Default = None.
+    min_matches:
+        Scores with less than min_matches matching peaks are set to 0 before
+        selecting the top_n. Default = None.
+    block_size:
+        Number of rows to read and process at once. Default = 1000.
+    n_jobs:
+        Number of threads to process blocks with. Default = 1.
+
+    Returns:
+    --------
+    similars_idx, similars
+        Arrays of shape (n_rows, top_n) with the column indices and scores of the
+        top_n highest scores per row (sorted from high to low).
+    """
+    n_rows, n_columns = scores.shape
+    top_n = min(top_n, n_columns)
+    assert min_matches is None or matches is not None or isinstance(scores, CondensedScoreMatrix), \
+        "Expected matches matrix to apply min_matches."
+    similars_idx = np.zeros((n_rows, top_n), dtype="int")
+    similars = np.zeros((n_rows, top_n))
+
+    def select_block(row_start):
+        rows = slice(row_start, min(row_start + block_size, n_rows))
+        if isinstance(scores, CondensedScoreMatrix):
+            block, block_matches = scores.block(rows, slice(None))
+        else:
+            block = np.asarray(scores[rows])
+            block_matches = None if matches is None else np.asarray(matches[rows])
+        block = np.nan_to_num(block.astype(np.float64), nan=0.0)
+        if min_matches is not None:
+            block[block_matches < min_matches] = 0
+        similars_idx[rows], similars[rows] = _select_top_n(block, top_n)
+
+    block_starts = range(0, n_rows, block_size)
+    if n_jobs == 1:
+        for row_start in block_starts:
+            select_block(row_start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(select_block, block_starts))
+    return similars_idx, similars
+
+
+def _select_top_n(block: np.ndarray, top_n: int):
+    """Top_n values (sorted, lowest index first for ties) and their indices for every row."""
+    if top_n == 0:
+        return np.zeros((block.shape[0], 0), dtype="int"), np.zeros((block.shape[0], 0))
+    # Value of the top_n-th highest entry of every row
+    kth_values = -np.partition(-block, top_n - 1, axis=1)[:, top_n - 1:top_n]
+    larger = block > kth_values
+    equal = block == kth_values
+    # Take as many entries equal to the kth value as needed (lowest indices first)
+    n_missing = top_n - larger.sum(axis=1, keepdims=True)
+    selected = larger | (equal & (np.cumsum(equal, axis=1) <= n_missing))
+    indices = np.nonzero(selected)[1].reshape(-1, top_n)
+    values = np.take_along_axis(block, indices, axis=1)
+    order = np.lexsort((indices, -values), axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(values, order, axis=1)
@@ -31,6 +31,7 @@ setup(
         "matchms>=0.6.2",
         "numpy",
         "pandas",
+        "scipy",
         "spec2vec",
         "networkx",
         "gensim",
@@ -0,0 +1,77 @@
+import numpy as np
+from custom_functions.ann_index import IVFIndex, recall_report
+from custom_functions.library_index import LibraryIndex
+from custom_functions.library_search import library_matching
+from utils import create_test_data
+
+
+def create_clustered_vectors(n_vectors=500, n_clusters=10, vector_size=16):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(n_clusters, vector_size))
+    vectors = centers[rng.integers(n_clusters, size=n_vectors)]
+    return vectors + 0.3 * rng.normal(size=(n_vectors, vector_size))
+
+
+def test_ivf_index_exact_for_all_lists():
+    vectors = create_clustered_vectors()
+    queries = create_clustered_vectors(20)
+    ann_index = IVFIndex.build(vectors, n_lists=10)
+    assert ann_index.list_offsets[-1] == 500, "Expected all vectors in lists."
+
+    ids, scores = ann_index.search(queries, top_n=5, n_probe=10)
+    vectors_norm = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries_norm = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    expected_scores = queries_norm @ vectors_norm.T
+    expected_ids = np.argsort(-expected_scores, axis=1)[:, :5]
+    assert np.all(ids == expected_ids), "Expected exact search results."
+    assert np.allclose(scores, np.take_along_axis(expected_scores, expected_ids, axis=1)), \
+        "Expected exact cosine scores."
+
+
+def test_ivf_index_ids_and_small_lists():
+    vectors = create_clustered_vectors(50)
+    ann_index = IVFIndex.build(vectors, ids=np.arange(50) * 2, n_lists=25)
+    ids, _ = ann_index.search(vectors[:3], top_n=10, n_probe=1)
+    assert ids.shape == (3, 10), "Expected top_n results even if probed list is small."
+    assert np.all(ids[:, 0] == np.array([0, 2, 4])), "Expected vectors to find themselves first."
+
+
+def test_ivf_index_save_and_load(tmp_path):
+    vectors = create_clustered_vectors()
+    ann_index = IVFIndex.build(vectors, n_lists=10, n_probe=3)
+    ann_index.save(str(tmp_path / "ann"))
+    loaded = IVFIndex.load(str(tmp_path / "ann"))
+    assert loaded.n_probe == 3 and loaded.n_lists == 10, "Expected same settings."
+    assert isinstance(loaded.vectors, np.memmap), "Expected memory-mapped vectors."
+    ids, scores = ann_index.search(vectors[:10], top_n=5)
+    ids_loaded, scores_loaded = loaded.search(vectors[:10], top_n=5)
+    assert np.all(ids == ids_loaded) and np.allclose(scores, scores_loaded), "Expected same results."
+
+
+def test_recall_report():
+    vectors = create_clustered_vectors()
+    ann_index = IVFIndex.build(vectors, n_lists=20)
+    report = recall_report(ann_index, create_clustered_vectors(30), top_n=10, n_probes=[1, 5, 20])
+    assert list(report["n_probe"]) == [1, 5, 20], "Expected one row per n_probe."
+    assert np.all(np.diff(report["recall"]) >= 0), "Expected recall to increase with n_probe."
+    assert report["recall"].iloc[-1] == 1.0, "Expected exact search when probing all lists."
+
+
+def test_library_matching_with_ann_index():
+    documents_library, documents_query, model = create_test_data(n_library=40, n_query=4)
+    library_index = LibraryIndex.build(documents_library, model,
+                                       intensity_weighting_power=0.5,
+                                       allowed_missing_percentage=5.0)
+    library_ids = library_index.library_ids()
+    ann_index = IVFIndex.build(library_index.embeddings[library_ids], ids=library_ids,
+                               n_lists=5, n_probe=5)
+    settings = {"presearch_based_on": ["spec2vec-top3"],
+                "include_scores": ["cosine"],
+                "intensity_weighting_power": 0.5,
+                "allowed_missing_percentage": 5.0}
+    found_matches = library_matching(documents_query, library_index, model, **settings)
+    found_matches_ann = library_matching(documents_query, library_index, model, ann_index=ann_index,
+                                         **settings)
+    for matches, matches_ann in zip(found_matches, found_matches_ann):
+        assert np.all(matches.index == matches_ann.index), "Expected same candidates."
+        assert np.allclose(matches["s2v_score"], matches_ann["s2v_score"]), "Expected same scores."
@@ -0,0 +1,33 @@
+import json
+from benchmarks.benchmark_library_matching import main, run_benchmark
+from custom_functions.library_search import library_matching
+from utils import create_test_data
+
+
+def test_library_matching_timings():
+    documents_library, documents_query, model = create_test_data()
+    timings = {}
+    library_matching(documents_query, documents_library, model,
+                     presearch_based_on=["precursor_mz", "spec2vec-top3"],
+                     include_scores=["spec2vec"],
+                     allowed_missing_percentage=5.0,
+                     timings=timings)
+    assert set(timings) == {"setup", "library_embedding", "library_packing", "pool_startup",
+                            "spec2vec_presearch", "mass_presearch", "modcos_presearch",
+                            "rescoring", "assembly"}, "Expected timings for all steps."
+    assert all(x >= 0 for x in timings.values()), "Expected positive times."
+
+
+def test_run_benchmark():
+    results = run_benchmark(library_sizes=[20, 40], n_queries=3, n_peaks=10)
+    assert {x["n_library"] for x in results} == {20, 40}, "Expected results for all library sizes."
+    assert {x["step"] for x in results if x["n_library"] == 20} >= {"total", "modcos_presearch", "assembly"}, \
+        "Expected timings per step."
+
+
+def test_benchmark_main(tmp_path):
+    filename = str(tmp_path / "results.json")
+    main(["--library-sizes", "20", "--n-queries", "2", "--n-peaks", "10", "--output", filename])
+    with open(filename, "r") as f:
+        results = json.load(f)
+    assert len(results) == 10, "Expected 9 steps and total time."
@@ -0,0 +1,25 @@
+import networkx as nx
+import numpy as np
+from custom_functions.graph_components import ClusterLabels
+
+
+def test_cluster_labels():
+    graph = nx.Graph()
+    graph.add_nodes_from(range(8))
+    graph.add_edges_from([(0, 3), (3, 5), (1, 2), (6, 7)])
+    clusters = ClusterLabels(graph)
+    assert clusters.clusters() == [[0, 3, 5], [1, 2], [4], [6, 7]], "Expected connected components."
+    assert np.all(clusters.sizes == [3, 2, 1, 2]), "Expected cluster sizes."
+    assert clusters.labels[5] == clusters.labels[0] != clusters.labels[1], "Expected same labels per cluster."
+
+    graph.add_edge(2, 4)
+    clusters.union(2, 4)
+    graph.add_edge(7, 0)
+    clusters.union(7, 0)
+    assert clusters.size_of(6) == 5 and clusters.cluster_nodes(6) == [0, 3, 5, 6, 7], "Expected merged clusters."
+
+    graph.remove_edge(3, 5)
+    assert clusters.split(clusters.cluster_nodes(0)) == [[0, 3, 6, 7], [5]], "Expected split cluster."
+    assert clusters.clusters() == [sorted(x) for x in nx.connected_components(graph)], \
+        "Expected same clusters as networkx."
+    assert clusters.size_of(5) == 1 and clusters.size_of(3) == 4, "Expected updated sizes."
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from matchms import Spectrum
+from matchms.similarity import PrecursorMzMatch
+from custom_functions.library_index import LibraryIndex, PrecursorMzIndex
+from custom_functions.library_search import library_matching
+from utils import create_test_data
+
+
+def test_library_index_embeddings():
+    documents_library, _, model = create_test_data()
+    library_index = LibraryIndex.build(documents_library, model,
+                                       intensity_weighting_power=0.5,
+                                       allowed_missing_percentage=5.0)
+    assert library_index.embeddings.shape == (20, 10), "Expected different embeddings shape."
+    assert np.all(library_index.library_ids() == np.array([1, 2, 4, 5, 7, 8, 10, 11, 13, 14, 16, 17, 19])), \
+        "Expected only ids of annotated spectra."
+    assert np.all(library_index.library_ids(ignore_non_annotated=False) == np.arange(20)), \
+        "Expected all ids."
+
+
+def test_library_index_save_and_load(tmp_path):
+    documents_library, _, model = create_test_data()
+    library_index = LibraryIndex.build(documents_library, model,
+                                       intensity_weighting_power=0.5,
+                                       allowed_missing_percentage=5.0)
+    library_index.save(str(tmp_path / "index"))
+    loaded = LibraryIndex.load(str(tmp_path / "index"))
+    assert isinstance(loaded.embeddings, np.memmap), "Expected memory-mapped embeddings."
+    assert np.all(loaded.embeddings == library_index.embeddings), "Expected identical embeddings."
+    assert loaded.metadata == library_index.metadata, "Expected identical metadata."
+    assert np.all(np.load(str(tmp_path / "index" / "library_ids.npy")) == library_index.library_ids()), \
+        "Expected library_ids to be stored."
+    assert np.all(loaded.library_ids() == library_index.library_ids()), "Expected same library ids."
+    loaded = LibraryIndex.load(str(tmp_path / "index"), documents_library=documents_library)
+    assert loaded.documents is documents_library, "Expected library documents."
+    with pytest.raises(AssertionError, match="do not match"):
+        LibraryIndex.load(str(tmp_path / "index"), documents_library=documents_library[1:] + documents_library[:1])
+    assert loaded.intensity_weighting_power == 0.5
+    assert loaded.allowed_missing_percentage == 5.0
+
+
+def test_library_matching_with_library_index():
+    documents_library, documents_query, model = create_test_data()
+    settings = {"presearch_based_on": ["precursor_mz", "spec2vec-top3"],
+                "include_scores": ["spec2vec", "cosine", "modcosine"],
+                "intensity_weighting_power": 0.5,
+                "allowed_missing_percentage": 5.0,
+                "mass_tolerance": 2.0,
+                "mass_tolerance_type": "Dalton"}
+    found_matches = library_matching(documents_query, documents_library, model, **settings)
+    library_index = LibraryIndex.build(documents_library, model,
+                                       intensity_weighting_power=0.5,
+                                       allowed_missing_percentage=5.0)
+    found_matches_index = library_matching(documents_query, library_index, model, **settings)
+    for matches, matches_index in zip(found_matches, found_matches_index):
+        assert np.all(matches.index == matches_index.index), "Expected same candidates."
+        assert np.allclose(matches.values.astype(float), matches_index.values.astype(float)), \
+            "Expected same scores."
+    packed_spectra = library_index.packed_spectra()
+    assert len(packed_spectra) == len(library_index.library_ids()), "Expected annotated library spectra."
+    assert library_index.packed_spectra() is packed_spectra, "Expected library spectra to be packed only once."
+
+    # Library documents are not needed if packed library spectra are given
+    library_index_without_documents = LibraryIndex(library_index.embeddings, library_index.metadata,
+                                                   intensity_weighting_power=0.5,
+                                                   allowed_missing_percentage=5.0)
+    found_matches_packed = library_matching(documents_query, library_index_without_documents, model,
+                                            library_spectra=packed_spectra, **settings)
+    for matches, matches_packed in zip(found_matches, found_matches_packed):
+        assert np.allclose(matches.values.astype(float), matches_packed.values.astype(float)), \
+            "Expected same scores."
+
+
+def test_library_matching_with_library_index_without_documents(tmp_path):
+    documents_library, documents_query, model = create_test_data()
+    LibraryIndex.build(documents_library, model,
+                       intensity_weighting_power=0.5,
+                       allowed_missing_percentage=5.0).save(str(tmp_path / "index"))
+    library_index = LibraryIndex.load(str(tmp_path / "index"))
+    found_matches = library_matching(documents_query, library_index, model,
+                                     presearch_based_on=["spec2vec-top3"],
+                                     include_scores=["spec2vec"],
+                                     intensity_weighting_power=0.5,
+                                     allowed_missing_percentage=5.0)
+    assert len(found_matches) == 3, "Expected results for all queries."
+    assert found_matches[0].shape[0] == 3, "Expected top 3 candidates."
+    assert np.all(np.isin(found_matches[0].index, library_index.library_ids())), \
+        "Expected only annotated candidates."
+
+    found_matches = library_matching(documents_query, library_index, model,
+                                     presearch_based_on=["precursor_mz"],
+                                     include_scores=["spec2vec"],
+                                     intensity_weighting_power=0.5,
+                                     allowed_missing_percentage=5.0,
+                                     mass_tolerance=1.0,
+                                     mass_tolerance_type="Dalton")
+    assert list(found_matches[0].index) == [19], "Expected different mass match."
+    assert found_matches[1] == [], "Expected no mass matches."
+
+    with pytest.raises(AssertionError, match="Library documents are needed"):
+        library_matching(documents_query, library_index, model,
+                         presearch_based_on=["spec2vec-top3"],
+                         include_scores=["cosine"],
+                         intensity_weighting_power=0.5,
+                         allowed_missing_percentage=5.0)
+
+
+@pytest.mark.parametrize("tolerance, tolerance_type", [[0.1, "Dalton"], [2.0, "Dalton"],
+                                                       [10, "ppm"], [1000, "ppm"]])
+def test_precursor_mz_index_same_as_precursor_mz_match(tolerance, tolerance_type):
+    rng = np.random.default_rng(0)
+    precursors_library = np.round(rng.uniform(100, 110, 200), 3)
+    precursors_query = np.concatenate([rng.uniform(99, 111, 20), precursors_library[:5] + 0.001])
+    spectrums_library = [Spectrum(mz=np.array([50.]), intensities=np.array([1.]),
+                                  metadata={"precursor_mz": x}) for x in precursors_library]
+    spectrums_query = [Spectrum(mz=np.array([50.]), intensities=np.array([1.]),
+                                metadata={"precursor_mz": x}) for x in precursors_query]
+    expected = PrecursorMzMatch(tolerance=tolerance, tolerance_type=tolerance_type).matrix(spectrums_library,
+                                                                                         spectrums_query)
+    mass_index = PrecursorMzIndex(precursors_library, tolerance=tolerance, tolerance_type=tolerance_type)
+    candidates = mass_index.candidates_list(precursors_query)
+    for i, candidate_ids in enumerate(candidates):
+        assert np.all(candidate_ids == np.where(expected[:, i])[0]), "Expected same mass matches."
+
+
+def test_precursor_mz_index_example():
+    mass_index = PrecursorMzIndex([100.0, 250.1, 100.001], tolerance=20, tolerance_type="ppm")
+    assert np.all(mass_index.candidates(100.0005) == np.array([0, 2])), "Expected different candidates."
+    assert mass_index.candidates(200.0).shape[0] == 0, "Expected no candidates."
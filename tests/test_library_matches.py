@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from custom_functions.library_matches import LibraryMatches
+from custom_functions.library_search import iter_library_matching, library_matching
+from utils import create_test_data
+
+
+SETTINGS = {"presearch_based_on": ["precursor_mz", "spec2vec-top3"],
+            "include_scores": ["spec2vec", "cosine"],
+            "ignore_non_annotated": True,
+            "intensity_weighting_power": 0.5,
+            "allowed_missing_percentage": 5.0,
+            "mass_tolerance": 0.5,
+            "mass_tolerance_type": "Dalton"}
+
+
+def test_library_matching_columnar_same_as_dataframes():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=5)
+    found_matches = library_matching(documents_query, documents_library, model, **SETTINGS)
+    found_matches_columnar = library_matching(documents_query, documents_library, model,
+                                              output_format="columnar", **SETTINGS)
+    assert isinstance(found_matches_columnar, LibraryMatches), "Expected columnar output."
+    assert len(found_matches_columnar) == 5, "Expected one entry per query."
+    for matches, matches_columnar in zip(found_matches, found_matches_columnar):
+        pd.testing.assert_frame_equal(matches, matches_columnar)
+
+    table = found_matches_columnar.to_dataframe()
+    assert table.shape[0] == sum(x.shape[0] for x in found_matches), "Expected one row per candidate."
+    assert list(table.columns) == ["query_id", "library_id", "cosine_score", "cosine_matches",
+                                   "mass_match", "s2v_score"], "Expected only calculated scores."
+
+
+def test_iter_library_matching_columnar():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=7)
+    found_matches = library_matching(documents_query, documents_library, model,
+                                     output_format="columnar", **SETTINGS)
+    chunks = list(iter_library_matching(documents_query, documents_library, model,
+                                        chunk_size=3, output_format="columnar", **SETTINGS))
+    assert [x[0] for x in chunks] == [0, 3, 6], "Expected one result per chunk."
+    combined = LibraryMatches.concatenate([x[1] for x in chunks])
+    assert np.all(combined.query_id == found_matches.query_id), "Expected same query ids."
+    assert np.all(combined.library_id == found_matches.library_id), "Expected same library ids."
+    assert np.allclose(combined.scores["s2v_score"], found_matches.scores["s2v_score"]), \
+        "Expected same scores."
+
+
+def test_library_matches_save_and_load(tmp_path):
+    library_matches = LibraryMatches(3, np.array([0, 0, 2]), np.array([5, 7, 1]),
+                                     {"cosine_score": np.array([0.1, 0.2, 0.3]),
+                                      "cosine_matches": np.array([1, 2, 3])})
+    filename = str(tmp_path / "matches.npz")
+    library_matches.save(filename)
+    loaded = LibraryMatches.load(filename)
+    assert len(loaded) == 3, "Expected same number of queries."
+    assert loaded[1] == [], "Expected empty list for query without candidates."
+    matches_df = loaded[0]
+    assert list(matches_df.index) == [5, 7], "Expected library ids as index."
+    assert list(matches_df["mod_cosine_score"]) == 2 * ["not calculated"], \
+        "Expected placeholder for scores that were not calculated."
+    assert np.allclose(loaded[-1]["cosine_score"], [0.3]), "Expected same scores."
@@ -8,7 +8,9 @@ from spec2vec import SpectrumDocument
 #path_root = os.path.dirname(os.path.__file__)
 path_root = os.path.dirname(os.getcwd())
 sys.path.insert(0, os.path.join(path_root, "custom_functions"))
-from custom_functions.library_search import library_matching
+import custom_functions.library_search
+from custom_functions.library_search import iter_library_matching, library_matching
+from utils import create_test_data
 
 
 def test_library_matching():
@@ -48,3 +50,42 @@ def test_library_matching():
     assert np.all(found_matches[0].values[:,3] == np.array([1, 0, 2])), \
         "Expected different number of matches"
     assert np.all(found_matches[0].values[:,4]), "Expected all mass matches to be True"
+
+
+def test_iter_library_matching_same_as_library_matching():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=7)
+    settings = {"presearch_based_on": ["precursor_mz", "spec2vec-top4", "modcos-top3"],
+                "include_scores": ["spec2vec", "cosine", "modcosine"],
+                "ignore_non_annotated": False,
+                "intensity_weighting_power": 0.5,
+                "allowed_missing_percentage": 5.0,
+                "min_matches": 1,
+                "mass_tolerance": 2.0,
+                "mass_tolerance_type": "Dalton"}
+    found_matches = library_matching(documents_query, documents_library, model, **settings)
+    results = list(iter_library_matching(documents_query, documents_library, model,
+                                         chunk_size=3, **settings))
+    assert [x[0] for x in results] == list(range(7)), "Expected results for all queries in order."
+    for matches, (_, matches_chunked) in zip(found_matches, results):
+        assert np.all(matches.index == matches_chunked.index), "Expected same candidates."
+        assert np.allclose(matches.values.astype(float), matches_chunked.values.astype(float)), \
+            "Expected same scores."
+
+
+def test_library_matching_no_process_pool_by_default(monkeypatch):
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=4)
+    settings = {"presearch_based_on": ["precursor_mz", "spec2vec-top4", "modcos-top3"],
+                "allowed_missing_percentage": 5.0,
+                "min_matches": 1,
+                "mass_tolerance": 2.0,
+                "mass_tolerance_type": "Dalton"}
+    expected_matches = library_matching(documents_query, documents_library, model, n_jobs=2, **settings)
+
+    def no_scoring_pool(*args, **kwargs):
+        raise AssertionError("Expected no process pool.")
+
+    monkeypatch.setattr(custom_functions.library_search, "ScoringPool", no_scoring_pool)
+    found_matches = library_matching(documents_query, documents_library, model, **settings)
+    for matches, expected in zip(found_matches, expected_matches):
+        assert np.all(matches.index == expected.index), "Expected same candidates."
+        assert np.allclose(matches.values.astype(float), expected.values.astype(float)), "Expected same scores."
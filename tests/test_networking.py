@@ -0,0 +1,167 @@
+import networkx as nx
+import numpy as np
+import pytest
+from custom_functions.networking import (add_intra_cluster_links, create_network, dilate_cluster, erode_clusters,
+                                         evaluate_clusters, refine_network, split_cluster,
+                                         weak_link_finder)
+
+
+def create_network_loop(similars_idx, similars, max_links, cutoff, link_method):
+    """Reference implementation adding the links node by node."""
+    msnet = nx.Graph()
+    msnet.add_nodes_from(np.arange(0, similars_idx.shape[0]))
+    for i in range(0, similars_idx.shape[0]):
+        idx = np.where(similars[i, :] > cutoff)[0][:max_links]
+        new_edges = [(i, int(similars_idx[i, x]), float(similars[i, x])) for x in idx
+                     if similars_idx[i, x] != i
+                     and (link_method == "single" or i in similars_idx[similars_idx[i, x], :])]
+        msnet.add_weighted_edges_from(new_edges)
+    return msnet
+
+
+def get_top_n(n_nodes=50, top_n=6, seed=0):
+    rng = np.random.default_rng(seed)
+    similarities = rng.random((n_nodes, n_nodes))
+    # Not symmetric, so that both directions of a link can have different weights
+    similarities = (similarities + 0.5 * similarities.T) / 1.5
+    similars_idx = np.argsort(similarities, axis=1)[:, ::-1][:, :top_n]
+    # Include some self-links
+    similars_idx[::7, 0] = np.arange(0, n_nodes, 7)
+    return similars_idx, np.take_along_axis(similarities, similars_idx, axis=1)
+
+
+@pytest.mark.parametrize("link_method", ["single", "mutual"])
+def test_create_network(link_method):
+    similars_idx, similars = get_top_n()
+    expected = create_network_loop(similars_idx, similars, max_links=4, cutoff=0.6, link_method=link_method)
+    msnet = create_network(similars_idx, similars, max_links=4, cutoff=0.6, link_method=link_method)
+    assert list(msnet.nodes) == list(expected.nodes), "Expected same nodes."
+    assert list(msnet.edges(data="weight")) == list(expected.edges(data="weight")), "Expected same edges."
+    assert nx.number_of_selfloops(msnet) == 0, "Expected no self-links."
+
+
+def test_create_network_scipy():
+    similars_idx, similars = get_top_n()
+    msnet = create_network(similars_idx, similars, max_links=4, cutoff=0.6)
+    adjacency = create_network(similars_idx, similars, max_links=4, cutoff=0.6, output_format="scipy")
+    expected = nx.to_numpy_array(msnet, nodelist=range(50))
+    assert np.all(adjacency.toarray() == expected), "Expected same adjacency matrix."
+
+
+def get_clustered_network(n_groups=3, group_size=12, seed=0):
+    """Dense groups of nodes, connected by single weak links."""
+    rng = np.random.default_rng(seed)
+    graph = nx.Graph()
+    graph.add_nodes_from(range(n_groups * group_size))
+    for group in range(n_groups):
+        nodes = np.arange(group * group_size, (group + 1) * group_size)
+        for i, node in enumerate(nodes):
+            for other in nodes[i + 1:]:
+                if rng.random() < 0.5 or other == node + 1:
+                    graph.add_edge(int(node), int(other), weight=0.8 + 0.2 * rng.random())
+        if group > 0:
+            graph.add_edge(int(nodes[0]) - 1, int(nodes[0]), weight=0.61)
+    return graph
+
+
+def test_refine_network_splits_weak_links():
+    np.random.seed(0)
+    graph = get_clustered_network()
+    graph_refined, _, links_removed = refine_network(graph.copy(), None, None, max_cluster_size=20,
+                                                     min_cluster_size=5, max_search_steps=200, max_cuts=1,
+                                                     basic_splitting=False)
+    assert sorted(links_removed) == [(11, 12), (23, 24)], "Expected weak links to be removed."
+    assert [len(x) for x in nx.connected_components(graph_refined)] == [12, 12, 12], "Expected 3 clusters."
+
+
+@pytest.mark.parametrize("weak_link_method", ["sampled", "exact"])
+def test_refine_network_same_links_as_repeated_splitting(weak_link_method):
+    graph = get_clustered_network(n_groups=6, group_size=8)
+    graph.add_edge(3, 30, weight=0.62)
+    graph.add_edge(20, 45, weight=0.62)
+    edges = list(graph.edges)
+
+    # Splitting the whole graph again in every iteration
+    np.random.seed(0)
+    graph_expected = graph.copy()
+    expected_links = []
+    for _ in range(10):
+        if max(len(x) for x in nx.connected_components(graph_expected)) <= 10:
+            break
+        graph_expected, links = split_cluster(graph_expected.copy(), max_cluster_size=10, min_cluster_size=4,
+                                              max_search_steps=200, max_cuts=2, weak_link_method=weak_link_method)
+        expected_links.extend(links)
+
+    np.random.seed(0)
+    graph_refined, _, links_removed = refine_network(graph, None, None, max_cluster_size=10, min_cluster_size=4,
+                                                     max_search_steps=200, max_cuts=2, basic_splitting=False,
+                                                     weak_link_method=weak_link_method)
+    assert links_removed == expected_links, "Expected same links to be removed."
+    assert sorted(graph_refined.edges) == sorted(graph_expected.edges), "Expected same refined network."
+    assert list(graph.edges) == edges, "Expected input network to be unchanged."
+
+
+def test_erode_and_dilate_clusters():
+    graph = get_clustered_network()
+    graph_eroded, links_removed = erode_clusters(graph.copy(), max_cluster_size=20, keep_weights_above=0.7)
+    assert sorted(links_removed) == [(11, 12), (23, 24)], "Expected weakest links to be removed."
+    assert max(len(x) for x in nx.connected_components(graph_eroded)) == 12, "Expected smaller clusters."
+
+    graph_eroded.add_node(36)
+    similars_idx = np.array([[(i + 1) % 37, i] for i in range(37)])
+    similars = np.ones((37, 2)) * 0.9
+    graph_dilated, links_added = dilate_cluster(graph_eroded, similars_idx, similars, max_cluster_size=13,
+                                                min_cluster_size=2)
+    assert links_added == [(36, 0)], "Expected singleton to be linked to a cluster of size 12."
+
+
+def test_evaluate_clusters():
+    graph = get_clustered_network()
+    graph.remove_edge(11, 12)
+    graph = add_intra_cluster_links(graph, np.ones((36, 36)), min_weight=0.5, max_links=100)
+    m_sim_ref = np.random.default_rng(1).random((36, 36))
+    cluster_data = evaluate_clusters(graph, m_sim_ref)
+    assert list(cluster_data["num_nodes"]) == [12, 24], "Expected two clusters."
+    assert cluster_data["num_edges"][0] == 66, "Expected fully connected cluster."
+    assert np.isclose(cluster_data["ref_sim_mean_nodes"][0], m_sim_ref[:12, :12].mean()), \
+        "Expected mean reference similarity of cluster."
+
+
+def test_weak_link_finder_exact():
+    graph = get_clustered_network()
+    n_links, cuts, counts, part_sizes = weak_link_finder(graph, max_cuts=1, method="exact")[0]
+    assert n_links == 1 and cuts.tolist() == [[11, 12], [23, 24]], "Expected both bridges."
+    assert counts.tolist() == [288, 288] and sorted(part_sizes[0]) == [12, 24], \
+        "Expected number of separated node pairs and part sizes."
+
+    graph.add_edge(0, 30, weight=0.6)
+    assert weak_link_finder(graph, max_cuts=1, method="exact") == [], "Expected no more bridges."
+    cuts_found = weak_link_finder(graph, max_cuts=2, method="exact")
+    assert [x[0] for x in cuts_found] == [2], "Expected only cuts of 2 links."
+    assert len(cuts_found[0][1]) == 2, "Expected one cut per Gomory-Hu tree edge between the groups."
+    assert all(x in [[0, 30, 11, 12], [0, 30, 23, 24], [11, 12, 23, 24]] for x in cuts_found[0][1].tolist()), \
+        "Expected cuts of 2 links between the groups."
+    assert np.all(cuts_found[0][3].sum(axis=1) == 36), "Expected sizes of both separated parts."
+
+    graph_refined, _, links_removed = refine_network(graph, None, None, max_cluster_size=20, min_cluster_size=5,
+                                                     max_cuts=2, basic_splitting=False, weak_link_method="exact")
+    assert sorted(links_removed) == [(0, 30), (11, 12), (23, 24)], "Expected links between groups removed."
+    assert [len(x) for x in nx.connected_components(graph_refined)] == [12, 12, 12], "Expected 3 clusters."
+
+
+def test_weak_link_finder_same_fields_for_both_methods():
+    graph = get_clustered_network()
+    for method in ["sampled", "exact"]:
+        weak_links = weak_link_finder(graph, max_steps=200, max_cuts=1, method=method)[0]
+        assert weak_links.n_links == 1, "Expected cuts of one link."
+        assert sorted(weak_links.cuts.tolist()) == [[11, 12], [23, 24]], "Expected both bridges."
+        assert len(weak_links.counts) == 2 and np.all(weak_links.counts > 0), \
+            "Expected number of separated node pairs per cut."
+    assert weak_links.part_sizes.shape == (2, 2), "Expected part sizes for exact method."
+
+
+def test_weak_link_finder_exact_requires_connected_graph():
+    graph = nx.Graph([(0, 1), (1, 2), (3, 4), (4, 5), (5, 6), (6, 3)])
+    for max_cuts in [1, 2]:
+        with pytest.raises(AssertionError, match="connected graph"):
+            weak_link_finder(graph, max_cuts=max_cuts, method="exact")
@@ -0,0 +1,63 @@
+import pickle
+import numpy as np
+import pytest
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from custom_functions.packed_spectra import PackedSpectra, score_packed_pair, spectra_hash
+from custom_functions.parallel_scoring import score_pairs
+from custom_functions.similarity_matrix import all_vs_all_similarity_matrix
+from utils import create_test_data
+
+
+def get_test_spectrums(n_spectrums=12):
+    documents, _, _ = create_test_data(n_library=n_spectrums, n_query=0)
+    return [x._obj for x in documents]
+
+
+def test_packed_spectra_from_spectra():
+    spectrums = get_test_spectrums()
+    packed_spectra = PackedSpectra.from_spectra(spectrums)
+    assert len(packed_spectra) == 12, "Expected 12 spectra."
+    assert np.all(packed_spectra.peaks_of(3) == spectrums[3].peaks.to_numpy), "Expected same peaks."
+    assert packed_spectra.precursor_mz[3] == spectrums[3].get("precursor_mz"), "Expected same precursor m/z."
+    subset = pickle.loads(pickle.dumps(packed_spectra.subset([5, 1])))
+    assert np.all(subset.peaks_of(1) == spectrums[1].peaks.to_numpy), "Expected same peaks in subset."
+    assert subset.precursor_mz[0] == spectrums[5].get("precursor_mz"), "Expected same precursor m/z in subset."
+
+
+def test_spectra_hash():
+    spectrums = get_test_spectrums()
+    assert spectra_hash(spectrums) == PackedSpectra.from_spectra(spectrums).content_hash(), \
+        "Expected same hash for spectra and packed spectra."
+    assert spectra_hash(spectrums[:6]) != spectra_hash(spectrums[6:]), "Expected different hash for other spectra."
+    shifted = [s.clone() for s in spectrums]
+    shifted[3].set("precursor_mz", shifted[3].get("precursor_mz") + 1.0)
+    assert spectra_hash(shifted) != spectra_hash(spectrums), "Expected different hash for other precursor m/z."
+
+
+@pytest.mark.parametrize("similarity_function", [CosineGreedy(tolerance=0.5), ModifiedCosine(tolerance=0.5),
+                                                 CosineGreedy(tolerance=0.5, mz_power=1.0)])
+def test_score_packed_pair_same_as_matchms(similarity_function):
+    spectrums = get_test_spectrums()
+    packed_spectra = PackedSpectra.from_spectra(spectrums)
+    for i in range(12):
+        for j in range(12):
+            expected = similarity_function.pair(spectrums[i], spectrums[j])
+            score, matches = score_packed_pair(packed_spectra, i, packed_spectra, j, similarity_function)
+            assert score == expected["score"] and matches == expected["matches"], "Expected same score."
+
+
+def test_scoring_with_packed_spectra():
+    spectrums = get_test_spectrums()
+    packed_spectra = PackedSpectra.from_spectra(spectrums)
+    modcos = ModifiedCosine(tolerance=0.5)
+    similarities, num_matches = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=1, tile_size=(5, 5))
+    similarities_packed, num_matches_packed = all_vs_all_similarity_matrix(packed_spectra, modcos, n_jobs=2,
+                                                                           tile_size=(5, 5))
+    assert np.all(similarities == similarities_packed), "Expected same scores."
+    assert np.all(num_matches == num_matches_packed), "Expected same matches."
+
+    pairs = np.array([[0, 1], [4, 2], [3, 3]])
+    scores, matches = score_pairs(packed_spectra, packed_spectra, pairs, modcos, n_jobs=1)
+    assert np.all(scores == similarities[pairs[:, 0], pairs[:, 1]]), "Expected same scores for pairs."
+    with pytest.raises(AssertionError):
+        score_pairs(packed_spectra, spectrums, pairs, modcos, n_jobs=1)
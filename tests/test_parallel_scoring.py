@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from custom_functions.packed_spectra import PackedSpectra
+from custom_functions.parallel_scoring import ScoringPool, make_tiles, score_pairs, top_n_scores
+from utils import create_test_data
+
+
+def test_make_tiles():
+    tiles = make_tiles(5, 3, tile_size=(2, 2))
+    assert tiles == [(0, 2, 0, 2), (0, 2, 2, 3), (2, 4, 0, 2), (2, 4, 2, 3), (4, 5, 0, 2), (4, 5, 2, 3)], \
+        "Expected different tiles."
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_top_n_scores_same_as_full_matrix(n_jobs):
+    documents_library, documents_query, _ = create_test_data(n_library=25, n_query=5)
+    references = [x._obj for x in documents_library]
+    queries = [x._obj for x in documents_query]
+    modcos = ModifiedCosine(tolerance=0.5)
+
+    scores = np.zeros((len(references), len(queries)))
+    matches = np.zeros((len(references), len(queries)))
+    for i, reference in enumerate(references):
+        for j, query in enumerate(queries):
+            score = modcos.pair(reference, query)
+            scores[i, j] = score["score"]
+            matches[i, j] = score["matches"]
+    scores_selected = scores.copy()
+    scores_selected[matches < 2] = 0
+    expected_ids = np.argpartition(scores_selected, -3, axis=0)[-3:, :]
+
+    selected_ids, selected_scores, selected_matches = top_n_scores(references, queries, modcos, 3,
+                                                                   min_matches=2, n_jobs=n_jobs,
+                                                                   tile_size=(7, 2))
+    for j in range(len(queries)):
+        # Selection can only differ for tied scores
+        assert np.allclose(np.sort(scores_selected[selected_ids[:, j], j]),
+                           np.sort(scores_selected[expected_ids[:, j], j])), "Expected same selection."
+        assert np.allclose(selected_scores[:, j], scores[selected_ids[:, j], j]), "Expected same scores."
+        assert np.all(selected_matches[:, j] == matches[selected_ids[:, j], j]), "Expected same matches."
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_score_pairs(n_jobs):
+    documents_library, documents_query, _ = create_test_data(n_library=10, n_query=3)
+    references = [x._obj for x in documents_library]
+    queries = [x._obj for x in documents_query]
+    modcos = ModifiedCosine(tolerance=0.5)
+    pairs = np.array([[0, 0], [5, 2], [9, 1], [5, 2], [3, 0]])
+    scores, matches = score_pairs(references, queries, pairs, modcos, n_jobs=n_jobs, batch_size=2)
+    for (i_ref, i_query), score, match in zip(pairs, scores, matches):
+        expected = modcos.pair(references[i_ref], queries[i_query])
+        assert score == pytest.approx(expected["score"], 1e-9), "Expected different score."
+        assert match == expected["matches"], "Expected different number of matches."
+
+
+def test_score_pairs_no_pairs():
+    documents_library, documents_query, _ = create_test_data(n_library=3, n_query=1)
+    scores, matches = score_pairs([x._obj for x in documents_library], [x._obj for x in documents_query],
+                                  np.empty((0, 2), dtype="int"), ModifiedCosine())
+    assert scores.shape == (0,) and matches.shape == (0,), "Expected empty results."
+
+
+@pytest.mark.parametrize("n_jobs, mp_context", [[1, None], [2, None], [2, "spawn"]])
+def test_scoring_pool_reused_for_several_query_chunks(n_jobs, mp_context):
+    documents_library, documents_query, _ = create_test_data(n_library=25, n_query=6)
+    references = PackedSpectra.from_spectra(documents_library)
+    pairs = np.array([(i, j) for i in range(0, 25, 3) for j in range(3)])
+    with ScoringPool(references, n_jobs=n_jobs, mp_context=mp_context) as pool:
+        pool.start()
+        for chunk_start in [0, 3]:
+            queries = PackedSpectra.from_spectra(documents_query[chunk_start:(chunk_start + 3)])
+            for similarity_function in [CosineGreedy(tolerance=0.5), ModifiedCosine(tolerance=0.5)]:
+                scores, matches = score_pairs(references, queries, pairs, similarity_function, batch_size=5,
+                                              pool=pool)
+                expected_scores, expected_matches = score_pairs(references, queries, pairs, similarity_function,
+                                                                n_jobs=1)
+                assert np.all(scores == expected_scores), "Expected same scores with ScoringPool."
+                assert np.all(matches == expected_matches), "Expected same matches with ScoringPool."
+            selected_ids, _, _ = top_n_scores(references, queries, ModifiedCosine(tolerance=0.5), 3,
+                                              tile_size=(7, 2), pool=pool)
+            expected_ids, _, _ = top_n_scores(references, queries, ModifiedCosine(tolerance=0.5), 3, n_jobs=1,
+                                              tile_size=(7, 2))
+            assert np.all(selected_ids == expected_ids), "Expected same selection with ScoringPool."
+        with pytest.raises(AssertionError):
+            score_pairs(queries, queries, pairs[:2], CosineGreedy(), pool=pool)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from custom_functions.score_bounds import ScoreUpperBound
+from custom_functions.similarity_matrix import all_vs_all_similarity_matrix
+from utils import create_test_data
+
+
+def get_test_spectrums(n_spectrums=12):
+    documents, _, _ = create_test_data(n_library=n_spectrums, n_query=0)
+    return [x._obj for x in documents]
+
+
+@pytest.mark.parametrize("similarity_function", [CosineGreedy(tolerance=0.5), ModifiedCosine(tolerance=0.5),
+                                                 CosineGreedy(tolerance=0.2, mz_power=1.0)])
+def test_score_upper_bound(similarity_function):
+    spectrums = get_test_spectrums()
+    upper_bound = ScoreUpperBound(spectrums, spectrums, similarity_function)
+    score_bounds, matches_bounds = upper_bound.tile((0, 12, 2, 9))
+    assert score_bounds.shape == (12, 7), "Expected bounds for all pairs of the tile."
+    pairs = upper_bound.candidate_pairs((0, 12, 2, 9), score_cutoff=0.5, min_matches=2)
+    pairs_triangle = upper_bound.candidate_pairs((0, 12, 2, 9), score_cutoff=0.5, min_matches=2,
+                                                 upper_triangle=True)
+    assert upper_bound.n_pairs_checked == 84 + 42, "Expected number of checked pairs."
+    assert upper_bound.n_pairs_pruned == 84 + 42 - len(pairs) - len(pairs_triangle), \
+        "Expected number of pruned pairs."
+    for i in range(12):
+        for j in range(2, 9):
+            score = similarity_function.pair(spectrums[i], spectrums[j])
+            assert score["score"] <= score_bounds[i, j - 2] + 1e-9, "Expected upper bound of score."
+            assert score["matches"] <= matches_bounds[i, j - 2], "Expected upper bound of matches."
+
+
+@pytest.mark.parametrize("similarity_function", [CosineGreedy(tolerance=0.5), ModifiedCosine(tolerance=0.5)])
+def test_all_vs_all_similarity_matrix_prune_with_upper_bound(similarity_function, capsys):
+    spectrums = get_test_spectrums(15)
+    expected = all_vs_all_similarity_matrix(spectrums, similarity_function, n_jobs=1, tile_size=(4, 4),
+                                            score_cutoff=0.3, min_matches=2)
+    pruning_statistics = {}
+    pruned = all_vs_all_similarity_matrix(spectrums, similarity_function, n_jobs=1, tile_size=(4, 4),
+                                          score_cutoff=0.3, min_matches=2, prune_with_upper_bound=True,
+                                          pruning_statistics=pruning_statistics)
+    assert "Pruned" in capsys.readouterr().out, "Expected number of pruned pairs to be reported."
+    upper_bound = ScoreUpperBound(spectrums, spectrums, similarity_function)
+    score_bounds, matches_bounds = upper_bound.tile((0, 15, 0, 15))
+    in_triangle = np.triu(np.ones((15, 15), dtype=bool))
+    expected_pruned = np.sum(in_triangle & ((score_bounds * (1 + 1e-6) + 1e-12 <= 0.3) | (matches_bounds < 2)))
+    assert pruning_statistics == {"n_pairs_checked": 120, "n_pairs_pruned": expected_pruned,
+                                  "n_pairs_scored": 120 - expected_pruned}, "Expected pruning statistics."
+    assert 0 < expected_pruned < 120, "Expected some but not all pairs to be pruned."
+    assert len(pruned) == len(expected) and np.all(pruned.indices == expected.indices), "Expected same entries."
+    assert np.all(pruned.scores == expected.scores), "Expected same scores."
+    assert np.all(pruned.matches == expected.matches), "Expected same matches."
+
+    pruned_windows = all_vs_all_similarity_matrix(spectrums, similarity_function, n_jobs=1, score_cutoff=0.3,
+                                                  min_matches=2, max_precursor_difference=5.5,
+                                                  prune_with_upper_bound=True)
+    rows, columns, scores, _ = pruned_windows.to_coo()
+    precursor_mz = np.array([s.get("precursor_mz") for s in spectrums])
+    expected_scores, _ = expected.to_dense()
+    in_window = np.abs(precursor_mz.reshape(-1, 1) - precursor_mz.reshape(1, -1)) <= 5.5
+    assert len(pruned_windows) == np.sum((expected_scores > 0) & in_window), "Expected same entries in windows."
+    assert np.all(scores == expected_scores[rows, columns]), "Expected same scores in windows."
+
+
+def test_score_upper_bound_requires_tolerance():
+    spectrums = get_test_spectrums(4)
+    with pytest.raises(AssertionError, match="tolerance > 0"):
+        ScoreUpperBound(spectrums, spectrums, CosineGreedy(tolerance=0))
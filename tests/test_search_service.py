@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+from custom_functions.library_search import library_matching
+from custom_functions.search_service import LibrarySearchService, search_remote
+from utils import create_test_data
+
+
+SETTINGS = {"presearch_based_on": ["precursor_mz", "spec2vec-top3"],
+            "include_scores": ["spec2vec", "cosine"],
+            "intensity_weighting_power": 0.5,
+            "allowed_missing_percentage": 5.0,
+            "mass_tolerance": 0.5,
+            "mass_tolerance_type": "Dalton"}
+
+
+def test_search_service_batches_requests():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=6)
+    expected_matches = library_matching(documents_query, documents_library, model, **SETTINGS)
+    service = LibrarySearchService(documents_library, model, max_wait=0.5, **SETTINGS)
+    try:
+        futures = [service.submit(documents_query[i:(i + 2)]) for i in range(0, 6, 2)]
+        results = [future.result(timeout=60) for future in futures]
+    finally:
+        service.close()
+
+    found_matches = [matches for result in results for matches in result["matches"]]
+    for matches, expected in zip(found_matches, expected_matches):
+        pd.testing.assert_frame_equal(matches, expected)
+    assert [x["batch_size"] for x in results] == [6, 6, 6], "Expected requests to be combined."
+    statistics = service.statistics()
+    assert statistics["n_requests"] == 3 and statistics["max_batch_size"] == 6, \
+        "Expected statistics of all requests."
+
+
+def test_search_service_error_only_for_failing_request():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=4)
+    expected_matches = library_matching(documents_query, documents_library, model, **SETTINGS)
+    # Peaks are not in the model vocabulary
+    unknown_spectrum = Spectrum(mz=np.array([1000.0, 1100.0]), intensities=np.array([0.5, 1.0]),
+                                metadata={"precursor_mz": 1200.0})
+    service = LibrarySearchService(documents_library, model, max_wait=0.5, **SETTINGS)
+    try:
+        futures = [service.submit(documents_query[:2]), service.submit([unknown_spectrum]),
+                   service.submit(documents_query[2:])]
+        found_matches = futures[0].result(timeout=60)["matches"] + futures[2].result(timeout=60)["matches"]
+        assert futures[1].exception(timeout=60) is not None, "Expected error for unknown spectrum."
+    finally:
+        service.close()
+
+    for matches, expected in zip(found_matches, expected_matches):
+        pd.testing.assert_frame_equal(matches, expected)
+    assert service.statistics()["n_requests"] == 2, "Expected statistics of successful requests."
+
+
+def test_search_service_http():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=3)
+    expected_matches = library_matching(documents_query, documents_library, model, **SETTINGS)
+    service = LibrarySearchService(documents_library, model, max_batch_size=2, **SETTINGS)
+    url = service.serve()
+    try:
+        found_matches = search_remote(url, [x._obj for x in documents_query])
+    finally:
+        service.close()
+
+    assert len(found_matches) == 3, "Expected results for all queries."
+    for records, expected in zip(found_matches, expected_matches):
+        assert [x["library_id"] for x in records] == list(expected.index), "Expected same candidates."
+        assert np.allclose([x["s2v_score"] for x in records], expected["s2v_score"]), \
+            "Expected same scores."
+
+
+def test_search_service_keeps_packed_library_and_scoring_pool():
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=4)
+    settings = dict(SETTINGS, include_scores=["spec2vec", "cosine", "modcosine"], n_jobs=2)
+    expected_matches = library_matching(documents_query, documents_library, model, **settings)
+    service = LibrarySearchService(documents_library, model, **settings)
+    try:
+        scoring_pool = service.scoring_pool
+        assert scoring_pool.references is service.library_index.packed_spectra(), \
+            "Expected library to be packed once."
+        found_matches = service.search(documents_query[:2]) + service.search(documents_query[2:])
+        assert service.scoring_pool is scoring_pool, "Expected same scoring pool for all requests."
+    finally:
+        service.close()
+    for matches, expected in zip(found_matches, expected_matches):
+        pd.testing.assert_frame_equal(matches, expected)
+
+    service = LibrarySearchService(documents_library, model, **SETTINGS)
+    service.close()
+    service_spec2vec = LibrarySearchService(documents_library, model,
+                                            **dict(SETTINGS, include_scores=["spec2vec"]))
+    service_spec2vec.close()
+    assert service.scoring_pool is not None and service_spec2vec.scoring_pool is None, \
+        "Expected scoring pool only for cosine scores."
+
+
+def test_search_service_is_quiet(capsys):
+    documents_library, documents_query, model = create_test_data(n_library=30, n_query=2)
+    service = LibrarySearchService(documents_library, model, **SETTINGS)
+    try:
+        service.search(documents_query)
+    finally:
+        service.close()
+    captured = capsys.readouterr()
+    assert captured.out == "" and captured.err == "", "Expected no messages or progress bars."
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from custom_functions.sharded_scoring import ShardedTileQueue, run_worker
+from custom_functions.similarity_matrix import all_vs_all_similarity_matrix
+from utils import create_test_data
+
+
+class SlowCosine(CosineGreedy):
+    """CosineGreedy that takes at least 0.02 s per pair."""
+    def pair(self, reference, query):
+        time.sleep(0.02)
+        return super().pair(reference, query)
+
+
+def get_test_spectrums(n_spectrums=12):
+    documents, _, _ = create_test_data(n_library=n_spectrums, n_query=0)
+    return [x._obj for x in documents]
+
+
+def test_sharded_scoring_with_local_worker_processes(tmp_path):
+    spectrums = get_test_spectrums()
+    modcos = ModifiedCosine(tolerance=0.5)
+    shared_folder = os.path.join(tmp_path, "queue")
+    queue = ShardedTileQueue.create(shared_folder, spectrums, modcos, tile_size=(3, 3))
+    assert len(queue.missing_tiles()) == 10, "Expected 10 upper triangle tiles."
+
+    workers = [multiprocessing.Process(target=run_worker, args=(shared_folder,)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert queue.missing_tiles() == [], "Expected all tiles to be finished."
+    assert len(os.listdir(os.path.join(shared_folder, "tiles"))) == 10, "Expected one file per tile."
+    assert len(os.listdir(os.path.join(shared_folder, "locks"))) == 10, "Expected every tile claimed once."
+
+    expected_similarities, expected_matches = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=1)
+    similarities, num_matches = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=0, tile_size=(3, 3),
+                                                             shared_folder=shared_folder)
+    assert np.all(similarities == expected_similarities), "Expected identical scores."
+    assert np.all(num_matches == expected_matches), "Expected identical matches."
+
+    score_matrix = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=0, tile_size=(3, 3),
+                                                shared_folder=shared_folder,
+                                                output_folder=os.path.join(tmp_path, "matrix"))
+    assert np.allclose(score_matrix.to_dense()[0], expected_similarities, atol=1e-6), \
+        "Expected same scores in condensed matrix."
+    sparse_matrix = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=0, tile_size=(3, 3),
+                                                 shared_folder=shared_folder, score_cutoff=0.2)
+    assert np.all(sparse_matrix.to_dense()[0] == np.where(expected_similarities > 0.2, expected_similarities, 0)), \
+        "Expected same scores in sparse matrix."
+
+
+def test_sharded_scoring_stale_lock(tmp_path):
+    spectrums = get_test_spectrums(6)
+    queue = ShardedTileQueue.create(str(tmp_path), spectrums, CosineGreedy(), tile_size=(3, 3))
+    assert queue.claim((0, 3, 0, 3)), "Expected first claim to succeed."
+    assert not queue.claim((0, 3, 0, 3)), "Expected tile to be locked."
+
+    assert run_worker(str(tmp_path)) == 2, "Expected locked tile to be skipped."
+    with pytest.raises(AssertionError):
+        list(queue.iter_tiles())
+    with pytest.raises(TimeoutError):
+        queue.wait(poll_interval=0.01, timeout=0.05)
+    assert run_worker(str(tmp_path), lock_timeout=0) == 1, "Expected stale lock to be taken over."
+    assert queue.missing_tiles() == [], "Expected all tiles to be finished."
+
+
+def test_sharded_scoring_refreshes_lock_of_long_tile(tmp_path):
+    spectrums = get_test_spectrums(6)
+    queue = ShardedTileQueue.create(str(tmp_path), spectrums, SlowCosine(), tile_size=(6, 6))
+    worker = threading.Thread(target=queue.run_worker, kwargs={"heartbeat_interval": 0.02})
+    worker.start()
+    try:
+        time.sleep(0.2)
+        assert not queue.is_finished((0, 6, 0, 6)), "Expected tile to still be computed."
+        assert not queue.claim((0, 6, 0, 6), lock_timeout=0.1), "Expected refreshed lock not to be taken over."
+    finally:
+        worker.join()
+    assert queue.missing_tiles() == [], "Expected tile to be finished."
+
+
+def test_sharded_scoring_checks_settings(tmp_path):
+    spectrums = get_test_spectrums(6)
+    ShardedTileQueue.create(str(tmp_path), spectrums, CosineGreedy(), tile_size=(3, 3))
+    with pytest.raises(AssertionError):
+        ShardedTileQueue.create(str(tmp_path), spectrums, CosineGreedy(), tile_size=(2, 2))
+    with pytest.raises(AssertionError, match="different settings"):
+        ShardedTileQueue.create(str(tmp_path), spectrums, CosineGreedy(tolerance=0.2), tile_size=(3, 3))
+    other_spectrums = get_test_spectrums(12)[6:]
+    with pytest.raises(AssertionError, match="different settings"):
+        ShardedTileQueue.create(str(tmp_path), other_spectrums, CosineGreedy(), tile_size=(3, 3))
+    assert ShardedTileQueue.create(str(tmp_path), spectrums, CosineGreedy(), tile_size=(3, 3)).n_spectrums == 6, \
+        "Expected existing queue for same settings."
+
+
+def test_all_vs_all_similarity_matrix_resumes_stale_lock(tmp_path):
+    spectrums = get_test_spectrums(6)
+    cosine = CosineGreedy()
+    queue = ShardedTileQueue.create(str(tmp_path), spectrums, cosine, tile_size=(3, 3))
+    assert queue.claim((0, 3, 3, 6)), "Expected claim of crashed worker to succeed."
+
+    with pytest.raises(TimeoutError):
+        all_vs_all_similarity_matrix(spectrums, cosine, n_jobs=1, tile_size=(3, 3), shared_folder=str(tmp_path),
+                                     wait_timeout=0.05, poll_interval=0.01)
+    assert queue.missing_tiles() == [(0, 3, 3, 6)], "Expected locked tile to be skipped."
+
+    similarities, num_matches = all_vs_all_similarity_matrix(spectrums, cosine, n_jobs=1, tile_size=(3, 3),
+                                                             shared_folder=str(tmp_path), lock_timeout=0,
+                                                             wait_timeout=1, poll_interval=0.01)
+    expected_similarities, expected_matches = all_vs_all_similarity_matrix(spectrums, cosine, n_jobs=1)
+    assert np.all(similarities == expected_similarities), "Expected identical scores."
+    assert np.all(num_matches == expected_matches), "Expected identical matches."
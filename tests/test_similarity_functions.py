@@ -0,0 +1,38 @@
+import numpy as np
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from custom_functions.packed_spectra import PackedSpectra
+from custom_functions.similarity_functions import CosineAndModifiedCosine
+from custom_functions.similarity_matrix import all_vs_all_similarity_matrix
+from utils import create_test_data
+
+
+def get_test_spectrums(n_spectrums=12):
+    documents, _, _ = create_test_data(n_library=n_spectrums, n_query=0)
+    return [x._obj for x in documents]
+
+
+def test_cosine_and_modified_cosine_pair():
+    spectrums = get_test_spectrums()
+    similarity_function = CosineAndModifiedCosine(tolerance=0.5)
+    for reference in spectrums:
+        for query in spectrums:
+            score = similarity_function.pair(reference, query)
+            expected_cosine = CosineGreedy(tolerance=0.5).pair(reference, query)
+            expected_modcos = ModifiedCosine(tolerance=0.5).pair(reference, query)
+            assert np.all(score["score"] == [expected_cosine["score"], expected_modcos["score"]]), \
+                "Expected same scores."
+            assert np.all(score["matches"] == [expected_cosine["matches"], expected_modcos["matches"]]), \
+                "Expected same matches."
+
+
+def test_all_vs_all_similarity_matrix_cosine_and_modified_cosine():
+    spectrums = get_test_spectrums()
+    similarities, num_matches = all_vs_all_similarity_matrix(PackedSpectra.from_spectra(spectrums),
+                                                             CosineAndModifiedCosine(tolerance=0.5),
+                                                             n_jobs=1, tile_size=(5, 5))
+    assert similarities.shape == (12, 12, 2), "Expected cosine and modified cosine scores."
+    for i, similarity_function in enumerate([CosineGreedy(tolerance=0.5), ModifiedCosine(tolerance=0.5)]):
+        expected_similarities, expected_matches = all_vs_all_similarity_matrix(spectrums, similarity_function,
+                                                                               n_jobs=1)
+        assert np.all(similarities[:, :, i] == expected_similarities), "Expected same scores."
+        assert np.all(num_matches[:, :, i] == expected_matches), "Expected same matches."
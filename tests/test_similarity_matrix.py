@@ -0,0 +1,306 @@
+import os
+import numpy as np
+import pytest
+from matchms.similarity import CosineGreedy, ModifiedCosine
+from custom_functions.packed_spectra import PackedSpectra, spectra_hash
+from custom_functions.parallel_scoring import make_upper_triangle_tiles
+from custom_functions.score_storage import CondensedScoreMatrix, SparseScoreMatrix
+from custom_functions.similarity_matrix import (TileJournal, all_vs_all_similarity_matrix,
+                                                extend_similarity_matrix, precursor_window_pairs)
+from utils import create_test_data
+
+
+class CrashingCosine(CosineGreedy):
+    """CosineGreedy that counts computed pairs and fails after max_pairs pairs."""
+    def __init__(self, max_pairs=None):
+        super().__init__()
+        # Private: not part of the similarity settings stored in checkpoints
+        self._max_pairs = max_pairs
+        self._n_pairs = 0
+
+    @property
+    def n_pairs(self):
+        return self._n_pairs
+
+    def pair(self, reference, query):
+        self._n_pairs += 1
+        if self._max_pairs is not None and self._n_pairs > self._max_pairs:
+            raise RuntimeError("Crash")
+        return super().pair(reference, query)
+
+
+def get_test_spectrums(n_spectrums=15):
+    documents, _, _ = create_test_data(n_library=n_spectrums, n_query=0)
+    return [x._obj for x in documents]
+
+
+def expected_similarity_matrix(spectrums, similarity_function):
+    similarities = np.zeros((len(spectrums), len(spectrums)))
+    num_matches = np.zeros((len(spectrums), len(spectrums)))
+    for i in range(len(spectrums)):
+        for j in range(i, len(spectrums)):
+            score = similarity_function.pair(spectrums[i], spectrums[j])
+            similarities[i, j] = similarities[j, i] = score["score"]
+            num_matches[i, j] = num_matches[j, i] = score["matches"]
+    return similarities, num_matches
+
+
+def test_make_upper_triangle_tiles():
+    tiles = make_upper_triangle_tiles(5, tile_size=(2, 2))
+    assert tiles == [(0, 2, 0, 2), (0, 2, 2, 4), (0, 2, 4, 5), (2, 4, 2, 4), (2, 4, 4, 5), (4, 5, 4, 5)], \
+        "Expected only tiles in upper triangle."
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_all_vs_all_similarity_matrix(n_jobs):
+    spectrums = get_test_spectrums()
+    modcos = ModifiedCosine(tolerance=0.5)
+    similarities, num_matches = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=n_jobs,
+                                                             tile_size=(4, 4))
+    expected_similarities, expected_matches = expected_similarity_matrix(spectrums, modcos)
+    assert np.all(similarities == expected_similarities), "Expected identical scores."
+    assert np.all(num_matches == expected_matches), "Expected identical matches."
+
+
+def test_all_vs_all_similarity_matrix_save(tmp_path):
+    spectrums = get_test_spectrums(6)
+    filename = os.path.join(tmp_path, "similarities.npy")
+    similarities, num_matches = all_vs_all_similarity_matrix(spectrums, CosineGreedy(), filename=filename,
+                                                             safety_points=2, n_jobs=1, tile_size=(2, 2))
+    assert np.all(np.load(filename) == similarities), "Expected stored scores."
+    assert np.all(np.load(os.path.join(tmp_path, "similarities_matches.npy")) == num_matches), \
+        "Expected stored matches."
+
+
+def test_all_vs_all_similarity_matrix_resume_from_checkpoint(tmp_path):
+    spectrums = get_test_spectrums(10)
+    checkpoint_folder = os.path.join(tmp_path, "checkpoints")
+    with pytest.raises(RuntimeError):
+        all_vs_all_similarity_matrix(spectrums, CrashingCosine(max_pairs=20), n_jobs=1,
+                                     tile_size=(3, 3), checkpoint_folder=checkpoint_folder)
+    journal = TileJournal(checkpoint_folder, 10, (3, 3), similarity_function=CrashingCosine(),
+                          spectra_hash=spectra_hash(spectrums))
+    assert len(journal.completed_tiles()) == 2, "Expected first two tiles to be finished."
+
+    similarity_function = CrashingCosine()
+    similarities, num_matches = all_vs_all_similarity_matrix(spectrums, similarity_function, n_jobs=1,
+                                                             tile_size=(3, 3),
+                                                             checkpoint_folder=checkpoint_folder)
+    assert similarity_function.n_pairs == 55 - 6 - 9, "Expected finished tiles to be skipped."
+    expected_similarities, expected_matches = expected_similarity_matrix(spectrums, CosineGreedy())
+    assert np.all(similarities == expected_similarities), "Expected identical scores."
+    assert np.all(num_matches == expected_matches), "Expected identical matches."
+
+
+def test_tile_journal_ignores_torn_lines(tmp_path):
+    journal = TileJournal(str(tmp_path), 10, (3, 3), similarity_function="CosineGreedy")
+    journal.add((0, 3, 0, 3), scores=np.ones((3, 3)), matches=np.ones((3, 3)))
+    with open(os.path.join(tmp_path, "completed_tiles.txt"), "a") as f:
+        f.write("0,3,")  # crash while writing
+    journal.add((0, 3, 3, 6), scores=np.ones((3, 3)), matches=np.ones((3, 3)))
+    with open(os.path.join(tmp_path, "completed_tiles.txt"), "a") as f:
+        f.write("3,6,3,6\n0,3,6,7\n")  # no tile file, and no tile of the computation
+    assert journal.completed_tiles() == {(0, 3, 0, 3), (0, 3, 3, 6)}, "Expected only finished tiles."
+    assert [tile for tile, _ in journal.load_tiles()] == [(0, 3, 0, 3), (0, 3, 3, 6)], \
+        "Expected all finished tiles to be loaded."
+
+
+def test_tile_journal_checks_settings(tmp_path):
+    TileJournal(str(tmp_path), 10, (3, 3), similarity_function="CosineGreedy")
+    with pytest.raises(AssertionError):
+        TileJournal(str(tmp_path), 10, (4, 4), similarity_function="CosineGreedy")
+
+
+@pytest.mark.parametrize("spectrums_slice, similarity_function", [[slice(12, 24), CosineGreedy()],
+                                                                  [slice(0, 12), CosineGreedy(tolerance=0.2)],
+                                                                  [slice(0, 12), CosineGreedy(mz_power=1.0)]])
+def test_all_vs_all_similarity_matrix_checkpoint_of_other_computation(tmp_path, spectrums_slice,
+                                                                      similarity_function):
+    spectrums = get_test_spectrums(24)
+    checkpoint_folder = os.path.join(tmp_path, "checkpoints")
+    all_vs_all_similarity_matrix(spectrums[:12], CosineGreedy(), n_jobs=1, tile_size=(3, 3),
+                                 checkpoint_folder=checkpoint_folder)
+    with pytest.raises(AssertionError, match="different settings"):
+        all_vs_all_similarity_matrix(spectrums[spectrums_slice], similarity_function, n_jobs=1, tile_size=(3, 3),
+                                     checkpoint_folder=checkpoint_folder)
+
+
+def test_all_vs_all_similarity_matrix_condensed_output(tmp_path):
+    spectrums = get_test_spectrums(10)
+    output_folder = os.path.join(tmp_path, "matrix")
+    score_matrix = all_vs_all_similarity_matrix(spectrums, CosineGreedy(), n_jobs=1, tile_size=(3, 4),
+                                                output_folder=output_folder)
+    expected_similarities, expected_matches = expected_similarity_matrix(spectrums, CosineGreedy())
+    assert score_matrix.scores.dtype == np.float32 and score_matrix.matches.dtype == np.uint16, \
+        "Expected reduced precision."
+    assert score_matrix.scores.shape == (55,), "Expected only upper triangle to be stored."
+    similarities, num_matches = score_matrix.to_dense()
+    assert np.allclose(similarities, expected_similarities, atol=1e-6), "Expected same scores."
+    assert np.all(num_matches == expected_matches), "Expected same matches."
+    assert np.allclose(score_matrix.row(4)[0], expected_similarities[4], atol=1e-6), "Expected same row."
+    scores_block, matches_block = score_matrix.block(slice(6, 9), slice(1, 5))
+    assert np.all(matches_block == expected_matches[6:9, 1:5]), "Expected same block."
+    for rows, columns in [(slice(2, 7), slice(4, 10)), (slice(0, 10, 3), slice(1, 8, 2))]:
+        scores_block, matches_block = score_matrix.block(rows, columns)
+        assert np.allclose(scores_block, expected_similarities[rows, columns], atol=1e-6), \
+            "Expected same block across the diagonal."
+        assert np.all(matches_block == expected_matches[rows, columns]), "Expected same block across the diagonal."
+
+
+def test_all_vs_all_similarity_matrix_condensed_resume(tmp_path):
+    spectrums = get_test_spectrums(10)
+    output_folder = os.path.join(tmp_path, "matrix")
+    checkpoint_folder = os.path.join(tmp_path, "checkpoints")
+    with pytest.raises(RuntimeError):
+        all_vs_all_similarity_matrix(spectrums, CrashingCosine(max_pairs=20), n_jobs=1, tile_size=(3, 3),
+                                     checkpoint_folder=checkpoint_folder, output_folder=output_folder)
+    similarity_function = CrashingCosine()
+    score_matrix = all_vs_all_similarity_matrix(spectrums, similarity_function, n_jobs=1, tile_size=(3, 3),
+                                                checkpoint_folder=checkpoint_folder,
+                                                output_folder=output_folder)
+    assert similarity_function.n_pairs == 55 - 6 - 9, "Expected finished tiles to be skipped."
+    assert not any(x.endswith(".npz") for x in os.listdir(checkpoint_folder)), \
+        "Expected no tile files for condensed output."
+    expected_similarities, _ = expected_similarity_matrix(spectrums, CosineGreedy())
+    assert np.allclose(score_matrix.to_dense()[0], expected_similarities, atol=1e-6), "Expected same scores."
+
+
+def test_extend_similarity_matrix(tmp_path):
+    spectrums = get_test_spectrums(10)
+    output_folder = os.path.join(tmp_path, "matrix")
+    all_vs_all_similarity_matrix(spectrums[:7], CrashingCosine(), n_jobs=1, tile_size=(3, 3),
+                                 output_folder=output_folder)
+    with pytest.raises(RuntimeError):
+        extend_similarity_matrix(output_folder, spectrums, CrashingCosine(max_pairs=5), n_jobs=1,
+                                 tile_size=(3, 3))
+    assert CondensedScoreMatrix.open(output_folder).n_spectrums == 7, "Expected unchanged matrix after crash."
+
+    similarity_function = CrashingCosine()
+    score_matrix = extend_similarity_matrix(output_folder, spectrums, similarity_function, n_jobs=1,
+                                            tile_size=(2, 2))
+    assert similarity_function.n_pairs == 8 + 9 + 10, "Expected only pairs with new spectrums to be computed."
+    expected_similarities, expected_matches = expected_similarity_matrix(spectrums, CosineGreedy())
+    similarities, num_matches = score_matrix.to_dense()
+    assert score_matrix.shape == (10, 10), "Expected extended matrix."
+    assert np.allclose(similarities, expected_similarities, atol=1e-6), "Expected same scores."
+    assert np.all(num_matches == expected_matches), "Expected same matches."
+
+
+def test_extend_similarity_matrix_checks_settings(tmp_path):
+    spectrums = get_test_spectrums(12)
+    output_folder = os.path.join(tmp_path, "matrix")
+    all_vs_all_similarity_matrix(spectrums[:6], CosineGreedy(), n_jobs=1, tile_size=(3, 3),
+                                 output_folder=output_folder)
+    for other_spectrums, similarity_function in [(spectrums[:8], CosineGreedy(tolerance=0.2)),
+                                                 (spectrums[:8], ModifiedCosine()),
+                                                 (spectrums[1:9], CosineGreedy())]:
+        with pytest.raises(AssertionError, match="different settings"):
+            extend_similarity_matrix(output_folder, other_spectrums, similarity_function, n_jobs=1)
+    assert CondensedScoreMatrix.open(output_folder).n_spectrums == 6, "Expected unchanged matrix."
+
+    extend_similarity_matrix(output_folder, PackedSpectra.from_spectra(spectrums[:9]), CosineGreedy(), n_jobs=1)
+    score_matrix = extend_similarity_matrix(output_folder, spectrums, CosineGreedy(), n_jobs=1)
+    assert score_matrix.spectra_hash == spectra_hash(spectrums), "Expected hash of all spectrums."
+    expected_similarities, _ = expected_similarity_matrix(spectrums, CosineGreedy())
+    assert np.allclose(score_matrix.to_dense()[0], expected_similarities, atol=1e-6), "Expected same scores."
+
+
+def test_all_vs_all_similarity_matrix_sparse_cutoff(tmp_path):
+    spectrums = get_test_spectrums(12)
+    modcos = ModifiedCosine(tolerance=0.5)
+    filename = os.path.join(tmp_path, "sparse.npz")
+    sparse_matrix = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=1, tile_size=(5, 5),
+                                                 score_cutoff=0.2, min_matches=2, filename=filename)
+    expected_similarities, expected_matches = expected_similarity_matrix(spectrums, modcos)
+    expected_selected = (expected_similarities > 0.2) & (expected_matches >= 2)
+    similarities, num_matches = sparse_matrix.to_dense()
+    assert len(sparse_matrix) == expected_selected.sum(), "Expected only selected entries."
+    assert np.all(similarities == np.where(expected_selected, expected_similarities, 0)), \
+        "Expected same scores for selected entries."
+    assert np.all(num_matches == np.where(expected_selected, expected_matches, 0)), \
+        "Expected same matches for selected entries."
+    loaded = SparseScoreMatrix.load(filename)
+    assert np.all(loaded.indptr == sparse_matrix.indptr) and np.all(loaded.indices == sparse_matrix.indices), \
+        "Expected same matrix after loading."
+
+
+def test_all_vs_all_similarity_matrix_sparse_top_n():
+    spectrums = get_test_spectrums(12)
+    modcos = ModifiedCosine(tolerance=0.5)
+    sparse_matrix = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=1, tile_size=(5, 5),
+                                                 top_n=3, ignore_diagonal=True)
+    expected_similarities, _ = expected_similarity_matrix(spectrums, modcos)
+    np.fill_diagonal(expected_similarities, -np.inf)
+    for i in range(12):
+        columns, scores, _ = sparse_matrix.row(i)
+        assert len(columns) == 3 and i not in columns, "Expected top 3 without diagonal."
+        assert np.allclose(np.sort(scores), np.sort(expected_similarities[i])[-3:]), \
+            "Expected top 3 scores."
+        assert np.all(expected_similarities[i, columns] == scores), "Expected scores of given columns."
+    assert sparse_matrix.to_scipy().shape == (12, 12), "Expected scipy sparse matrix."
+
+
+def test_all_vs_all_similarity_matrix_sparse_top_n_with_cutoff():
+    spectrums = get_test_spectrums(12)
+    cosine = CosineGreedy()
+    sparse_matrix = all_vs_all_similarity_matrix(spectrums, cosine, n_jobs=1, tile_size=(5, 5),
+                                                 top_n=3, score_cutoff=0.1, ignore_diagonal=True)
+    expected_similarities, _ = expected_similarity_matrix(spectrums, cosine)
+    np.fill_diagonal(expected_similarities, 0)
+    for i in range(12):
+        columns, scores, _ = sparse_matrix.row(i)
+        expected_columns = np.lexsort((np.arange(12), -expected_similarities[i]))[:3]
+        expected_columns = expected_columns[expected_similarities[i, expected_columns] > 0.1]
+        assert np.all(np.sort(columns) == np.sort(expected_columns)), "Expected only selected top 3 entries."
+        assert np.all(expected_similarities[i, columns] == scores), "Expected scores of given columns."
+
+
+@pytest.mark.parametrize("selection", [{"score_cutoff": 0.1, "min_matches": 1},
+                                       {"top_n": 1, "ignore_diagonal": True}])
+def test_all_vs_all_similarity_matrix_sparse_resume_from_checkpoint(tmp_path, selection):
+    spectrums = get_test_spectrums(10)
+    checkpoint_folder = os.path.join(tmp_path, "checkpoints")
+    expected_matrix = all_vs_all_similarity_matrix(spectrums, CosineGreedy(), n_jobs=1, tile_size=(3, 3),
+                                                   **selection)
+    with pytest.raises(RuntimeError):
+        all_vs_all_similarity_matrix(spectrums, CrashingCosine(max_pairs=20), n_jobs=1, tile_size=(3, 3),
+                                     checkpoint_folder=checkpoint_folder, **selection)
+    with np.load(os.path.join(checkpoint_folder, "tile_0_3_3_6.npz")) as data:
+        assert set(data.keys()) == {"rows", "columns", "scores", "matches"}, "Expected only selected entries."
+        assert len(data["scores"]) < 9, "Expected less entries than in the dense tile."
+
+    sparse_matrix = all_vs_all_similarity_matrix(spectrums, CrashingCosine(), n_jobs=1, tile_size=(3, 3),
+                                                 checkpoint_folder=checkpoint_folder, **selection)
+    similarities, num_matches = sparse_matrix.to_dense()
+    expected_similarities, expected_matches = expected_matrix.to_dense()
+    assert np.all(similarities == expected_similarities), "Expected same scores."
+    assert np.all(num_matches == expected_matches), "Expected same matches."
+    with pytest.raises(AssertionError, match="different settings"):
+        all_vs_all_similarity_matrix(spectrums, CrashingCosine(), n_jobs=1, tile_size=(3, 3),
+                                     checkpoint_folder=checkpoint_folder, score_cutoff=0.5)
+
+
+def test_precursor_window_pairs():
+    precursor_mz = [100.0, 114.01, None, 100.005, 250.0, 86.0]
+    pairs = precursor_window_pairs(precursor_mz, [(0, 0.01), (13.99, 14.02)])
+    expected_pairs = [(i, j) for i in range(6) for j in range(i, 6)
+                      if precursor_mz[i] is not None and precursor_mz[j] is not None
+                      and (abs(precursor_mz[i] - precursor_mz[j]) <= 0.01
+                           or 13.99 <= abs(precursor_mz[i] - precursor_mz[j]) <= 14.02)]
+    assert [tuple(x) for x in pairs] == sorted(expected_pairs), "Expected different pairs."
+
+
+def test_all_vs_all_similarity_matrix_precursor_windows():
+    spectrums = get_test_spectrums(15)
+    modcos = ModifiedCosine(tolerance=0.5)
+    sparse_matrix = all_vs_all_similarity_matrix(spectrums, modcos, n_jobs=1, max_precursor_difference=2.5,
+                                                 precursor_windows=[(9.5, 10.5)])
+    expected_similarities, expected_matches = expected_similarity_matrix(spectrums, modcos)
+    precursor_mz = np.array([s.get("precursor_mz") for s in spectrums])
+    differences = np.abs(precursor_mz.reshape(-1, 1) - precursor_mz.reshape(1, -1))
+    scheduled = (differences <= 2.5) | ((differences >= 9.5) & (differences <= 10.5))
+    rows, columns, scores, matches = sparse_matrix.to_coo()
+    assert len(sparse_matrix) == scheduled.sum(), "Expected all scheduled pairs (and only those)."
+    assert np.all(scheduled[rows, columns]), "Expected only scheduled pairs."
+    assert np.all(scores == expected_similarities[rows, columns]), "Expected same scores."
+    assert np.all(matches == expected_matches[rows, columns]), "Expected same matches."
@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pytest
+from spec2vec.vector_operations import cosine_similarity_matrix
+from custom_functions.score_storage import CondensedScoreMatrix
+from custom_functions.top_n_selection import RunningTopN, top_n_cosine, top_n_neighbours
+
+
+def test_running_top_n():
+    running_top_n = RunningTopN(2, 3, fields={"matches": "int"})
+    running_top_n.update(np.array([0, 1]), np.array([[0.5, 0.1, np.nan], [0.7, 0.1, 0.2]]),
+                         matches=np.array([[5, 1, 0], [7, 1, 2]]))
+    running_top_n.update(np.array([2, 3]), np.array([[0.6, 0.9, 0.3], [0.1, 0.1, -0.1]]),
+                         matches=np.array([[6, 9, 3], [1, 1, 0]]))
+    assert np.all(running_top_n.ids == np.array([[1, 2, 2], [2, 0, 1]])), "Expected different ids."
+    assert np.allclose(running_top_n.values, np.array([[0.7, 0.9, 0.3], [0.6, 0.1, 0.2]])), \
+        "Expected different values."
+    assert np.all(running_top_n.fields["matches"] == np.array([[7, 9, 3], [6, 1, 2]])), \
+        "Expected different matches."
+
+
+def test_running_top_n_large_blocks_with_ties():
+    rng = np.random.default_rng(2)
+    values = np.round(rng.random((40, 4)), 1)  # many ties
+    ids = rng.permutation(40)
+    running_top_n = RunningTopN(3, 4, fields={"matches": "int"})
+    for start in range(0, 40, 15):
+        running_top_n.update(ids[start:start + 15], values[start:start + 15],
+                             matches=10 * values[start:start + 15])
+    values_by_id = values[np.argsort(ids)]
+    for i in range(4):
+        expected_ids = np.lexsort((np.arange(40), -values_by_id[:, i]))[:3]
+        assert np.all(running_top_n.ids[:, i] == expected_ids), "Expected top 3 (lowest id for ties)."
+        assert np.all(running_top_n.fields["matches"][:, i] == (10 * values_by_id[expected_ids, i]).astype(int)), \
+            "Expected matches of selected ids."
+
+
+def test_top_n_cosine_same_as_full_matrix():
+    rng = np.random.default_rng(0)
+    library_vectors = rng.normal(size=(103, 8))
+    query_vectors = rng.normal(size=(7, 8))
+    similarities = cosine_similarity_matrix(library_vectors, query_vectors)
+    expected = np.argpartition(similarities, -5, axis=0)[-5:, :]
+
+    ids, scores = top_n_cosine(library_vectors, query_vectors, 5, block_size=10)
+    for i in range(7):
+        assert set(ids[:, i]) == set(expected[:, i]), "Expected same selection."
+    assert np.all(scores == np.take_along_axis(similarities, ids, axis=0)), "Expected same scores."
+    assert np.all(np.diff(scores, axis=0) <= 0), "Expected sorted scores."
+
+
+def test_top_n_cosine_rows():
+    rng = np.random.default_rng(1)
+    library_vectors = rng.normal(size=(50, 8))
+    query_vectors = rng.normal(size=(3, 8))
+    rows = np.arange(0, 50, 3)
+    ids, _ = top_n_cosine(library_vectors, query_vectors, 4, rows=rows, block_size=4)
+    expected_ids, _ = top_n_cosine(library_vectors[rows], query_vectors, 4)
+    assert np.all(ids == expected_ids), "Expected ids to be positions in rows."
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_top_n_neighbours_memory_mapped(tmp_path, n_jobs):
+    rng = np.random.default_rng(0)
+    scores = np.round(rng.random((23, 23)), 1)  # many ties
+    matches = rng.integers(0, 10, (23, 23))
+    np.save(os.path.join(tmp_path, "scores.npy"), scores)
+    np.save(os.path.join(tmp_path, "matches.npy"), matches)
+    scores_mmap = np.load(os.path.join(tmp_path, "scores.npy"), mmap_mode="r")
+    matches_mmap = np.load(os.path.join(tmp_path, "matches.npy"), mmap_mode="r")
+
+    similars_idx, similars = top_n_neighbours(scores_mmap, 5, matches=matches_mmap, min_matches=3,
+                                              block_size=4, n_jobs=n_jobs)
+    masked_scores = np.where(matches >= 3, scores, 0)
+    columns = np.arange(23)
+    for i in range(23):
+        expected_idx = np.lexsort((columns, -masked_scores[i]))[:5]
+        assert np.all(similars_idx[i] == expected_idx), "Expected top 5 (lowest index for ties)."
+        assert np.all(similars[i] == masked_scores[i, expected_idx]), "Expected top 5 scores."
+
+
+def test_top_n_neighbours_condensed_matrix(tmp_path):
+    rng = np.random.default_rng(1)
+    scores = rng.random((12, 12))
+    scores = (scores + scores.T) / 2
+    matches = np.ones((12, 12), dtype=int)
+    score_matrix = CondensedScoreMatrix.create(os.path.join(tmp_path, "matrix"), 12, score_dtype="float64")
+    score_matrix.write_tile((0, 12, 0, 12), scores, matches)
+    similars_idx, similars = top_n_neighbours(score_matrix, 3, block_size=5)
+    expected_idx = np.argsort(-scores, axis=1, kind="stable")[:, :3]
+    assert np.all(similars_idx == expected_idx), "Expected same top 3."
+    assert np.all(similars == np.take_along_axis(scores, expected_idx, axis=1)), "Expected same scores."
@@ -0,0 +1,21 @@
+import numpy as np
+from gensim.models import Word2Vec
+from matchms import Spectrum
+from spec2vec import SpectrumDocument
+
+
+def create_test_data(n_library=20, n_query=3):
+    """Create random library and query documents and a small Word2Vec model."""
+    rng = np.random.default_rng(42)
+    spectrums = []
+    for i in range(n_library + n_query):
+        mz = np.sort(rng.choice(np.arange(50, 300), 8, replace=False)).astype(float)
+        intensities = rng.uniform(0.05, 1.0, 8)
+        intensities /= intensities.max()
+        smiles = "C" * (i + 1) if i % 3 else None
+        spectrums.append(Spectrum(mz=mz, intensities=intensities,
+                                  metadata={"precursor_mz": float(300 + i), "smiles": smiles}))
+    documents = [SpectrumDocument(s, n_decimals=2) for s in spectrums]
+    model = Word2Vec([d.words for d in documents], vector_size=10, min_count=1,
+                     epochs=2, seed=1, workers=1)
+    return documents[:n_library], documents[n_library:], model